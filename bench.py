@@ -0,0 +1,357 @@
+"""
+Нагрузочный бенчмарк обработчиков бота и методов Database.
+
+Обработчики вызываются с настоящими объектами telegram.Update, а бот
+работает через поддельный транспорт (FakeRequest), поэтому сеть не нужна.
+Перед замером база заполняется синтетической историей заданного размера.
+
+Для каждого обработчика выводятся p50/p95/p99 задержки, пропускная
+способность, прирост RSS за время сценария и пиковый RSS процесса
+с начала прогона (он только растет и общий для всех сценариев).
+
+Примеры:
+    python bench.py
+    python bench.py --users 10000 --history-days 365 --requests 20000
+    DB_WRITE_BEHIND=1 python bench.py --concurrency 500
+    DATABASE_URL=postgresql://localhost/bench python bench.py  # пустая база PostgreSQL
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import resource
+import statistics
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+from types import SimpleNamespace
+
+class Stats:
+    """Замеры одного обработчика"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.latencies = []
+        self.wall_time = 0.0
+        self.errors = 0
+        # RSS на старте сценария: прирост считается только для этого сценария
+        self.rss_start = current_rss_mb()
+
+    def percentile(self, p: float):
+        """Перцентиль задержки в миллисекундах"""
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        index = min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))
+        return ordered[index] * 1000
+
+    def row(self):
+        """Строка итоговой таблицы"""
+        throughput = len(self.latencies) / self.wall_time if self.wall_time else 0.0
+        mean = statistics.fmean(self.latencies) * 1000 if self.latencies else 0.0
+        return {
+            'name': self.name,
+            'requests': len(self.latencies),
+            'errors': self.errors,
+            'mean_ms': round(mean, 3),
+            'p50_ms': round(self.percentile(50), 3),
+            'p95_ms': round(self.percentile(95), 3),
+            'p99_ms': round(self.percentile(99), 3),
+            'rps': round(throughput, 1),
+            'rss_delta_mb': round(current_rss_mb() - self.rss_start, 1),
+            'process_peak_rss_mb': round(peak_rss_mb(), 1),
+        }
+
+def peak_rss_mb():
+    """Пиковый RSS процесса с момента запуска в мегабайтах (ru_maxrss в Linux — в килобайтах)"""
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage / 1024 if sys.platform != 'darwin' else usage / 1024 / 1024
+
+def current_rss_mb():
+    """Текущий RSS процесса в мегабайтах из /proc/self/statm;
+    где /proc нет, используется пиковый RSS"""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return peak_rss_mb()
+    return pages * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+
+def make_fake_request():
+    """Транспорт Bot API без сети: отвечает на методы сразу"""
+    from telegram.request import BaseRequest
+
+    class FakeRequest(BaseRequest):
+        def __init__(self):
+            self.calls = 0
+            self._message_ids = itertools.count(1)
+
+        async def initialize(self):
+            pass
+
+        async def shutdown(self):
+            pass
+
+        async def do_request(self, url, method, request_data=None, read_timeout=None,
+                             write_timeout=None, connect_timeout=None, pool_timeout=None):
+            self.calls += 1
+            endpoint = url.rsplit('/', 1)[-1]
+            params = request_data.parameters if request_data else {}
+            if endpoint == 'getMe':
+                result = {'id': 1, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'}
+            elif endpoint in ('sendMessage', 'editMessageText', 'sendDocument'):
+                chat_id = int(params.get('chat_id', 0))
+                result = {
+                    'message_id': next(self._message_ids),
+                    'date': int(time.time()),
+                    'chat': {'id': chat_id, 'type': 'private'},
+                    'text': params.get('text', '')
+                }
+            else:
+                result = True
+            return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+    return FakeRequest()
+
+class UpdateFactory:
+    """Синтетические обновления Telegram для заданного бота"""
+
+    def __init__(self, tg_bot):
+        self.bot = tg_bot
+        self._ids = itertools.count(1)
+
+    def _user(self, user_id: int):
+        return {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}'}
+
+    def _message(self, user_id: int, text: str, from_user=None):
+        message = {
+            'message_id': next(self._ids),
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': from_user or self._user(user_id),
+            'text': text
+        }
+        if text.startswith('/'):
+            command = text.split()[0]
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]
+        return message
+
+    def message(self, user_id: int, text: str):
+        """Update с текстовым сообщением пользователя"""
+        from telegram import Update
+        data = {'update_id': next(self._ids), 'message': self._message(user_id, text)}
+        return Update.de_json(data, self.bot)
+
+    def callback(self, user_id: int, data: str):
+        """Update с нажатием inline-кнопки"""
+        from telegram import Update
+        bot_user = {'id': 1, 'is_bot': True, 'first_name': 'bench'}
+        payload = {
+            'update_id': next(self._ids),
+            'callback_query': {
+                'id': str(next(self._ids)),
+                'from': self._user(user_id),
+                'chat_instance': '1',
+                'message': self._message(user_id, '', from_user=bot_user),
+                'data': data
+            }
+        }
+        return Update.de_json(payload, self.bot)
+
+def seed_history(bot_module, users: int, history_days: int, actions_per_day: int):
+    """Заполнение базы историей: рабочие дни и действия за прошлые дни"""
+    db = bot_module.db
+    today = date.today()
+    started = time.perf_counter()
+    rng = random.Random(42)
+    for user_id in range(1, users + 1):
+        days, actions = [], []
+        for offset in range(1, history_days + 1):
+            work_date = today - timedelta(days=offset)
+            day = bot_module.date_to_day(work_date.isoformat())
+            start_at = bot_module.local_to_ts(day, 8 * 60 + rng.randint(0, 90), bot_module.DEFAULT_TZ)
+            days.append((user_id, day, start_at, start_at + (8 * 60 + rng.randint(0, 120)) * 60, None, None))
+            created = datetime.combine(work_date, datetime.min.time())
+            for k in range(actions_per_day):
+                action = f"Монтаж электропроводки №{k}"
+                actions.append((user_id, day, action, bot_module.search_terms(action),
+                                bot_module.datetime_to_ms(created + timedelta(hours=9 + k))))
+        db.storage.write_many([
+            (bot_module.SQL_UPSERT_WORK_DAY, days),
+            (bot_module.SQL_INSERT_WORK_TASK, actions)
+        ])
+    elapsed = time.perf_counter() - started
+    print(f"🌱 История: {users} пользователей × {history_days} дней × {actions_per_day} действий "
+          f"за {elapsed:.1f} с")
+
+def open_work_days(bot_module, users, work_date: str, start_at: int):
+    """Незакрытая смена за work_date у каждого пользователя (через Database, чтобы обновился кэш)"""
+    for user_id in users:
+        bot_module.db.add_work_day(user_id, work_date, start_at)
+
+async def run_handler(stats: Stats, handler, make_update, make_context, users, requests, concurrency):
+    """Параллельный прогон обработчика со сбором задержек"""
+    semaphore = asyncio.Semaphore(concurrency)
+    rng = random.Random(stats.name)
+
+    async def one(i):
+        user_id = users[i % len(users)] if i < len(users) else rng.choice(users)
+        update = make_update(user_id)
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                await handler(update, make_context())
+            except Exception as e:
+                stats.errors += 1
+                logging.error(f"❌ {stats.name}: {e}")
+            stats.latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    stats.wall_time = time.perf_counter() - started
+
+def run_db_method(stats: Stats, call, users, requests):
+    """Последовательный прогон синхронного метода Database"""
+    rng = random.Random(stats.name)
+    started = time.perf_counter()
+    for _ in range(requests):
+        user_id = rng.choice(users)
+        t0 = time.perf_counter()
+        call(user_id)
+        stats.latencies.append(time.perf_counter() - t0)
+    stats.wall_time = time.perf_counter() - started
+
+async def bench_handlers(bot_module, args, users):
+    """Прогон обработчиков через настоящий telegram.Bot с поддельным транспортом"""
+    from telegram import Bot
+
+    tg_bot = Bot(token='1:bench', request=make_fake_request(), get_updates_request=make_fake_request())
+    await tg_bot.initialize()
+    factory = UpdateFactory(tg_bot)
+    no_args = lambda: SimpleNamespace(args=[])
+
+    today = date.today()
+    month_args = lambda: SimpleNamespace(args=[
+        (today - timedelta(days=30)).strftime('%d.%m.%Y'), today.strftime('%d.%m.%Y')
+    ])
+
+    # Перезапись конца смены, открытой 8 часов назад: кнопка из ответа на повторный «Конец дня»
+    now = int(time.time())
+    work_date = bot_module.local_today(bot_module.DEFAULT_TZ, now)
+    overwrite_end = f"overwrite_end_{bot_module.date_to_day(work_date)}_{now}"
+    open_days = lambda: open_work_days(bot_module, users, work_date, now - 8 * 3600)
+
+    # Кнопки проходят через единый маршрутизатор, как в работающем боте.
+    # Последний элемент — подготовка данных перед сценарием
+    route = bot_module.route_text
+    scenarios = [
+        ('start_work_day', route,
+         lambda u: factory.message(u, bot_module.BUTTON_START_DAY), no_args, None),
+        ('add_action_complete', bot_module.add_action_complete,
+         lambda u: factory.message(u, "Прокладка кабеля ВВГнг 3x2.5"), no_args, None),
+        ('today_info', route,
+         lambda u: factory.message(u, bot_module.BUTTON_TODAY), no_args, None),
+        ('end_work_day', route,
+         lambda u: factory.message(u, bot_module.BUTTON_END_DAY), no_args, None),
+        ('handle_overwrite_callback', bot_module.handle_overwrite_callback,
+         lambda u: factory.callback(u, overwrite_end), no_args, open_days),
+        ('report (30 дней)', bot_module.report,
+         lambda u: factory.message(u, "/report"), month_args, None),
+    ]
+
+    results = []
+    for name, handler, make_update, make_context, setup in scenarios:
+        if args.only and not any(name.startswith(o) for o in args.only):
+            continue
+        if setup:
+            setup()
+        stats = Stats(name)
+        await run_handler(stats, handler, make_update, make_context, users, args.requests, args.concurrency)
+        results.append(stats.row())
+        print(f"  ✅ {name}")
+
+    await tg_bot.shutdown()
+    return results
+
+def bench_db(bot_module, args, users):
+    """Прогон методов Database напрямую, без обработчиков"""
+    db = bot_module.db
+    today = date.today().isoformat()
+    month_ago = (date.today() - timedelta(days=30)).isoformat()
+    scenarios = [
+        ('db.get_work_day', lambda u: db.get_work_day(u, today)),
+        ('db.get_work_tasks', lambda u: db.get_work_tasks(u, today)),
+        ('db.add_work_task', lambda u: db.add_work_task(u, today, "Замена проводки")),
+        ('db.iter_period_report', lambda u: list(db.iter_period_report(u, month_ago, today))),
+    ]
+    results = []
+    for name, call in scenarios:
+        if args.only and not any(name.startswith(o) for o in args.only):
+            continue
+        stats = Stats(name)
+        run_db_method(stats, call, users, args.requests)
+        results.append(stats.row())
+        print(f"  ✅ {name}")
+    return results
+
+def print_table(rows):
+    """Итоговая таблица результатов"""
+    columns = ['name', 'requests', 'errors', 'mean_ms', 'p50_ms', 'p95_ms', 'p99_ms', 'rps', 'rss_delta_mb',
+               'process_peak_rss_mb']
+    widths = {c: max(len(c), *(len(str(r[c])) for r in rows)) for c in columns}
+    print("  ".join(c.ljust(widths[c]) for c in columns))
+    for row in rows:
+        print("  ".join(str(row[c]).ljust(widths[c]) for c in columns))
+
+def main():
+    """Запуск бенчмарка"""
+    parser = argparse.ArgumentParser(description="Бенчмарк обработчиков бота")
+    parser.add_argument('--users', type=int, default=1000, help="Число пользователей")
+    parser.add_argument('--history-days', type=int, default=30, help="Дней истории на пользователя")
+    parser.add_argument('--actions-per-day', type=int, default=3, help="Действий в день в истории")
+    parser.add_argument('--requests', type=int, default=5000, help="Вызовов на каждый обработчик")
+    parser.add_argument('--concurrency', type=int, default=100, help="Одновременных обновлений")
+    parser.add_argument('--only', nargs='*', help="Запускать только указанные сценарии (по префиксу)")
+    parser.add_argument('--json', dest='json_path', help="Сохранить результаты в JSON")
+    parser.add_argument('--keep-db', action='store_true', help="Не удалять базу после прогона")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench_')
+    os.environ.setdefault('DB_PATH', os.path.join(workdir, 'bench.db'))
+
+    started = time.perf_counter()
+    import bot as bot_module
+    imported = time.perf_counter()
+    bot_module.db.migrate()
+    print(f"📦 Импорт bot.py: {(imported - started) * 1000:.0f} мс, "
+          f"миграции: {(time.perf_counter() - imported) * 1000:.0f} мс, "
+          f"база: {bot_module.db.storage.description}")
+    logging.getLogger().setLevel(logging.WARNING)
+
+    users = list(range(1, args.users + 1))
+    seed_history(bot_module, args.users, args.history_days, args.actions_per_day)
+
+    print("🚀 Обработчики:")
+    rows = asyncio.run(bench_handlers(bot_module, args, users))
+    print("🚀 Методы Database:")
+    rows += bench_db(bot_module, args, users)
+
+    bot_module.adb.close()
+    print()
+    print_table(rows)
+
+    if args.json_path:
+        with open(args.json_path, 'w', encoding='utf-8') as f:
+            json.dump(rows, f, ensure_ascii=False, indent=2)
+    if not args.keep_db and bot_module.DB_PATH.startswith(workdir):
+        for name in os.listdir(workdir):
+            os.remove(os.path.join(workdir, name))
+        os.rmdir(workdir)
+
+if __name__ == '__main__':
+    main()
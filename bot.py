@@ -1,7 +1,26 @@
+import time
+
+# Начало импорта модуля: время запуска попадает в /ready и метрики
+IMPORT_STARTED = time.perf_counter()
+
 import os
+import re
+import asyncio
+import bisect
+import functools
+import heapq
+import inspect
+import itertools
+import json
 import logging
 import sqlite3
+import threading
+import copy
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager, asynccontextmanager
 from datetime import datetime, date, timedelta
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 
 # Настройка логирования для Railway
 logging.basicConfig(
@@ -12,134 +31,2454 @@ logging.basicConfig(
 # Загрузка переменных окружения
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 
-if not BOT_TOKEN:
-    logging.error("❌ BOT_TOKEN не найден! Проверьте переменные окружения на Railway.")
-    exit(1)
+# Путь к файлу базы данных
+DB_PATH = os.getenv('DB_PATH', 'work_tracker.db')
+
+# PostgreSQL: если задан DATABASE_URL, данные хранятся в нем вместо файла DB_PATH.
+# Размер пула соединений и порог подготовки запросов на сервере
+# (0 — сразу, пустое значение — выключено, например за PgBouncer в режиме transaction)
+DATABASE_URL = os.getenv('DATABASE_URL')
+PG_POOL_MIN = int(os.getenv('PG_POOL_MIN', '1'))
+PG_POOL_MAX = int(os.getenv('PG_POOL_MAX', '10'))
+PG_PREPARE_THRESHOLD = int(os.getenv('PG_PREPARE_THRESHOLD', '0') or -1)
+
+# Режим webhook: если задан WEBHOOK_URL, вместо long polling поднимается HTTP-сервер
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+PORT = int(os.getenv('PORT', '8443'))
+
+# Адрес Bot API (для локального запуска с fake_telegram.py)
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')
+
+# Размер пула HTTP-соединений к Bot API (соединения переиспользуются между запросами)
+TELEGRAM_POOL_SIZE = int(os.getenv('TELEGRAM_POOL_SIZE', '256'))
+
+# Очередь исходящих сообщений: общий лимит Telegram (сообщений в секунду),
+# лимит на чат с допустимым всплеском, число задач отправки и попыток при ошибках сети
+OUTBOUND_QUEUE = os.getenv('OUTBOUND_QUEUE', '1') == '1'
+OUTBOUND_GLOBAL_RATE = float(os.getenv('OUTBOUND_GLOBAL_RATE', '30'))
+OUTBOUND_CHAT_RATE = float(os.getenv('OUTBOUND_CHAT_RATE', '1'))
+OUTBOUND_CHAT_BURST = int(os.getenv('OUTBOUND_CHAT_BURST', '3'))
+OUTBOUND_WORKERS = int(os.getenv('OUTBOUND_WORKERS', '8'))
+OUTBOUND_MAX_ATTEMPTS = 3
+OUTBOUND_CHAT_BUCKETS = 10000
+
+# Число обновлений, обрабатываемых одновременно (обновления одного пользователя идут
+# по очереди), и потоков для работы с базой
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', '256'))
+DB_THREADS = int(os.getenv('DB_THREADS', '4'))
+
+# Отложенная запись в базу: изменения копятся и сбрасываются пачками
+DB_WRITE_BEHIND = os.getenv('DB_WRITE_BEHIND', '0') == '1'
+DB_FLUSH_INTERVAL_MS = int(os.getenv('DB_FLUSH_INTERVAL_MS', '50'))
+DB_FLUSH_MAX_ROWS = int(os.getenv('DB_FLUSH_MAX_ROWS', '500'))
+
+# Кэш текущего дня: максимум записей и время жизни записи в секундах
+TODAY_CACHE_SIZE = int(os.getenv('TODAY_CACHE_SIZE', '10000'))
+TODAY_CACHE_TTL = float(os.getenv('TODAY_CACHE_TTL', '3600'))
+
+# Метрики: порт HTTP-эндпоинта /metrics и период записи сводки в лог (0 — выключено)
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+METRICS_LOG_INTERVAL = float(os.getenv('METRICS_LOG_INTERVAL', '0'))
+
+# Отдельный порт для проб /health и /ready (0 — пробы доступны только на METRICS_PORT)
+HEALTH_PORT = int(os.getenv('HEALTH_PORT', '0'))
+
+# Напоминания и автозакрытие дня: время HH:MM (по умолчанию выключены, например
+# REMINDER_START_TIME=09:00 REMINDER_END_TIME=19:00 AUTO_CLOSE_TIME=23:59)
+# и дни недели для напоминаний (1 — понедельник). Время и день недели считаются
+# в поясе пользователя: задачи планируются отдельно для каждого пояса из таблицы users
+REMINDER_START_TIME = os.getenv('REMINDER_START_TIME', '')
+REMINDER_END_TIME = os.getenv('REMINDER_END_TIME', '')
+AUTO_CLOSE_TIME = os.getenv('AUTO_CLOSE_TIME', '')
+REMINDER_DAYS = {int(d) for d in os.getenv('REMINDER_DAYS', '1,2,3,4,5').split(',') if d.strip()}
+
+# При переходе на таблицу users (миграция v5) напоминания включаются только тем,
+# кто отмечал дни или действия за это число дней; остальные включают их через /reminders on
+REMINDER_ACTIVE_DAYS = int(os.getenv('REMINDER_ACTIVE_DAYS', '30'))
+
+# Смены, начатые меньше этого числа часов назад, не закрываются автоматически (ночные смены)
+AUTO_CLOSE_GRACE_HOURS = float(os.getenv('AUTO_CLOSE_GRACE_HOURS', '8'))
+
+# Часовой пояс (IANA) пользователей, не выбравших свой; в нем же
+# пересчитываются записи, сделанные до хранения времени в UTC
+DEFAULT_TZ = os.getenv('DEFAULT_TZ') or os.getenv('TZ') or 'UTC'
+
+# Состояние диалога пользователя: в памяти процесса, а на общей базе реплик — в колонке
+# users.state (NULL — STATE_IDLE), чтобы следующее сообщение могла обработать любая реплика
+STATE_IDLE = 'idle'
+STATE_AWAITING_ACTION = 'awaiting_action'
+
+# Тексты кнопок основной клавиатуры
+BUTTON_START_DAY = "🟢 Начало рабочего дня"
+BUTTON_END_DAY = "🔴 Конец рабочего дня"
+BUTTON_ADD_ACTION = "📝 Добавить действие"
+BUTTON_TODAY = "📅 Сегодня"
+BUTTON_BREAK = "☕ Перерыв"
+
+# ============================
+# МЕТРИКИ
+# ============================
+
+# Границы корзин гистограмм задержек, секунды
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Metrics:
+    """Счетчики, гистограммы и вычисляемые показатели в формате Prometheus"""
+    
+    def __init__(self, buckets=METRICS_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+        self._help = {}
+    
+    def describe(self, name: str, kind: str, text: str):
+        """Описание показателя для вывода в /metrics"""
+        self._help[name] = (kind, text)
+    
+    def inc(self, name: str, value: float = 1, **labels):
+        """Увеличение счетчика"""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+    
+    def observe(self, name: str, seconds: float, **labels):
+        """Запись значения в гистограмму"""
+        key = (name, tuple(sorted(labels.items())))
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            histogram[0][index] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+    
+    def gauge(self, name: str, func):
+        """Показатель, вычисляемый при каждом чтении метрик"""
+        self._gauges[name] = func
+    
+    @contextmanager
+    def timer(self, name: str, **labels):
+        """Замер длительности блока кода"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+    
+    def _gauge_values(self):
+        """Текущие значения вычисляемых показателей"""
+        values = {}
+        for name, func in list(self._gauges.items()):
+            try:
+                values[name] = func()
+            except Exception as e:
+                logging.error(f"❌ Ошибка при расчете метрики {name}: {e}")
+        return values
+    
+    def render(self):
+        """Текст в формате Prometheus exposition"""
+        def fmt_labels(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+        
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {k: (list(v[0]), v[1], v[2]) for k, v in self._histograms.items()}
+        
+        lines = []
+        described = set()
+        
+        def header(name, default_kind):
+            if name in described:
+                return
+            described.add(name)
+            kind, text = self._help.get(name, (default_kind, name))
+            lines.append(f"# HELP {name} {text}")
+            lines.append(f"# TYPE {name} {kind}")
+        
+        for (name, labels), value in sorted(counters.items()):
+            header(name, 'counter')
+            lines.append(f"{name}{fmt_labels(labels)} {value}")
+        
+        for (name, labels), (counts, total, count) in sorted(histograms.items()):
+            header(name, 'histogram')
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{fmt_labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_bucket{fmt_labels(labels, [('le', '+Inf')])} {count}")
+            lines.append(f"{name}_sum{fmt_labels(labels)} {total}")
+            lines.append(f"{name}_count{fmt_labels(labels)} {count}")
+        
+        for name, value in sorted(self._gauge_values().items()):
+            header(name, 'gauge')
+            if isinstance(value, dict):
+                for label, item in sorted(value.items()):
+                    lines.append(f'{name}{{key="{label}"}} {item}')
+            else:
+                lines.append(f"{name} {value}")
+        
+        return "\n".join(lines) + "\n"
+    
+    def snapshot(self):
+        """Сводка для структурированного лога: число вызовов и средняя задержка"""
+        with self._lock:
+            counters = {
+                name + fmt_label_suffix(labels): value
+                for (name, labels), value in self._counters.items()
+            }
+            histograms = {
+                name + fmt_label_suffix(labels): {
+                    'count': count,
+                    'avg_ms': round(total / count * 1000, 3) if count else 0.0
+                }
+                for (name, labels), (_, total, count) in self._histograms.items()
+            }
+        return {'counters': counters, 'histograms': histograms, 'gauges': self._gauge_values()}
+
+def fmt_label_suffix(labels):
+    """Метки в виде суффикса имени для логов: name[a=1,b=2]"""
+    if not labels:
+        return ""
+    return "[" + ",".join(f"{k}={v}" for k, v in labels) + "]"
+
+metrics = Metrics()
+metrics.describe('bot_updates_total', 'counter', 'Processed updates per handler')
+metrics.describe('bot_handler_errors_total', 'counter', 'Handler exceptions per handler')
+metrics.describe('bot_handler_seconds', 'histogram', 'Handler latency')
+metrics.describe('bot_update_seconds', 'histogram', 'Full update processing time including handler dispatch')
+metrics.describe('bot_db_query_seconds', 'histogram', 'Database method latency')
+metrics.describe('bot_db_errors_total', 'counter', 'Database method exceptions')
+metrics.describe('bot_telegram_api_seconds', 'histogram', 'Telegram Bot API request latency')
+metrics.describe('bot_telegram_api_requests_total', 'counter', 'Telegram Bot API requests by status code')
+metrics.describe('bot_db_executor_pending', 'gauge', 'Database calls queued or running in the executor')
+metrics.describe('bot_db_write_queue', 'gauge', 'Mutations waiting in the write-behind queue')
+metrics.describe('bot_db_write_lost_total', 'counter', 'Mutations dropped after write-behind retries failed')
+metrics.describe('bot_db_connections', 'gauge', 'Open database connections')
+metrics.describe('bot_today_cache', 'gauge', 'Today cache counters')
+metrics.describe('bot_ready', 'gauge', 'Startup checks passed and the bot accepts updates')
+metrics.describe('bot_startup_seconds', 'gauge', 'Duration of startup stages')
 
-# Глобальные переменные для хранения выбранных дат
-user_selections = {}
+def db_timed(func):
+    """Замер длительности метода Database (для генераторов — всего обхода)"""
+    name = func.__name__
+    
+    if inspect.isgeneratorfunction(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                yield from func(*args, **kwargs)
+            except Exception:
+                metrics.inc('bot_db_errors_total', method=name)
+                raise
+            finally:
+                metrics.observe('bot_db_query_seconds', time.perf_counter() - started, method=name)
+        return wrapper
+    
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            metrics.inc('bot_db_errors_total', method=name)
+            raise
+        finally:
+            metrics.observe('bot_db_query_seconds', time.perf_counter() - started, method=name)
+    return wrapper
+
+def timed_handler(callback):
+    """Обертка обработчика: задержка, число обновлений и ошибок"""
+    name = callback.__name__
+    
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        metrics.inc('bot_updates_total', handler=name)
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            metrics.inc('bot_handler_errors_total', handler=name)
+            raise
+        finally:
+            metrics.observe('bot_handler_seconds', time.perf_counter() - started, handler=name)
+    return wrapper
+
+# ============================
+# ГОТОВНОСТЬ К РАБОТЕ
+# ============================
+
+class Readiness:
+    """Проверки при запуске и длительность этапов старта.
+    Бот готов, когда все проверки завершились успешно"""
+    
+    def __init__(self, checks):
+        self._lock = threading.Lock()
+        # Проверка -> None (выполняется), True или False
+        self.checks = {name: None for name in checks}
+        self.timings = {}
+    
+    def record(self, stage: str, seconds: float):
+        """Длительность этапа запуска"""
+        with self._lock:
+            self.timings[stage] = round(seconds, 4)
+    
+    def finish(self, check: str, ok: bool, seconds: float = None):
+        """Результат проверки (и ее длительность)"""
+        with self._lock:
+            self.checks[check] = ok
+        if seconds is not None:
+            self.record(check, seconds)
+    
+    @property
+    def ready(self):
+        with self._lock:
+            return all(self.checks.values())
+    
+    def status(self):
+        """Состояние для /ready"""
+        names = {None: 'pending', True: 'ok', False: 'failed'}
+        with self._lock:
+            return {
+                'ready': all(self.checks.values()),
+                'checks': {name: names[ok] for name, ok in self.checks.items()},
+                'startup_seconds': dict(self.timings)
+            }
+
+# schema — миграции базы, telegram — подключение к Bot API и запуск фоновых задач
+readiness = Readiness(['schema', 'telegram'])
+metrics.gauge('bot_ready', lambda: int(readiness.ready))
+metrics.gauge('bot_startup_seconds', lambda: dict(readiness.timings))
+
+def start_metrics_server(port: int, listen: str = '0.0.0.0'):
+    """Запуск HTTP-сервера метрик и проб /health, /ready в фоновом потоке
+    (http.server импортируется только здесь)"""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    
+    class MetricsHTTPHandler(BaseHTTPRequestHandler):
+        """/metrics в формате Prometheus, /health — процесс жив, /ready — бот принимает обновления"""
+        
+        def do_GET(self):
+            path = self.path.split('?')[0]
+            if path == '/metrics':
+                self._send(200, 'text/plain; version=0.0.4; charset=utf-8', metrics.render().encode())
+            elif path == '/health':
+                self._send(200, 'text/plain; charset=utf-8', b'ok\n')
+            elif path == '/ready':
+                body = json.dumps(readiness.status()).encode()
+                self._send(200 if readiness.ready else 503, 'application/json', body)
+            else:
+                self.send_error(404)
+        
+        def _send(self, status: int, content_type: str, body: bytes):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        
+        def log_message(self, format, *args):
+            pass
+    
+    server = ThreadingHTTPServer((listen, port), MetricsHTTPHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    print(f"📊 Метрики и пробы доступны на http://{listen}:{port}/metrics, /health, /ready")
+    return server
+
+def start_check(name: str, func):
+    """Проверка при запуске в отдельном потоке, параллельно с остальным стартом.
+    func() возвращает True при успехе; результат попадает в readiness"""
+    future = Future()
+    
+    def run():
+        started = time.perf_counter()
+        try:
+            ok = bool(func())
+        except Exception as e:
+            logging.error(f"❌ Ошибка проверки {name} при запуске: {e}")
+            ok = False
+        readiness.finish(name, ok, time.perf_counter() - started)
+        future.set_result(ok)
+    
+    threading.Thread(target=run, name=f"startup-{name}", daemon=True).start()
+    return future
+
+def start_metrics_logger(interval: float):
+    """Периодическая запись сводки метрик в лог одной JSON-строкой"""
+    stop = threading.Event()
+    
+    def run():
+        while not stop.wait(interval):
+            logging.info("📊 metrics " + json.dumps(metrics.snapshot(), ensure_ascii=False, default=str))
+    
+    threading.Thread(target=run, name="metrics-log", daemon=True).start()
+    return stop
 
 # ============================
 # БАЗА ДАННЫХ
 # ============================
 
-class Database:
-    def __init__(self, db_name: str = "work_tracker.db"):
-        self.db_name = db_name
-        print(f"🔄 Инициализация базы данных: {self.db_name}")
-        self.init_db()
+# Настройки SQLite: WAL-журнал, кэш страниц и memory-mapped I/O
+SQLITE_BUSY_TIMEOUT = 5.0
+SQLITE_CACHE_SIZE_KB = 16384
+SQLITE_MMAP_SIZE = 64 * 1024 * 1024
+SQLITE_CACHED_STATEMENTS = 64
+
+# Вычет на обед при расчете часов, минут (если перерывы за день не отмечались)
+LUNCH_MINUTES = 60
+
+# Поиск: максимум слов в запросе
+SEARCH_MAX_WORDS = 10
+
+# Размер пачки строк при переносе данных в миграциях
+MIGRATION_BATCH_SIZE = 5000
+
+# Даты хранятся как номер дня от 1970-01-01, моменты времени — как секунды UTC
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+def date_to_day(date_str):
+    """Дата YYYY-MM-DD -> номер дня от начала эпохи"""
+    return date.fromisoformat(date_str).toordinal() - EPOCH_ORDINAL
+
+def day_to_date(day):
+    """Номер дня от начала эпохи -> дата YYYY-MM-DD"""
+    return date.fromordinal(day + EPOCH_ORDINAL).isoformat()
+
+def time_to_minutes(time_str):
+    """Время HH:MM -> минуты от полуночи (пустое время -> None)"""
+    if not time_str:
+        return None
+    hours, minutes = time_str.split(':')
+    return int(hours) * 60 + int(minutes)
+
+def minutes_to_time(minutes):
+    """Минуты от полуночи -> время HH:MM (None -> пустая строка)"""
+    if minutes is None:
+        return ""
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+def month_key(d):
+    """Дата -> ключ месяца YYYYMM"""
+    return d.year * 100 + d.month
+
+def datetime_to_ms(dt):
+    """Момент времени -> миллисекунды от начала эпохи"""
+    return int(dt.timestamp() * 1000)
+
+# Смещение пояса кэшируется по 15-минутным интервалам: переходы на летнее
+# время происходят на их границах, поэтому внутри интервала смещение постоянно
+TZ_OFFSET_STEP = 900
+
+@functools.lru_cache(maxsize=None)
+def get_zone(name: str):
+    """Часовой пояс по имени IANA (None, если пояс неизвестен)"""
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        return None
+
+if not get_zone(DEFAULT_TZ):
+    logging.warning(f"⚠️ Неизвестный часовой пояс DEFAULT_TZ={DEFAULT_TZ}, используется UTC")
+    DEFAULT_TZ = 'UTC'
+
+def zone_name(name):
+    """Пояс пользователя или DEFAULT_TZ, если пояс не выбран или неизвестен"""
+    return name if name and get_zone(name) else DEFAULT_TZ
+
+@functools.lru_cache(maxsize=65536)
+def _tz_offset(tz: str, step: int):
+    return int(datetime.fromtimestamp(step * TZ_OFFSET_STEP, get_zone(tz)).utcoffset().total_seconds())
+
+def tz_offset(tz: str, ts):
+    """Смещение пояса от UTC в секундах в момент ts"""
+    return _tz_offset(tz, int(ts) // TZ_OFFSET_STEP)
+
+def ts_to_day(ts, tz: str):
+    """Момент (секунды UTC) -> номер местного дня в поясе tz"""
+    return (int(ts) + tz_offset(tz, ts)) // 86400
+
+def ts_to_time(ts, tz: str):
+    """Момент (секунды UTC) -> местное время HH:MM в поясе tz (None -> пустая строка)"""
+    if ts is None:
+        return ""
+    return minutes_to_time((int(ts) + tz_offset(tz, ts)) % 86400 // 60)
+
+def local_today(tz: str, now):
+    """Местная дата YYYY-MM-DD в поясе tz в момент now"""
+    return day_to_date(ts_to_day(now, tz))
+
+def local_to_ts(day, minutes, tz: str):
+    """Местное время (номер дня, минуты от полуночи) в поясе tz -> секунды UTC"""
+    local = day * 86400 + minutes * 60
+    guess = local - tz_offset(tz, local)
+    return local - tz_offset(tz, guess)
+
+def break_minutes(break_min, break_at, at):
+    """Минуты перерывов с учетом незакрытого перерыва, завершенного в момент at
+    (None — перерывы не отмечались, вычитается обед)"""
+    if break_at is None:
+        return break_min
+    return (break_min or 0) + max(0, at - break_at) // 60
+
+# Слова поискового запроса и окончания, отбрасываемые без стеммера Snowball
+SEARCH_WORD = re.compile(r'\w+')
+CYRILLIC_WORD = re.compile(r'^[а-яё]+$')
+# Беглая гласная в конце основы (розетка — розеток, щиток — щитка): выбрасывается,
+# чтобы все формы слова давали одну основу
+FLEETING_VOWEL = re.compile(r'(?<=[бвгджзклмнпрстфхцчшщ])[оеё](?=[кцн]$)')
+RUSSIAN_ENDINGS = sorted((
+    'иями', 'ями', 'ами', 'ого', 'его', 'ому', 'ему', 'ыми', 'ими', 'ией', 'ться',
+    'ой', 'ей', 'ий', 'ый', 'ая', 'яя', 'ое', 'ее', 'ые', 'ие', 'ую', 'юю', 'ов', 'ев',
+    'ам', 'ям', 'ах', 'ях', 'ом', 'ем', 'ия', 'ию', 'ть', 'ет', 'ит', 'ут', 'ют', 'ат', 'ят',
+    'а', 'я', 'о', 'е', 'ы', 'и', 'у', 'ю', 'ь', 'й'
+), key=len, reverse=True)
+
+@functools.lru_cache(maxsize=1)
+def russian_stemmer():
+    """Стеммер Snowball для русского языка (None, если snowballstemmer не установлен)"""
+    try:
+        import snowballstemmer
+    except ImportError:
+        return None
+    return snowballstemmer.stemmer('russian')
+
+@functools.lru_cache(maxsize=10000)
+def stem_word(word: str):
+    """Основа русского слова для поискового индекса и запроса; прочие слова не меняются"""
+    word = word.lower().replace('ё', 'е')
+    if not CYRILLIC_WORD.match(word):
+        return word
+    stemmer = russian_stemmer()
+    if stemmer:
+        stem = stemmer.stemWord(word)
+    else:
+        stem = word
+        for ending in RUSSIAN_ENDINGS:
+            if word.endswith(ending) and len(word) - len(ending) >= 3:
+                stem = word[:-len(ending)]
+                break
+    return FLEETING_VOWEL.sub('', stem) if len(stem) >= 4 else stem
+
+def search_terms(text):
+    """Основы слов описания через пробел: индексируются вместо исходного текста,
+    поэтому запрос и индекс приводятся к основам одним и тем же стеммером"""
+    return ' '.join(stem_word(word) for word in SEARCH_WORD.findall((text or '').lower()))
+
+# Запросы вынесены в константы, чтобы одинаковый текст SQL
+# переиспользовал подготовленные выражения из кэша соединения
+SQL_UPSERT_WORK_DAY = '''
+    INSERT INTO work_days (user_id, day, start_at, end_at, break_min, break_at)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT (user_id, day) DO UPDATE SET
+        start_at = excluded.start_at, end_at = excluded.end_at,
+        break_min = excluded.break_min, break_at = excluded.break_at
+'''
+SQL_INSERT_WORK_TASK = '''
+    INSERT INTO work_actions (user_id, day, action_description, search_terms, created_at)
+    VALUES (?, ?, ?, ?, ?)
+'''
+SQL_SELECT_WORK_DAY = '''
+    SELECT user_id, day, start_at, end_at, break_min, break_at FROM work_days WHERE user_id = ? AND day = ?
+'''
+SQL_SELECT_WORK_TASKS = '''
+    SELECT action_description FROM work_actions 
+    WHERE user_id = ? AND day = ?
+    ORDER BY created_at
+'''
+SQL_SELECT_PERIOD_DAYS = '''
+    SELECT day, start_at, end_at, break_min FROM work_days 
+    WHERE user_id = ? AND day BETWEEN ? AND ?
+    ORDER BY day
+'''
+SQL_SELECT_PERIOD_TASKS = '''
+    SELECT day, action_description FROM work_actions 
+    WHERE user_id = ? AND day BETWEEN ? AND ?
+    ORDER BY day, created_at
+'''
+SQL_DELETE_WORK_DAY = 'DELETE FROM work_days WHERE user_id = ? AND day = ?'
+SQL_DELETE_WORK_TASKS = 'DELETE FROM work_actions WHERE user_id = ? AND day = ?'
+
+# Отчет за период: часы (из daily_totals) и число действий по дням одним запросом
+SQL_SELECT_PERIOD_REPORT = '''
+    SELECT day, MAX(start_at), MAX(end_at), MAX(minutes), MAX(lunch_minutes),
+           CAST(SUM(actions) AS INTEGER)
+    FROM (
+        SELECT w.day, w.start_at, w.end_at, t.minutes, t.lunch_minutes, 0 AS actions
+        FROM work_days w
+        JOIN daily_totals t ON t.user_id = w.user_id AND t.day = w.day
+        WHERE w.user_id = ? AND w.day BETWEEN ? AND ?
+        UNION ALL
+        SELECT day, NULL, NULL, 0, 0, COUNT(*) FROM work_actions
+        WHERE user_id = ? AND day BETWEEN ? AND ?
+        GROUP BY day
+    ) AS per_day
+    GROUP BY day
+    ORDER BY day
+'''
+# Выгрузка истории: рабочие дни с действиями, плюс действия в дни без отметок.
+# Курсор читается построчно, сортировка выполняется на стороне SQLite.
+# Пояс пользователя нужен, чтобы показать время в его местных часах
+SQL_EXPORT_TEMPLATE = '''
+    SELECT w.user_id, w.day, w.start_at, w.end_at, t.minutes, t.lunch_minutes,
+           a.created_at, a.action_description, u.tz
+    FROM work_days w
+    LEFT JOIN daily_totals t ON t.user_id = w.user_id AND t.day = w.day
+    LEFT JOIN work_actions a ON a.user_id = w.user_id AND a.day = w.day
+    LEFT JOIN users u ON u.user_id = w.user_id
+    WHERE w.day BETWEEN ? AND ? {user_filter_w}
+    UNION ALL
+    SELECT a.user_id, a.day, NULL, NULL, NULL, NULL, a.created_at, a.action_description, u.tz
+    FROM work_actions a
+    LEFT JOIN users u ON u.user_id = a.user_id
+    WHERE a.day BETWEEN ? AND ? {user_filter_a}
+      AND NOT EXISTS (SELECT 1 FROM work_days w WHERE w.user_id = a.user_id AND w.day = a.day)
+    ORDER BY 1, 2, 7
+'''
+SQL_EXPORT_ALL = SQL_EXPORT_TEMPLATE.format(user_filter_w='', user_filter_a='')
+SQL_EXPORT_USER = SQL_EXPORT_TEMPLATE.format(
+    user_filter_w='AND w.user_id = ?', user_filter_a='AND a.user_id = ?'
+)
+
+SQL_SELECT_MONTHLY_TOTALS = '''
+    SELECT month, days, minutes, lunch_minutes FROM monthly_totals
+    WHERE user_id = ? AND month BETWEEN ? AND ?
+    ORDER BY month
+'''
+
+# Поиск по описаниям действий: FTS5 по основам слов, ранжирование bm25 без учета колонки user_id
+SQL_SEARCH_ACTIONS = '''
+    SELECT a.day, a.created_at, a.action_description
+    FROM work_actions_fts
+    JOIN work_actions a ON a.id = work_actions_fts.rowid
+    WHERE work_actions_fts MATCH ?
+    ORDER BY bm25(work_actions_fts, 0.0, 1.0), a.id DESC
+    LIMIT ? OFFSET ?
+'''
+PG_SQL_SEARCH_ACTIONS = '''
+    SELECT day, created_at, action_description FROM work_actions
+    WHERE user_id = ? AND search_tsv @@ to_tsquery('simple', ?)
+    ORDER BY ts_rank(search_tsv, to_tsquery('simple', ?)) DESC, id DESC
+    LIMIT ? OFFSET ?
+'''
+
+# Пользователи и настройка напоминаний
+SQL_INSERT_USER = 'INSERT INTO users (user_id) VALUES (?) ON CONFLICT (user_id) DO NOTHING'
+SQL_UPSERT_USER_REMINDERS = '''
+    INSERT INTO users (user_id, reminders) VALUES (?, ?)
+    ON CONFLICT (user_id) DO UPDATE SET reminders = excluded.reminders
+'''
+SQL_SELECT_USER_REMINDERS = 'SELECT reminders FROM users WHERE user_id = ?'
+SQL_UPSERT_USER_TIMEZONE = '''
+    INSERT INTO users (user_id, tz) VALUES (?, ?)
+    ON CONFLICT (user_id) DO UPDATE SET tz = excluded.tz
+'''
+SQL_SELECT_USER_TIMEZONE = 'SELECT tz FROM users WHERE user_id = ?'
+
+# Состояние диалога и последний поисковый запрос пользователя.
+# Состояние снимается условным UPDATE: его получит только одна из реплик
+SQL_UPSERT_USER_STATE = '''
+    INSERT INTO users (user_id, state) VALUES (?, ?)
+    ON CONFLICT (user_id) DO UPDATE SET state = excluded.state
+'''
+SQL_SELECT_USER_STATE = 'SELECT state FROM users WHERE user_id = ?'
+SQL_CLEAR_USER_STATE = 'UPDATE users SET state = NULL WHERE user_id = ? AND state = ? RETURNING user_id'
+SQL_UPSERT_USER_SEARCH = '''
+    INSERT INTO users (user_id, search_query) VALUES (?, ?)
+    ON CONFLICT (user_id) DO UPDATE SET search_query = excluded.search_query
+'''
+SQL_SELECT_USER_SEARCH = 'SELECT search_query FROM users WHERE user_id = ?'
+
+# Запуски задач планировщика: запуск выполняет реплика, первой вставившая строку
+SQL_DELETE_OLD_JOB_RUNS = 'DELETE FROM job_runs WHERE run_at < ?'
+SQL_CLAIM_JOB_RUN = '''
+    INSERT INTO job_runs (job, run_at) VALUES (?, ?)
+    ON CONFLICT (job, run_at) DO NOTHING
+    RETURNING job
+'''
+
+# Напоминания: кто еще не отметил начало дня и у кого день не закрыт.
+# Открытые дни ищутся по частичному индексу idx_work_days_open, без обхода всей work_days
+# Пользователи без своего пояса относятся к поясу по умолчанию (первый параметр)
+SQL_SELECT_USERS_WITHOUT_DAY = '''
+    SELECT user_id FROM users u
+    WHERE reminders = 1 AND COALESCE(u.tz, ?) = ?
+      AND NOT EXISTS (SELECT 1 FROM work_days w WHERE w.user_id = u.user_id AND w.day = ?)
+'''
+SQL_SELECT_OPEN_DAY_USERS = '''
+    SELECT w.user_id FROM work_days w
+    JOIN users u ON u.user_id = w.user_id
+    WHERE w.day = ? AND w.end_at IS NULL AND w.start_at IS NOT NULL AND u.reminders = 1
+      AND COALESCE(u.tz, ?) = ?
+'''
+SQL_SELECT_USER_ZONES = 'SELECT DISTINCT tz FROM users WHERE tz IS NOT NULL'
+# Автозакрытие: незакрытые смены, начатые раньше заданного момента, с поясом пользователя.
+# Закрывается только смена, которую за это время не закрыл сам пользователь
+SQL_SELECT_OPEN_DAYS = '''
+    SELECT w.user_id, w.day, w.start_at, w.break_min, w.break_at, u.tz, COALESCE(u.reminders, 1)
+    FROM work_days w
+    LEFT JOIN users u ON u.user_id = w.user_id
+    WHERE w.end_at IS NULL AND w.start_at IS NOT NULL AND w.start_at <= ?
+'''
+SQL_CLOSE_WORK_DAY = '''
+    UPDATE work_days SET end_at = ?, break_min = ?, break_at = NULL
+    WHERE user_id = ? AND day = ? AND end_at IS NULL
+    RETURNING user_id
+'''
+
+# ============================
+# МИГРАЦИИ СХЕМЫ
+# ============================
+
+@contextmanager
+def transaction(conn):
+    """Явная транзакция на соединении в режиме autocommit"""
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield conn
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    conn.execute('COMMIT')
+
+def set_schema_version(conn, version):
+    """Запись версии схемы (вызывается внутри транзакции миграции)"""
+    conn.execute(f'PRAGMA user_version = {int(version)}')
+
+def copy_in_batches(conn, select_sql, insert_sql, convert, last_key=0):
+    """Перенос строк короткими транзакциями, чтобы не держать блокировку записи.
+    Возвращает последний перенесенный ключ для последующей догрузки."""
+    while True:
+        with transaction(conn):
+            rows = conn.execute(select_sql, (last_key, MIGRATION_BATCH_SIZE)).fetchall()
+            if not rows:
+                return last_key
+            conn.executemany(insert_sql, [r for r in map(convert, rows) if r is not None])
+        last_key = rows[-1][0]
+
+def migrate_base_schema(conn, version):
+    """v1: исходные таблицы с датами и временем в виде строк"""
+    with transaction(conn):
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS work_days (
+                user_id INTEGER,
+                date TEXT,
+                start_time TEXT,
+                end_time TEXT,
+                PRIMARY KEY (user_id, date)
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS work_actions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                date TEXT,
+                action_description TEXT,
+                created_at TEXT
+            )
+        ''')
+        set_schema_version(conn, version)
+
+def migrate_actions_index(conn, version):
+    """v2: индекс для выборки действий пользователя за день"""
+    with transaction(conn):
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS idx_work_actions_user_date
+            ON work_actions (user_id, date, created_at)
+        ''')
+        set_schema_version(conn, version)
+
+def convert_work_day_row(row):
+    """Строка work_days v1 -> (user_id, day, start_min, end_min)"""
+    _, user_id, date_str, start_time, end_time = row
+    try:
+        return (user_id, date_to_day(date_str), time_to_minutes(start_time), time_to_minutes(end_time))
+    except (TypeError, ValueError):
+        logging.warning(f"⚠️ Пропущен рабочий день с некорректными данными: {row}")
+        return None
+
+def convert_work_action_row(row):
+    """Строка work_actions v1 -> (id, user_id, day, action_description, created_at)"""
+    action_id, user_id, date_str, action_description, created_at = row
+    try:
+        day = date_to_day(date_str)
+    except (TypeError, ValueError):
+        logging.warning(f"⚠️ Пропущено действие с некорректной датой: {row}")
+        return None
+    try:
+        created_ms = datetime_to_ms(datetime.fromisoformat(created_at))
+    except (TypeError, ValueError):
+        created_ms = None
+    return (action_id, user_id, day, action_description, created_ms)
+
+def migrate_integer_columns(conn, version):
+    """v3: даты и время в виде целых чисел.
+    Данные переносятся в новые таблицы пачками, затем в одной короткой
+    транзакции догружаются изменения, сделанные во время переноса, и таблицы
+    подменяются."""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS work_days_v3 (
+            user_id INTEGER NOT NULL,
+            day INTEGER NOT NULL,
+            start_min INTEGER,
+            end_min INTEGER,
+            PRIMARY KEY (user_id, day)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS work_actions_v3 (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            day INTEGER NOT NULL,
+            action_description TEXT,
+            created_at INTEGER
+        )
+    ''')
+    
+    select_days = '''
+        SELECT rowid, user_id, date, start_time, end_time FROM work_days
+        WHERE rowid > ? ORDER BY rowid LIMIT ?
+    '''
+    insert_days = 'INSERT OR REPLACE INTO work_days_v3 VALUES (?, ?, ?, ?)'
+    select_actions = '''
+        SELECT id, user_id, date, action_description, created_at FROM work_actions
+        WHERE id > ? ORDER BY id LIMIT ?
+    '''
+    insert_actions = 'INSERT OR REPLACE INTO work_actions_v3 VALUES (?, ?, ?, ?, ?)'
+    
+    last_day_rowid = copy_in_batches(conn, select_days, insert_days, convert_work_day_row)
+    last_action_id = copy_in_batches(conn, select_actions, insert_actions, convert_work_action_row)
+    
+    with transaction(conn):
+        # Догружаем строки, добавленные или перезаписанные во время переноса
+        for row in conn.execute(select_days, (last_day_rowid, -1)).fetchall():
+            converted = convert_work_day_row(row)
+            if converted:
+                conn.execute(insert_days, converted)
+        for row in conn.execute(select_actions, (last_action_id, -1)).fetchall():
+            converted = convert_work_action_row(row)
+            if converted:
+                conn.execute(insert_actions, converted)
+        
+        # Убираем строки, удаленные во время переноса
+        conn.execute('''
+            DELETE FROM work_days_v3 WHERE NOT EXISTS (
+                SELECT 1 FROM work_days o
+                WHERE o.user_id = work_days_v3.user_id
+                  AND o.date = date(work_days_v3.day * 86400, 'unixepoch')
+            )
+        ''')
+        conn.execute('DELETE FROM work_actions_v3 WHERE id NOT IN (SELECT id FROM work_actions)')
+        
+        conn.execute('DROP TABLE work_days')
+        conn.execute('DROP TABLE work_actions')
+        conn.execute('ALTER TABLE work_days_v3 RENAME TO work_days')
+        conn.execute('ALTER TABLE work_actions_v3 RENAME TO work_actions')
+        conn.execute('''
+            CREATE INDEX idx_work_actions_user_day
+            ON work_actions (user_id, day, created_at)
+        ''')
+        set_schema_version(conn, version)
+
+# Вклад рабочего дня в сводные таблицы (используется в триггерах, ROW — NEW или OLD)
+ROLLUP_MINUTES = 'CASE WHEN {row}.end_min > {row}.start_min THEN {row}.end_min - {row}.start_min ELSE 0 END'
+ROLLUP_LUNCH_MINUTES = ('CASE WHEN {row}.end_min - {row}.start_min > ' + str(LUNCH_MINUTES) +
+                        ' THEN {row}.end_min - {row}.start_min - ' + str(LUNCH_MINUTES) + ' ELSE 0 END')
+ROLLUP_DAYS = 'CASE WHEN {row}.start_min IS NOT NULL THEN 1 ELSE 0 END'
+ROLLUP_MONTH = "CAST(strftime('%Y%m', {row}.day * 86400, 'unixepoch') AS INTEGER)"
+
+# Вклад смены с v7: длительность по моментам начала и конца (смена может переходить
+# через полночь) за вычетом отмеченных перерывов, а без них — обеда
+ROLLUP_SHIFT_MINUTES = 'CASE WHEN {row}.end_at > {row}.start_at THEN ({row}.end_at - {row}.start_at) / 60 ELSE 0 END'
+ROLLUP_BREAK_MINUTES = 'COALESCE({row}.break_min, ' + str(LUNCH_MINUTES) + ')'
+ROLLUP_NET_MINUTES = ('CASE WHEN ' + ROLLUP_SHIFT_MINUTES + ' > ' + ROLLUP_BREAK_MINUTES +
+                      ' THEN ' + ROLLUP_SHIFT_MINUTES + ' - ' + ROLLUP_BREAK_MINUTES + ' ELSE 0 END')
+ROLLUP_SHIFT_DAYS = 'CASE WHEN {row}.start_at IS NOT NULL THEN 1 ELSE 0 END'
+
+# Выражения сводных итогов: до v7 (минуты от полуночи) и текущие
+ROLLUP_COLUMNS_V4 = {'minutes': ROLLUP_MINUTES, 'lunch': ROLLUP_LUNCH_MINUTES, 'days': ROLLUP_DAYS}
+ROLLUP_COLUMNS = {'minutes': ROLLUP_SHIFT_MINUTES, 'lunch': ROLLUP_NET_MINUTES, 'days': ROLLUP_SHIFT_DAYS}
+
+def rollup_add_sql(row, month=ROLLUP_MONTH, columns=ROLLUP_COLUMNS):
+    """Добавление вклада строки work_days в daily_totals и monthly_totals"""
+    values = {
+        'minutes': columns['minutes'].format(row=row),
+        'lunch': columns['lunch'].format(row=row),
+        'days': columns['days'].format(row=row),
+        'month': month.format(row=row),
+        'row': row
+    }
+    return '''
+        INSERT INTO daily_totals (user_id, day, minutes, lunch_minutes)
+        VALUES ({row}.user_id, {row}.day, {minutes}, {lunch})
+        ON CONFLICT (user_id, day) DO UPDATE SET
+            minutes = excluded.minutes, lunch_minutes = excluded.lunch_minutes;
+        INSERT INTO monthly_totals (user_id, month, days, minutes, lunch_minutes)
+        VALUES ({row}.user_id, {month}, {days}, {minutes}, {lunch})
+        ON CONFLICT (user_id, month) DO UPDATE SET
+            days = monthly_totals.days + excluded.days,
+            minutes = monthly_totals.minutes + excluded.minutes,
+            lunch_minutes = monthly_totals.lunch_minutes + excluded.lunch_minutes;
+    '''.format(**values)
+
+def rollup_remove_sql(row, month=ROLLUP_MONTH, columns=ROLLUP_COLUMNS):
+    """Вычитание вклада строки work_days из сводных таблиц"""
+    values = {
+        'minutes': columns['minutes'].format(row=row),
+        'lunch': columns['lunch'].format(row=row),
+        'days': columns['days'].format(row=row),
+        'month': month.format(row=row),
+        'row': row
+    }
+    return '''
+        DELETE FROM daily_totals WHERE user_id = {row}.user_id AND day = {row}.day;
+        UPDATE monthly_totals SET
+            days = days - {days},
+            minutes = minutes - {minutes},
+            lunch_minutes = lunch_minutes - {lunch}
+        WHERE user_id = {row}.user_id AND month = {month};
+        DELETE FROM monthly_totals
+        WHERE user_id = {row}.user_id AND month = {month} AND days = 0 AND minutes = 0;
+    '''.format(**values)
+
+def rollup_fill_sql(month=ROLLUP_MONTH, columns=ROLLUP_COLUMNS):
+    """Заполнение пустых сводных таблиц по всей истории work_days"""
+    values = {
+        'minutes': columns['minutes'].format(row='w'),
+        'lunch': columns['lunch'].format(row='w'),
+        'days': columns['days'].format(row='w'),
+        'month': month.format(row='w')
+    }
+    return [
+        '''
+            INSERT INTO daily_totals (user_id, day, minutes, lunch_minutes)
+            SELECT user_id, day, {minutes}, {lunch} FROM work_days w
+        '''.format(**values),
+        '''
+            INSERT INTO monthly_totals (user_id, month, days, minutes, lunch_minutes)
+            SELECT user_id, {month}, SUM({days}), SUM({minutes}), SUM({lunch})
+            FROM work_days w
+            GROUP BY 1, 2
+        '''.format(**values)
+    ]
+
+def migrate_totals_rollup(conn, version):
+    """v4: сводные таблицы минут по дням и месяцам, обновляемые триггерами"""
+    with transaction(conn):
+        conn.execute('''
+            CREATE TABLE daily_totals (
+                user_id INTEGER NOT NULL,
+                day INTEGER NOT NULL,
+                minutes INTEGER NOT NULL,
+                lunch_minutes INTEGER NOT NULL,
+                PRIMARY KEY (user_id, day)
+            ) WITHOUT ROWID
+        ''')
+        conn.execute('''
+            CREATE TABLE monthly_totals (
+                user_id INTEGER NOT NULL,
+                month INTEGER NOT NULL,
+                days INTEGER NOT NULL,
+                minutes INTEGER NOT NULL,
+                lunch_minutes INTEGER NOT NULL,
+                PRIMARY KEY (user_id, month)
+            ) WITHOUT ROWID
+        ''')
+        
+        conn.execute(f'''
+            CREATE TRIGGER work_days_totals_insert AFTER INSERT ON work_days BEGIN
+                {rollup_add_sql('NEW', columns=ROLLUP_COLUMNS_V4)}
+            END
+        ''')
+        conn.execute(f'''
+            CREATE TRIGGER work_days_totals_update AFTER UPDATE ON work_days BEGIN
+                {rollup_remove_sql('OLD', columns=ROLLUP_COLUMNS_V4)}
+                {rollup_add_sql('NEW', columns=ROLLUP_COLUMNS_V4)}
+            END
+        ''')
+        conn.execute(f'''
+            CREATE TRIGGER work_days_totals_delete AFTER DELETE ON work_days BEGIN
+                {rollup_remove_sql('OLD', columns=ROLLUP_COLUMNS_V4)}
+            END
+        ''')
+        
+        # Заполняем сводные таблицы по уже накопленной истории
+        conn.execute(f'''
+            INSERT INTO daily_totals (user_id, day, minutes, lunch_minutes)
+            SELECT user_id, day, {ROLLUP_MINUTES.format(row='w')}, {ROLLUP_LUNCH_MINUTES.format(row='w')}
+            FROM work_days w
+        ''')
+        conn.execute(f'''
+            INSERT INTO monthly_totals (user_id, month, days, minutes, lunch_minutes)
+            SELECT user_id, {ROLLUP_MONTH.format(row='w')},
+                   SUM({ROLLUP_DAYS.format(row='w')}),
+                   SUM({ROLLUP_MINUTES.format(row='w')}),
+                   SUM({ROLLUP_LUNCH_MINUTES.format(row='w')})
+            FROM work_days w
+            GROUP BY 1, 2
+        ''')
+        set_schema_version(conn, version)
+
+def migrate_users_and_open_days(conn, version):
+    """v5: таблица пользователей с настройкой напоминаний и частичный индекс незакрытых дней.
+    Напоминания включаются только недавно активным пользователям (REMINDER_ACTIVE_DAYS)"""
+    active_since = date_to_day(date.today().isoformat()) - REMINDER_ACTIVE_DAYS
+    with transaction(conn):
+        conn.execute('''
+            CREATE TABLE users (
+                user_id INTEGER PRIMARY KEY,
+                reminders INTEGER NOT NULL DEFAULT 1
+            )
+        ''')
+        conn.execute('''
+            INSERT INTO users (user_id, reminders)
+            SELECT user_id, MAX(day) >= ? FROM (
+                SELECT user_id, day FROM work_days UNION ALL SELECT user_id, day FROM work_actions
+            ) GROUP BY user_id
+        ''', (active_since,))
+        # В индекс попадают только дни без времени окончания, поэтому он остается маленьким
+        conn.execute('CREATE INDEX idx_work_days_open ON work_days (day) WHERE end_min IS NULL')
+        set_schema_version(conn, version)
+
+def migrate_actions_search(conn, version):
+    """v6: полнотекстовый индекс FTS5 по описаниям действий, синхронизируемый триггерами.
+    Колонка user_id индексируется как слово, чтобы отбирать действия пользователя
+    внутри FTS5, не ранжируя совпадения всей команды"""
+    with transaction(conn):
+        conn.execute('''
+            CREATE VIRTUAL TABLE work_actions_fts USING fts5(
+                user_id, action_description,
+                content='work_actions', content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2'
+            )
+        ''')
+        conn.execute('''
+            CREATE TRIGGER work_actions_fts_insert AFTER INSERT ON work_actions BEGIN
+                INSERT INTO work_actions_fts (rowid, user_id, action_description)
+                VALUES (NEW.id, NEW.user_id, NEW.action_description);
+            END
+        ''')
+        conn.execute('''
+            CREATE TRIGGER work_actions_fts_delete AFTER DELETE ON work_actions BEGIN
+                INSERT INTO work_actions_fts (work_actions_fts, rowid, user_id, action_description)
+                VALUES ('delete', OLD.id, OLD.user_id, OLD.action_description);
+            END
+        ''')
+        conn.execute('''
+            CREATE TRIGGER work_actions_fts_update AFTER UPDATE ON work_actions BEGIN
+                INSERT INTO work_actions_fts (work_actions_fts, rowid, user_id, action_description)
+                VALUES ('delete', OLD.id, OLD.user_id, OLD.action_description);
+                INSERT INTO work_actions_fts (rowid, user_id, action_description)
+                VALUES (NEW.id, NEW.user_id, NEW.action_description);
+            END
+        ''')
+        # Индексируем уже накопленные действия
+        conn.execute("INSERT INTO work_actions_fts (work_actions_fts) VALUES ('rebuild')")
+        set_schema_version(conn, version)
+
+def migrate_timestamps(conn, version):
+    """v7: начало и конец смены в секундах UTC, перерывы и часовой пояс пользователя.
+    Минуты от полуночи пересчитываются в поясе DEFAULT_TZ; смена, закончившаяся
+    раньше начала, считается закончившейся на следующий день вместо нуля часов"""
+    conn.create_function(
+        'local_to_ts', 2, lambda day, minutes: local_to_ts(day, minutes, DEFAULT_TZ), deterministic=True
+    )
+    with transaction(conn):
+        conn.execute('ALTER TABLE users ADD COLUMN tz TEXT')
+        for column in ('start_at', 'end_at', 'break_min', 'break_at'):
+            conn.execute(f'ALTER TABLE work_days ADD COLUMN {column} INTEGER')
+        
+        # Старые триггеры и индекс ссылаются на удаляемые колонки; итоги пересчитываются ниже
+        for trigger in ('insert', 'update', 'delete'):
+            conn.execute(f'DROP TRIGGER work_days_totals_{trigger}')
+        conn.execute('DROP INDEX idx_work_days_open')
+        conn.execute('''
+            UPDATE work_days SET
+                start_at = CASE WHEN start_min IS NOT NULL THEN local_to_ts(day, start_min) END,
+                end_at = CASE WHEN end_min IS NOT NULL THEN
+                    local_to_ts(CASE WHEN end_min < start_min THEN day + 1 ELSE day END, end_min) END
+        ''')
+        conn.execute('ALTER TABLE work_days DROP COLUMN start_min')
+        conn.execute('ALTER TABLE work_days DROP COLUMN end_min')
+        conn.execute('CREATE INDEX idx_work_days_open ON work_days (day) WHERE end_at IS NULL')
+        
+        conn.execute(f'''
+            CREATE TRIGGER work_days_totals_insert AFTER INSERT ON work_days BEGIN
+                {rollup_add_sql('NEW')}
+            END
+        ''')
+        conn.execute(f'''
+            CREATE TRIGGER work_days_totals_update AFTER UPDATE ON work_days BEGIN
+                {rollup_remove_sql('OLD')}
+                {rollup_add_sql('NEW')}
+            END
+        ''')
+        conn.execute(f'''
+            CREATE TRIGGER work_days_totals_delete AFTER DELETE ON work_days BEGIN
+                {rollup_remove_sql('OLD')}
+            END
+        ''')
+        conn.execute('DELETE FROM daily_totals')
+        conn.execute('DELETE FROM monthly_totals')
+        for sql in rollup_fill_sql():
+            conn.execute(sql)
+        set_schema_version(conn, version)
+
+def migrate_replica_state(conn, version):
+    """v8: состояние диалога и поисковый запрос в таблице users, журнал запусков
+    задач планировщика (для нескольких процессов на одной базе)"""
+    with transaction(conn):
+        conn.execute('ALTER TABLE users ADD COLUMN state TEXT')
+        conn.execute('ALTER TABLE users ADD COLUMN search_query TEXT')
+        conn.execute('''
+            CREATE TABLE job_runs (
+                job TEXT NOT NULL,
+                run_at INTEGER NOT NULL,
+                PRIMARY KEY (job, run_at)
+            ) WITHOUT ROWID
+        ''')
+        set_schema_version(conn, version)
+
+def migrate_search_terms(conn, version):
+    """v9: индекс FTS5 по основам слов (колонка search_terms, заполняется при записи)
+    с префиксными индексами; запрос и индекс используют один стеммер.
+    Колонка заполняется, а индекс строится пачками в коротких транзакциях (как перенос в v3);
+    после сбоя миграция продолжается с еще не заполненных строк"""
+    columns = {row[1] for row in conn.execute('PRAGMA table_info(work_actions)')}
+    with transaction(conn):
+        for name in ('insert', 'delete', 'update'):
+            conn.execute(f'DROP TRIGGER IF EXISTS work_actions_fts_{name}')
+        conn.execute('DROP TABLE IF EXISTS work_actions_fts')
+        if 'search_terms' not in columns:
+            conn.execute('ALTER TABLE work_actions ADD COLUMN search_terms TEXT')
+        conn.execute('''
+            CREATE VIRTUAL TABLE work_actions_fts USING fts5(
+                user_id, search_terms,
+                content='work_actions', content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2',
+                prefix='2 3 4'
+            )
+        ''')
+    
+    copy_in_batches(
+        conn,
+        'SELECT id, action_description FROM work_actions WHERE id > ? AND search_terms IS NULL ORDER BY id LIMIT ?',
+        'UPDATE work_actions SET search_terms = ? WHERE id = ?',
+        lambda row: (search_terms(row[1]), row[0])
+    )
+    select_indexed = 'SELECT id, user_id, search_terms FROM work_actions WHERE id > ? ORDER BY id LIMIT ?'
+    insert_indexed = 'INSERT INTO work_actions_fts (rowid, user_id, search_terms) VALUES (?, ?, ?)'
+    last_id = copy_in_batches(conn, select_indexed, insert_indexed, tuple)
+    
+    with transaction(conn):
+        # Догружаем действия, добавленные во время построения индекса
+        conn.executemany(insert_indexed, conn.execute(select_indexed, (last_id, -1)).fetchall())
+        conn.execute('''
+            CREATE TRIGGER work_actions_fts_insert AFTER INSERT ON work_actions BEGIN
+                INSERT INTO work_actions_fts (rowid, user_id, search_terms)
+                VALUES (NEW.id, NEW.user_id, NEW.search_terms);
+            END
+        ''')
+        conn.execute('''
+            CREATE TRIGGER work_actions_fts_delete AFTER DELETE ON work_actions BEGIN
+                INSERT INTO work_actions_fts (work_actions_fts, rowid, user_id, search_terms)
+                VALUES ('delete', OLD.id, OLD.user_id, OLD.search_terms);
+            END
+        ''')
+        conn.execute('''
+            CREATE TRIGGER work_actions_fts_update AFTER UPDATE ON work_actions BEGIN
+                INSERT INTO work_actions_fts (work_actions_fts, rowid, user_id, search_terms)
+                VALUES ('delete', OLD.id, OLD.user_id, OLD.search_terms);
+                INSERT INTO work_actions_fts (rowid, user_id, search_terms)
+                VALUES (NEW.id, NEW.user_id, NEW.search_terms);
+            END
+        ''')
+        set_schema_version(conn, version)
+
+# Миграции применяются по порядку, номер версии хранится в PRAGMA user_version
+MIGRATIONS = [
+    (1, migrate_base_schema),
+    (2, migrate_actions_index),
+    (3, migrate_integer_columns),
+    (4, migrate_totals_rollup),
+    (5, migrate_users_and_open_days),
+    (6, migrate_actions_search),
+    (7, migrate_timestamps),
+    (8, migrate_replica_state),
+    (9, migrate_search_terms),
+]
+
+# ============================
+# ХРАНИЛИЩЕ
+# ============================
+
+class SQLiteStorage:
+    """Хранилище в локальном файле SQLite: по одному долгоживущему соединению
+    на поток, схема ведется миграциями MIGRATIONS"""
+    
+    Error = sqlite3.Error
+    # База принадлежит одному процессу: кэш в памяти не расходится с ней
+    shared = False
+    
+    def __init__(self, path: str):
+        self.path = path
+        self.description = path
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+    
+    def _connect(self):
+        """Открытие нового соединения с настройками производительности"""
+        conn = sqlite3.connect(
+            self.path,
+            timeout=SQLITE_BUSY_TIMEOUT,
+            check_same_thread=False,
+            cached_statements=SQLITE_CACHED_STATEMENTS
+        )
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}')
+        conn.execute(f'PRAGMA mmap_size={SQLITE_MMAP_SIZE}')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        return conn
+    
+    @property
+    def conn(self):
+        """Соединение текущего потока (открывается один раз)"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+    
+    def migrate(self):
+        """Применение миграций схемы"""
+        # Миграции управляют транзакциями сами, поэтому отдельное соединение в режиме autocommit
+        conn = self._connect()
+        conn.isolation_level = None
+        try:
+            current = conn.execute('PRAGMA user_version').fetchone()[0]
+            for version, migrate in MIGRATIONS:
+                if version > current:
+                    print(f"🔄 Миграция базы данных до версии {version}: {migrate.__doc__.splitlines()[0]}")
+                    migrate(conn, version)
+        finally:
+            conn.close()
+    
+    def fetchone(self, sql: str, params=()):
+        """Первая строка результата запроса или None"""
+        return self.conn.execute(sql, params).fetchone()
+    
+    def fetchall(self, sql: str, params=()):
+        """Все строки результата запроса"""
+        return self.conn.execute(sql, params).fetchall()
+    
+    def write(self, operations):
+        """Изменения одной транзакцией: список пар (sql, параметры).
+        Возвращает строки последнего запроса (для RETURNING)"""
+        with self.conn as conn:
+            cursor = None
+            for sql, params in operations:
+                cursor = conn.execute(sql, params)
+            return cursor.fetchall() if cursor is not None and cursor.description else []
+    
+    def write_many(self, groups):
+        """Пачка изменений одной транзакцией: список пар (sql, список параметров)"""
+        with self.conn as conn:
+            for sql, rows in groups:
+                conn.executemany(sql, rows)
+    
+    def iter_rows(self, sql: str, params, batch_size: int):
+        """Потоковое чтение на отдельном соединении: незавершенный курсор
+        не держит открытой читающую транзакцию в общем соединении потока"""
+        conn = self._connect()
+        try:
+            cursor = conn.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            conn.close()
+    
+    search_sql = SQL_SEARCH_ACTIONS
+    
+    def search_params(self, user_id: int, words, limit: int, offset: int):
+        """Параметры поиска: запрос FTS5 по основам слов с совпадением по префиксу"""
+        terms = ' '.join(f'"{stem_word(word)}"*' for word in words)
+        return (f'user_id : "{user_id}" AND ({terms})', limit, offset)
+    
+    def connection_count(self):
+        """Число открытых соединений"""
+        with self._lock:
+            return len(self._connections)
+    
+    def close(self):
+        """Перенос WAL в основной файл и закрытие всех открытых соединений"""
+        try:
+            with self.conn as conn:
+                conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        except sqlite3.Error as e:
+            logging.error(f"❌ Ошибка при переносе WAL: {e}")
+        
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            try:
+                conn.close()
+            except sqlite3.Error as e:
+                logging.error(f"❌ Ошибка при закрытии соединения: {e}")
+        self._local = threading.local()
+
+# Месяц YYYYMM по номеру дня в триггерах PostgreSQL
+PG_ROLLUP_MONTH = "CAST(to_char(DATE '1970-01-01' + {row}.day, 'YYYYMM') AS INTEGER)"
+
+# Ключ advisory-блокировки: реплики не применяют миграции одновременно
+PG_MIGRATION_LOCK = 20240601
+
+def pg_rollup_function_sql(columns=ROLLUP_COLUMNS):
+    """Функция триггера сводных итогов для PostgreSQL"""
+    return f'''
+        CREATE OR REPLACE FUNCTION work_days_totals() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                {rollup_remove_sql('OLD', PG_ROLLUP_MONTH, columns)}
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                {rollup_add_sql('NEW', PG_ROLLUP_MONTH, columns)}
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+    '''
+
+def pg_migrate_base_schema(conn):
+    """v1: таблицы, индексы и триггеры сводных итогов (как SQLite v5)"""
+    conn.execute('''
+        CREATE TABLE work_days (
+            user_id BIGINT NOT NULL,
+            day INTEGER NOT NULL,
+            start_min INTEGER,
+            end_min INTEGER,
+            PRIMARY KEY (user_id, day)
+        )
+    ''', prepare=False)
+    conn.execute('''
+        CREATE TABLE work_actions (
+            id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            day INTEGER NOT NULL,
+            action_description TEXT,
+            created_at BIGINT
+        )
+    ''', prepare=False)
+    conn.execute('''
+        CREATE INDEX idx_work_actions_user_day ON work_actions (user_id, day, created_at)
+    ''', prepare=False)
+    conn.execute('''
+        CREATE TABLE daily_totals (
+            user_id BIGINT NOT NULL,
+            day INTEGER NOT NULL,
+            minutes INTEGER NOT NULL,
+            lunch_minutes INTEGER NOT NULL,
+            PRIMARY KEY (user_id, day)
+        )
+    ''', prepare=False)
+    conn.execute('''
+        CREATE TABLE monthly_totals (
+            user_id BIGINT NOT NULL,
+            month INTEGER NOT NULL,
+            days INTEGER NOT NULL,
+            minutes INTEGER NOT NULL,
+            lunch_minutes INTEGER NOT NULL,
+            PRIMARY KEY (user_id, month)
+        )
+    ''', prepare=False)
+    conn.execute('''
+        CREATE TABLE users (
+            user_id BIGINT PRIMARY KEY,
+            reminders INTEGER NOT NULL DEFAULT 1
+        )
+    ''', prepare=False)
+    conn.execute('CREATE INDEX idx_work_days_open ON work_days (day) WHERE end_min IS NULL', prepare=False)
+    
+    conn.execute(pg_rollup_function_sql(ROLLUP_COLUMNS_V4), prepare=False)
+    conn.execute('''
+        CREATE TRIGGER work_days_totals AFTER INSERT OR UPDATE OR DELETE ON work_days
+        FOR EACH ROW EXECUTE FUNCTION work_days_totals()
+    ''', prepare=False)
+
+def pg_migrate_actions_search(conn):
+    """v2: полнотекстовый поиск по описаниям действий (конфигурация russian, индекс GIN)"""
+    conn.execute('''
+        ALTER TABLE work_actions ADD COLUMN search_tsv tsvector
+        GENERATED ALWAYS AS (to_tsvector('russian', coalesce(action_description, ''))) STORED
+    ''', prepare=False)
+    conn.execute('CREATE INDEX idx_work_actions_search ON work_actions USING GIN (search_tsv)', prepare=False)
+
+def pg_migrate_timestamps(conn):
+    """v3: начало и конец смены в секундах UTC, перерывы и часовой пояс пользователя (как SQLite v7)"""
+    conn.execute('ALTER TABLE users ADD COLUMN tz TEXT', prepare=False)
+    conn.execute('''
+        ALTER TABLE work_days
+            ADD COLUMN start_at BIGINT, ADD COLUMN end_at BIGINT,
+            ADD COLUMN break_min INTEGER, ADD COLUMN break_at BIGINT
+    ''', prepare=False)
+    
+    # Итоги пересчитываются целиком после переноса, поэтому триггер на это время снимается
+    conn.execute('DROP TRIGGER work_days_totals ON work_days', prepare=False)
+    conn.execute('DROP INDEX idx_work_days_open', prepare=False)
+    conn.execute('''
+        UPDATE work_days SET
+            start_at = EXTRACT(EPOCH FROM (
+                DATE '1970-01-01' + day + make_interval(mins => start_min)
+            ) AT TIME ZONE %(tz)s)::BIGINT,
+            end_at = EXTRACT(EPOCH FROM (
+                DATE '1970-01-01' + day + CASE WHEN end_min < start_min THEN 1 ELSE 0 END
+                + make_interval(mins => end_min)
+            ) AT TIME ZONE %(tz)s)::BIGINT
+    ''', {'tz': DEFAULT_TZ}, prepare=False)
+    conn.execute('ALTER TABLE work_days DROP COLUMN start_min, DROP COLUMN end_min', prepare=False)
+    conn.execute('CREATE INDEX idx_work_days_open ON work_days (day) WHERE end_at IS NULL', prepare=False)
+    
+    conn.execute(pg_rollup_function_sql(), prepare=False)
+    conn.execute('''
+        CREATE TRIGGER work_days_totals AFTER INSERT OR UPDATE OR DELETE ON work_days
+        FOR EACH ROW EXECUTE FUNCTION work_days_totals()
+    ''', prepare=False)
+    conn.execute('DELETE FROM daily_totals', prepare=False)
+    conn.execute('DELETE FROM monthly_totals', prepare=False)
+    for sql in rollup_fill_sql(PG_ROLLUP_MONTH):
+        conn.execute(sql, prepare=False)
+
+def pg_migrate_replica_state(conn):
+    """v4: состояние диалога, поисковый запрос и журнал запусков задач (как SQLite v8)"""
+    conn.execute('ALTER TABLE users ADD COLUMN state TEXT, ADD COLUMN search_query TEXT', prepare=False)
+    conn.execute('''
+        CREATE TABLE job_runs (
+            job TEXT NOT NULL,
+            run_at BIGINT NOT NULL,
+            PRIMARY KEY (job, run_at)
+        )
+    ''', prepare=False)
+
+def pg_migrate_search_terms(conn):
+    """v5: поиск по основам слов из search_terms вместо стемминга russian (как SQLite v9)"""
+    conn.execute('ALTER TABLE work_actions ADD COLUMN search_terms TEXT', prepare=False)
+    with conn.cursor(name='search_terms') as rows, conn.cursor() as update:
+        rows.execute('SELECT id, action_description FROM work_actions')
+        while batch := rows.fetchmany(MIGRATION_BATCH_SIZE):
+            update.executemany(
+                'UPDATE work_actions SET search_terms = %s WHERE id = %s',
+                [(search_terms(action), action_id) for action_id, action in batch]
+            )
+    conn.execute('ALTER TABLE work_actions DROP COLUMN search_tsv', prepare=False)
+    conn.execute('''
+        ALTER TABLE work_actions ADD COLUMN search_tsv tsvector
+        GENERATED ALWAYS AS (to_tsvector('simple', coalesce(search_terms, ''))) STORED
+    ''', prepare=False)
+    conn.execute('CREATE INDEX idx_work_actions_search ON work_actions USING GIN (search_tsv)', prepare=False)
+
+# Миграции PostgreSQL, номер версии хранится в таблице schema_version
+PG_MIGRATIONS = [
+    (1, pg_migrate_base_schema),
+    (2, pg_migrate_actions_search),
+    (3, pg_migrate_timestamps),
+    (4, pg_migrate_replica_state),
+    (5, pg_migrate_search_terms),
+]
+
+@functools.lru_cache(maxsize=None)
+def pg_sql(sql: str):
+    """Текст запроса SQLite -> PostgreSQL (параметры ? -> %s)"""
+    return sql.replace('?', '%s')
+
+class PostgresStorage:
+    """Хранилище в PostgreSQL для нескольких реплик бота. Соединения берутся
+    из пула psycopg_pool; запросы готовятся на сервере после prepare_threshold
+    выполнений и дальше переиспользуются соединением пула"""
+    
+    # Базу меняют несколько реплик: данные в памяти процесса могут устареть
+    shared = True
+    
+    def __init__(self, url: str, min_size: int, max_size: int, prepare_threshold: int):
+        try:
+            import psycopg
+            from psycopg.conninfo import conninfo_to_dict
+            from psycopg_pool import ConnectionPool
+        except ImportError:
+            raise RuntimeError("Для работы с PostgreSQL установите psycopg[binary,pool]")
+        
+        self.Error = psycopg.Error
+        info = conninfo_to_dict(url)
+        self.description = f"PostgreSQL {info.get('host', 'localhost')}/{info.get('dbname', '')}"
+        self.pool = ConnectionPool(
+            url,
+            min_size=min_size,
+            max_size=max_size,
+            kwargs={
+                'autocommit': True,
+                'prepare_threshold': None if prepare_threshold < 0 else prepare_threshold
+            },
+            name='bot-db',
+            open=False
+        )
+    
+    def migrate(self):
+        """Открытие пула и применение миграций схемы одной транзакцией под advisory-блокировкой"""
+        self.pool.open(wait=True)
+        with self.pool.connection() as conn, conn.transaction():
+            conn.execute('SELECT pg_advisory_xact_lock(%s)', (PG_MIGRATION_LOCK,), prepare=False)
+            conn.execute('CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)', prepare=False)
+            current = conn.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version', prepare=False).fetchone()[0]
+            for version, migrate in PG_MIGRATIONS:
+                if version > current:
+                    print(f"🔄 Миграция базы данных до версии {version}: {migrate.__doc__.splitlines()[0]}")
+                    migrate(conn)
+                    conn.execute('INSERT INTO schema_version VALUES (%s)', (version,), prepare=False)
+    
+    def fetchone(self, sql: str, params=()):
+        """Первая строка результата запроса или None"""
+        with self.pool.connection() as conn:
+            return conn.execute(pg_sql(sql), params).fetchone()
+    
+    def fetchall(self, sql: str, params=()):
+        """Все строки результата запроса"""
+        with self.pool.connection() as conn:
+            return conn.execute(pg_sql(sql), params).fetchall()
+    
+    def write(self, operations):
+        """Изменения одной транзакцией: список пар (sql, параметры).
+        Возвращает строки последнего запроса (для RETURNING)"""
+        with self.pool.connection() as conn, conn.transaction():
+            cursor = None
+            for sql, params in operations:
+                cursor = conn.execute(pg_sql(sql), params)
+            return cursor.fetchall() if cursor is not None and cursor.description else []
+    
+    def write_many(self, groups):
+        """Пачка изменений одной транзакцией: список пар (sql, список параметров)"""
+        with self.pool.connection() as conn, conn.transaction(), conn.cursor() as cursor:
+            for sql, rows in groups:
+                cursor.executemany(pg_sql(sql), rows)
+    
+    def iter_rows(self, sql: str, params, batch_size: int):
+        """Потоковое чтение через курсор на стороне сервера"""
+        with self.pool.connection() as conn, conn.transaction():
+            with conn.cursor(name='iter_rows') as cursor:
+                cursor.execute(pg_sql(sql), params)
+                while True:
+                    rows = cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    yield from rows
+    
+    search_sql = PG_SQL_SEARCH_ACTIONS
+    
+    def search_params(self, user_id: int, words, limit: int, offset: int):
+        """Параметры поиска: запрос по основам слов с совпадением по префиксу"""
+        query = ' & '.join(f'{stem_word(word)}:*' for word in words)
+        return (user_id, query, query, limit, offset)
+    
+    def connection_count(self):
+        """Число открытых соединений пула"""
+        return self.pool.get_stats().get('pool_size', 0)
+    
+    def close(self):
+        """Закрытие пула соединений"""
+        self.pool.close()
+
+def open_storage():
+    """Хранилище по настройкам окружения: PostgreSQL, если задан DATABASE_URL, иначе SQLite"""
+    if DATABASE_URL:
+        return PostgresStorage(DATABASE_URL, PG_POOL_MIN, PG_POOL_MAX, PG_PREPARE_THRESHOLD)
+    return SQLiteStorage(DB_PATH)
+
+# ============================
+# КЭШ ТЕКУЩЕГО ДНЯ
+# ============================
+
+# Признак того, что значение в кэше еще не загружено
+MISSING = object()
+
+class TodayCache:
+    """LRU-кэш с TTL для рабочего дня и списка действий за сегодня.
+    Ключ — (user_id, date); «сегодня» у пользователей в разных поясах отличается,
+    поэтому кэшируются даты от вчера до завтра по часам сервера.
+    При смене даты кэш очищается целиком."""
+    
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        # Ключ -> {'generation', 'expires_at', 'work_day', 'tasks'}
+        self._entries = OrderedDict()
+        self._day = None
+        self._days = ()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def _rollover(self):
+        """Сброс кэша после полуночи"""
+        today = date.today()
+        if today != self._day:
+            self.evictions += len(self._entries)
+            self._entries.clear()
+            self._day = today
+            self._days = {(today + timedelta(days=d)).isoformat() for d in (-1, 0, 1)}
+    
+    def _entry(self, key, create: bool):
+        """Поиск записи с учетом даты и TTL (под блокировкой)"""
+        self._rollover()
+        if key[1] not in self._days:
+            return None
+        entry = self._entries.get(key)
+        now = time.monotonic()
+        if entry and entry['expires_at'] < now:
+            del self._entries[key]
+            self.evictions += 1
+            entry = None
+        if entry is None and create:
+            entry = {'generation': 0, 'work_day': MISSING, 'tasks': MISSING}
+            self._entries[key] = entry
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        if entry:
+            entry['expires_at'] = now + self.ttl
+            self._entries.move_to_end(key)
+        return entry
+    
+    def get(self, user_id: int, work_date: str, field: str):
+        """Значение из кэша или MISSING"""
+        with self._lock:
+            self._rollover()
+            if work_date not in self._days:
+                # Прошлые дни не кэшируются и не портят статистику
+                return MISSING
+            entry = self._entry((user_id, work_date), create=False)
+            value = entry[field] if entry else MISSING
+            if value is MISSING:
+                self.misses += 1
+                return MISSING
+            self.hits += 1
+            return copy.copy(value)
+    
+    def begin_load(self, user_id: int, work_date: str):
+        """Метка перед чтением из базы: значение сохранится, только если
+        за время чтения не было записи по этому ключу"""
+        with self._lock:
+            entry = self._entry((user_id, work_date), create=True)
+            return entry['generation'] if entry else None
+    
+    def store(self, user_id: int, work_date: str, field: str, value, generation):
+        """Сохранение прочитанного из базы значения"""
+        with self._lock:
+            entry = self._entry((user_id, work_date), create=False)
+            if entry and generation is not None and entry['generation'] == generation:
+                entry[field] = copy.copy(value)
+    
+    def update(self, user_id: int, work_date: str, field: str, change):
+        """Сквозная запись: change(старое значение или MISSING) -> новое значение"""
+        with self._lock:
+            entry = self._entry((user_id, work_date), create=True)
+            if entry:
+                entry['generation'] += 1
+                entry[field] = change(entry[field])
+    
+    def invalidate_users(self, user_ids):
+        """Сброс закэшированных значений пользователей (например, если их изменения
+        не удалось записать): следующее чтение пойдет в базу"""
+        with self._lock:
+            for key, entry in self._entries.items():
+                if key[0] in user_ids:
+                    entry['generation'] += 1
+                    entry['work_day'] = entry['tasks'] = MISSING
+    
+    def stats(self):
+        """Счетчики для подбора размера кэша"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / total if total else 0.0
+            }
+
+# ============================
+# ОТЛОЖЕННАЯ ЗАПИСЬ
+# ============================
+
+# Сколько раз повторять запись пачки при ошибке базы
+WRITE_BEHIND_RETRIES = 3
+
+class WriteBehindQueue:
+    """Очередь отложенной записи: обработчики только добавляют изменения,
+    а отдельный поток сбрасывает их одной транзакцией раз в N мс или по M строк"""
+    
+    def __init__(self, storage, flush_interval_ms: int, flush_max_rows: int, on_lost=None):
+        self.storage = storage
+        # Вызывается с множеством пользователей, чьи изменения потеряны,
+        # до того как ожидающие чтения будут отпущены
+        self.on_lost = on_lost
+        self.flush_interval = flush_interval_ms / 1000
+        self.flush_max_rows = flush_max_rows
+        self._pending = []
+        # Количество незаписанных изменений по пользователям (включая пачку в работе)
+        self._unwritten = {}
+        self._urgent = False
+        self._stopped = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+        self._thread.start()
+    
+    def put(self, user_id: int, operations):
+        """Добавление изменений пользователя: список пар (sql, параметры)"""
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError("Очередь записи уже остановлена")
+            self._pending.append((user_id, operations))
+            self._unwritten[user_id] = self._unwritten.get(user_id, 0) + 1
+            # Первое изменение будит поток записи: с него отсчитывается интервал сброса
+            if len(self._pending) == 1 or len(self._pending) >= self.flush_max_rows:
+                self._cond.notify_all()
+    
+    def wait_for_user(self, user_id: int):
+        """Ожидание записи всех изменений пользователя (read-your-writes)"""
+        with self._cond:
+            if not self._unwritten.get(user_id):
+                return
+            self._urgent = True
+            self._cond.notify_all()
+            while self._unwritten.get(user_id):
+                self._cond.wait()
+    
+    def flush(self):
+        """Ожидание записи всех накопленных изменений"""
+        with self._cond:
+            self._urgent = True
+            self._cond.notify_all()
+            while self._unwritten:
+                self._cond.wait()
+    
+    def pending_count(self):
+        """Количество изменений, ожидающих записи"""
+        with self._cond:
+            return sum(self._unwritten.values())
+    
+    def close(self):
+        """Сброс оставшихся изменений и остановка потока записи"""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        self._thread.join()
+    
+    def _next_batch(self):
+        """Ожидание пачки: до таймаута, заполнения или срочного запроса"""
+        with self._cond:
+            while not self._pending and not self._stopped:
+                self._cond.wait()
+            deadline = time.monotonic() + self.flush_interval
+            while (len(self._pending) < self.flush_max_rows
+                   and not self._urgent and not self._stopped):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            batch, self._pending = self._pending, []
+            self._urgent = False
+            return batch
+    
+    def _run(self):
+        """Цикл потока записи"""
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                return
+            try:
+                if not self._write(batch) and self.on_lost:
+                    self.on_lost({user_id for user_id, _ in batch})
+            except Exception as e:
+                logging.error(f"❌ Ошибка потока отложенной записи: {e}")
+            finally:
+                # Ожидающие чтения отпускаются при любом исходе, иначе они зависнут навсегда
+                with self._cond:
+                    for user_id, _ in batch:
+                        left = self._unwritten[user_id] - 1
+                        if left:
+                            self._unwritten[user_id] = left
+                        else:
+                            del self._unwritten[user_id]
+                    self._cond.notify_all()
+    
+    def _write(self, batch):
+        """Запись пачки одной транзакцией; подряд идущие одинаковые запросы идут через executemany.
+        Возвращает False, если пачку не удалось записать"""
+        groups = []
+        for _, operations in batch:
+            for sql, params in operations:
+                if groups and groups[-1][0] == sql:
+                    groups[-1][1].append(params)
+                else:
+                    groups.append((sql, [params]))
+        
+        for attempt in range(1, WRITE_BEHIND_RETRIES + 1):
+            try:
+                self.storage.write_many(groups)
+                return True
+            except self.storage.Error as e:
+                logging.error(f"❌ Ошибка отложенной записи (попытка {attempt}): {e}")
+                time.sleep(self.flush_interval * attempt)
+            except Exception as e:
+                # Ошибка не базы (например, число вне диапазона) при повторе не исчезнет
+                logging.error(f"❌ Ошибка отложенной записи: {e}")
+                break
+        logging.error(f"❌ Потеряно изменений при отложенной записи: {len(batch)}")
+        metrics.inc('bot_db_write_lost_total', len(batch))
+        return False
+
+def make_work_day(user_id: int, work_date: str, start_at, end_at, break_min, break_at):
+    """Рабочий день в виде словаря (как его возвращает get_work_day)"""
+    return {
+        'user_id': user_id,
+        'date': work_date,
+        'start_at': start_at,
+        'end_at': end_at,
+        'break_min': break_min,
+        'break_at': break_at
+    }
+
+class Database:
+    """Доступ к данным бота поверх хранилища (SQLite или PostgreSQL):
+    кэш текущего дня, отложенная запись и замеры времени запросов"""
+    
+    def __init__(self, storage, write_behind: bool = DB_WRITE_BEHIND):
+        # Схема проверяется не здесь, а в migrate(): импорт модуля не обращается к базе
+        self.storage = storage
+        
+        # Очередь отложенной записи (включается через DB_WRITE_BEHIND)
+        self.writer = None
+        if write_behind:
+            self.writer = WriteBehindQueue(storage, DB_FLUSH_INTERVAL_MS, DB_FLUSH_MAX_ROWS,
+                                           on_lost=self._drop_cached)
+            print(f"✅ Отложенная запись включена: {DB_FLUSH_INTERVAL_MS} мс / {DB_FLUSH_MAX_ROWS} строк")
+        
+        # Кэш текущего дня (отключается через TODAY_CACHE_SIZE=0). На общей базе реплик
+        # он не включается: день, измененный другой репликой, остался бы в кэше старым
+        self.cache = None
+        if TODAY_CACHE_SIZE > 0 and storage.shared:
+            print("ℹ️ Кэш текущего дня выключен: база общая для нескольких реплик")
+        elif TODAY_CACHE_SIZE > 0:
+            self.cache = TodayCache(TODAY_CACHE_SIZE, TODAY_CACHE_TTL)
+    
+    def migrate(self):
+        """Проверка схемы и применение миграций; True, если база готова к работе"""
+        print(f"🔄 Инициализация базы данных: {self.storage.description}")
+        try:
+            self.storage.migrate()
+            print(f"✅ База данных {self.storage.description} создана/подключена")
+            return True
+        except Exception as e:
+            print(f"❌ Ошибка при создании базы данных: {e}")
+            return False
+    
+    def connection_count(self):
+        """Число открытых соединений с базой"""
+        return self.storage.connection_count()
+    
+    def close(self):
+        """Сброс отложенной записи и закрытие хранилища"""
+        if self.cache:
+            logging.info(f"📊 Статистика кэша текущего дня: {self.cache.stats()}")
+        
+        if self.writer:
+            self.writer.close()
+            self.writer = None
+        self.storage.close()
+    
+    def _write(self, user_id: int, operations):
+        """Выполнение изменений сразу или через очередь отложенной записи"""
+        if self.writer:
+            self.writer.put(user_id, operations)
+            return
+        self.storage.write(operations)
+    
+    def _sync_user(self, user_id: int):
+        """Гарантия, что чтение увидит все изменения пользователя"""
+        if self.writer:
+            self.writer.wait_for_user(user_id)
+    
+    def _sync_all(self):
+        """Гарантия, что чтение увидит изменения всех пользователей"""
+        if self.writer:
+            self.writer.flush()
+    
+    def _drop_cached(self, user_ids):
+        """Сквозная запись уже попала в кэш, а в базу нет: кэш этих пользователей сбрасывается"""
+        if self.cache:
+            self.cache.invalidate_users(user_ids)
+    
+    def _cache_update(self, user_id: int, work_date: str, field: str, change):
+        """Сквозное обновление кэша после записи"""
+        if self.cache:
+            self.cache.update(user_id, work_date, field, change)
+    
+    @db_timed
+    def add_work_day(self, user_id: int, work_date: str, start_at: int, end_at: int = None,
+                     break_min: int = None, break_at: int = None):
+        """Добавление/обновление рабочего дня: моменты в секундах UTC,
+        минуты перерывов и начало незакрытого перерыва"""
+        self._write(user_id, [(SQL_UPSERT_WORK_DAY, (
+            user_id, date_to_day(work_date), start_at, end_at, break_min, break_at
+        ))])
+        work_day = make_work_day(user_id, work_date, start_at, end_at, break_min, break_at)
+        self._cache_update(user_id, work_date, 'work_day', lambda _: work_day)
+    
+    @db_timed
+    def add_work_task(self, user_id: int, work_date: str, action_description: str):
+        """Добавление выполненного действия"""
+        self._write(user_id, [(SQL_INSERT_WORK_TASK, (
+            user_id, date_to_day(work_date), action_description,
+            search_terms(action_description), datetime_to_ms(datetime.now())
+        ))])
+        self._cache_update(
+            user_id, work_date, 'tasks',
+            lambda tasks: MISSING if tasks is MISSING else tasks + [action_description]
+        )
+    
+    @db_timed
+    def reset_day(self, user_id: int, work_date: str):
+        """Удаление рабочего дня и действий за дату"""
+        day = date_to_day(work_date)
+        self._write(user_id, [
+            (SQL_DELETE_WORK_DAY, (user_id, day)),
+            (SQL_DELETE_WORK_TASKS, (user_id, day))
+        ])
+        self._cache_update(user_id, work_date, 'work_day', lambda _: None)
+        self._cache_update(user_id, work_date, 'tasks', lambda _: [])
+    
+    @db_timed
+    def register_user(self, user_id: int):
+        """Добавление пользователя в список получателей напоминаний (если его там нет)"""
+        self._write(user_id, [(SQL_INSERT_USER, (user_id,))])
+    
+    @db_timed
+    def set_reminders(self, user_id: int, enabled: bool):
+        """Включение/выключение напоминаний пользователя"""
+        self._write(user_id, [(SQL_UPSERT_USER_REMINDERS, (user_id, int(enabled)))])
+    
+    @db_timed
+    def set_timezone(self, user_id: int, tz: str):
+        """Сохранение часового пояса пользователя"""
+        self._write(user_id, [(SQL_UPSERT_USER_TIMEZONE, (user_id, tz))])
+    
+    @db_timed
+    def get_timezone(self, user_id: int):
+        """Часовой пояс пользователя (None, если не выбран)"""
+        self._sync_user(user_id)
+        row = self.storage.fetchone(SQL_SELECT_USER_TIMEZONE, (user_id,))
+        return row[0] if row else None
+    
+    @db_timed
+    def set_state(self, user_id: int, state: str):
+        """Сохранение состояния диалога (сразу, минуя отложенную запись:
+        следующее сообщение может прийти на другую реплику)"""
+        self.storage.write([(SQL_UPSERT_USER_STATE, (user_id, None if state == STATE_IDLE else state))])
+    
+    @db_timed
+    def pop_state(self, user_id: int):
+        """Состояние диалога со сбросом в STATE_IDLE"""
+        row = self.storage.fetchone(SQL_SELECT_USER_STATE, (user_id,))
+        if not row or row[0] is None:
+            return STATE_IDLE
+        # Сообщение, пришедшее одновременно на другую реплику, состояние уже не получит
+        if not self.storage.write([(SQL_CLEAR_USER_STATE, (user_id, row[0]))]):
+            return STATE_IDLE
+        return row[0]
+    
+    @db_timed
+    def set_search_query(self, user_id: int, query: str):
+        """Сохранение последнего поискового запроса (для перелистывания страниц)"""
+        self.storage.write([(SQL_UPSERT_USER_SEARCH, (user_id, query))])
+    
+    @db_timed
+    def get_search_query(self, user_id: int):
+        """Последний поисковый запрос пользователя или None"""
+        row = self.storage.fetchone(SQL_SELECT_USER_SEARCH, (user_id,))
+        return row[0] if row else None
+    
+    @db_timed
+    def claim_job_run(self, job: str, run_at: int, keep: float):
+        """Отметка запуска задачи планировщика; True — запуск достался этому процессу.
+        Записи старше keep секунд удаляются"""
+        return bool(self.storage.write([
+            (SQL_DELETE_OLD_JOB_RUNS, (run_at - int(keep),)),
+            (SQL_CLAIM_JOB_RUN, (job, run_at))
+        ]))
+    
+    @db_timed
+    def get_reminders(self, user_id: int):
+        """Включены ли напоминания у пользователя"""
+        self._sync_user(user_id)
+        row = self.storage.fetchone(SQL_SELECT_USER_REMINDERS, (user_id,))
+        return bool(row[0]) if row else True
+    
+    @db_timed
+    def get_users_without_day(self, work_date: str, tz: str):
+        """Пользователи пояса tz с включенными напоминаниями, не начавшие рабочий день"""
+        self._sync_all()
+        return [row[0] for row in self.storage.fetchall(
+            SQL_SELECT_USERS_WITHOUT_DAY, (DEFAULT_TZ, tz, date_to_day(work_date))
+        )]
+    
+    @db_timed
+    def get_open_day_users(self, work_date: str, tz: str):
+        """Пользователи пояса tz с включенными напоминаниями, не закрывшие рабочий день"""
+        self._sync_all()
+        return [row[0] for row in self.storage.fetchall(
+            SQL_SELECT_OPEN_DAY_USERS, (date_to_day(work_date), DEFAULT_TZ, tz)
+        )]
+    
+    @db_timed
+    def get_user_zones(self):
+        """Часовые пояса пользователей, включая пояс по умолчанию"""
+        self._sync_all()
+        zones = {zone_name(row[0]) for row in self.storage.fetchall(SQL_SELECT_USER_ZONES)}
+        return sorted(zones | {DEFAULT_TZ})
+    
+    @db_timed
+    def close_open_days(self, now: int, close_time: str, grace: float):
+        """Закрытие незавершенных смен временем close_time в поясе пользователя
+        (не раньше начала смены). Смены, начатые меньше grace секунд назад, и смены,
+        у которых close_time еще не наступило, остаются открытыми.
+        Возвращает список закрытых смен: (user_id, дата, начало, конец, пояс, напоминания включены)"""
+        self._sync_all()
+        close_min = time_to_minutes(close_time)
+        closed = []
+        for user_id, day, start_at, break_min, break_at, tz, reminders in self.storage.fetchall(
+                SQL_SELECT_OPEN_DAYS, (now - int(grace),)):
+            tz = zone_name(tz)
+            end_at = max(start_at, local_to_ts(day, close_min, tz))
+            if end_at > now:
+                continue
+            break_min = break_minutes(break_min, break_at, end_at)
+            # Пользователь мог закрыть смену сам после чтения списка
+            if not self.storage.write([(SQL_CLOSE_WORK_DAY, (end_at, break_min, user_id, day))]):
+                continue
+            work_day = make_work_day(user_id, day_to_date(day), start_at, end_at, break_min, None)
+            self._cache_update(user_id, work_day['date'], 'work_day', lambda _, work_day=work_day: work_day)
+            closed.append((user_id, work_day['date'], start_at, end_at, tz, bool(reminders)))
+        return closed
+    
+    def _cached_read(self, user_id: int, work_date: str, field: str, load):
+        """Чтение через кэш текущего дня"""
+        if not self.cache:
+            self._sync_user(user_id)
+            return load()
+        value = self.cache.get(user_id, work_date, field)
+        if value is not MISSING:
+            return value
+        generation = self.cache.begin_load(user_id, work_date)
+        self._sync_user(user_id)
+        value = load()
+        self.cache.store(user_id, work_date, field, value, generation)
+        return value
+    
+    @db_timed
+    def get_work_day(self, user_id: int, work_date: str):
+        """Получение данных рабочего дня"""
+        return self._cached_read(user_id, work_date, 'work_day', lambda: self._load_work_day(user_id, work_date))
+    
+    def _load_work_day(self, user_id: int, work_date: str):
+        """Чтение рабочего дня из базы"""
+        result = self.storage.fetchone(SQL_SELECT_WORK_DAY, (user_id, date_to_day(work_date)))
+        
+        if result:
+            return make_work_day(result[0], day_to_date(result[1]), *result[2:])
+        return None
+    
+    @db_timed
+    def get_work_tasks(self, user_id: int, work_date: str):
+        """Получение списка действий за день"""
+        return self._cached_read(user_id, work_date, 'tasks', lambda: self._load_work_tasks(user_id, work_date))
+    
+    def _load_work_tasks(self, user_id: int, work_date: str):
+        """Чтение списка действий из базы"""
+        return [row[0] for row in self.storage.fetchall(SQL_SELECT_WORK_TASKS, (user_id, date_to_day(work_date)))]
+    
+    @db_timed
+    def iter_period_report(self, user_id: int, start_date: str, end_date: str):
+        """Построчный обход итогов по дням за период: (дата, начало, конец
+        в секундах UTC, минуты, минуты за вычетом перерывов или обеда, число действий).
+        Длительности уже посчитаны в сводной таблице, строки времени не разбираются"""
+        self._sync_user(user_id)
+        period = (user_id, date_to_day(start_date), date_to_day(end_date))
+        for day, start_at, end_at, minutes, net_minutes, actions in self.storage.fetchall(
+                SQL_SELECT_PERIOD_REPORT, period + period):
+            yield (day_to_date(day), start_at, end_at, minutes, net_minutes, actions)
+    
+    @db_timed
+    def get_monthly_totals(self, user_id: int, start_month: int, end_month: int):
+        """Итоги по месяцам из сводной таблицы: (YYYYMM, дни, минуты, минуты за вычетом перерывов или обеда)"""
+        self._sync_user(user_id)
+        return self.storage.fetchall(SQL_SELECT_MONTHLY_TOTALS, (user_id, start_month, end_month))
+    
+    @db_timed
+    def search_actions(self, user_id: int, query: str, limit: int, offset: int = 0):
+        """Поиск действий пользователя по словам запроса, лучшие совпадения первыми:
+        список (дата, время создания в мс, описание)"""
+        words = SEARCH_WORD.findall(query.lower())[:SEARCH_MAX_WORDS]
+        if not words:
+            return []
+        self._sync_user(user_id)
+        rows = self.storage.fetchall(
+            self.storage.search_sql, self.storage.search_params(user_id, words, limit, offset)
+        )
+        return [(day_to_date(day), created_at, action) for day, created_at, action in rows]
+    
+    @db_timed
+    def iter_export(self, start_date: str, end_date: str, user_id: int = None, batch_size: int = 1000):
+        """Потоковое чтение истории для выгрузки (всех пользователей или одного);
+        начало и конец смены — в секундах UTC, последним полем — пояс пользователя"""
+        period = (date_to_day(start_date), date_to_day(end_date))
+        if user_id is None:
+            sql, params = SQL_EXPORT_ALL, period + period
+        else:
+            self._sync_user(user_id)
+            sql, params = SQL_EXPORT_USER, period + (user_id,) + period + (user_id,)
+        
+        for row_user, day, start_at, end_at, minutes, net_minutes, created_at, action, tz in \
+                self.storage.iter_rows(sql, params, batch_size):
+            yield (row_user, day_to_date(day), start_at, end_at,
+                   minutes, net_minutes, created_at, action, zone_name(tz))
+    
+    @db_timed
+    def get_work_period(self, user_id: int, start_date: str, end_date: str):
+        """Получение данных за период"""
+        self._sync_user(user_id)
+        period = (user_id, date_to_day(start_date), date_to_day(end_date))
+        
+        # Получаем рабочие дни: (дата, начало, конец, минуты перерывов)
+        work_days = [
+            (day_to_date(day), start_at, end_at, break_min)
+            for day, start_at, end_at, break_min in self.storage.fetchall(SQL_SELECT_PERIOD_DAYS, period)
+        ]
+        
+        # Получаем действия
+        tasks = [
+            (day_to_date(day), action_description)
+            for day, action_description in self.storage.fetchall(SQL_SELECT_PERIOD_TASKS, period)
+        ]
+        
+        return {
+            'work_days': work_days,
+            'tasks': tasks
+        }
+
+# ============================
+# АСИНХРОННЫЙ ДОСТУП К БАЗЕ
+# ============================
+
+class AsyncDatabase:
+    """Асинхронная обертка над Database: вызовы выполняются в отдельном
+    пуле потоков, чтобы запросы к базе не блокировали цикл событий.
+    Размер пула ограничивает и число соединений с базой."""
+    
+    def __init__(self, db, max_workers: int):
+        self.db = db
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="db")
+        # Число вызовов, ожидающих или выполняющихся в пуле (глубина очереди)
+        self.pending = 0
+    
+    async def run(self, func, *args):
+        """Выполнение синхронной функции в пуле потоков базы"""
+        loop = asyncio.get_running_loop()
+        self.pending += 1
+        try:
+            return await loop.run_in_executor(self.executor, functools.partial(func, *args))
+        finally:
+            self.pending -= 1
+    
+    def __getattr__(self, name):
+        method = getattr(self.db, name)
+        
+        async def call(*args):
+            return await self.run(method, *args)
+        
+        return call
+    
+    def close(self):
+        """Остановка пула потоков и закрытие базы"""
+        self.executor.shutdown(wait=True)
+        self.db.close()
+
+# База данных: объекты создаются без обращения к базе, схема проверяется при запуске (db.migrate)
+db = Database(open_storage())
+adb = AsyncDatabase(db, DB_THREADS)
+
+metrics.gauge('bot_db_executor_pending', lambda: adb.pending)
+metrics.gauge('bot_db_write_queue', lambda: db.writer.pending_count() if db.writer else 0)
+metrics.gauge('bot_db_connections', lambda: db.connection_count())
+metrics.gauge('bot_today_cache', lambda: db.cache.stats() if db.cache else {})
+
+# ============================
+# ИСХОДЯЩИЕ СООБЩЕНИЯ
+# ============================
+
+class TokenBucket:
+    """Ограничитель скорости «ведро с токенами»: rate токенов в секунду, не больше capacity"""
+    
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+    
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def delay(self):
+        """Сколько секунд ждать до появления токена"""
+        self._refill()
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+    
+    def reserve(self):
+        """Забрать токен (можно в долг); возвращает время ожидания до его появления"""
+        wait = self.delay()
+        self.tokens -= 1
+        return wait
+    
+    def is_full(self):
+        """Ведро полное — состояние можно забыть без потери ограничения"""
+        self._refill()
+        return self.tokens >= self.capacity
+
+class OutboundMessage:
+    """Исходящее сообщение в очереди"""
+    __slots__ = ('text', 'reply_markup', 'attempts')
+    
+    def __init__(self, text: str, reply_markup=None):
+        self.text = text
+        self.reply_markup = reply_markup
+        self.attempts = 0
+
+class OutboundSender:
+    """Очередь исходящих сообщений: обработчики только ставят ответ в очередь,
+    а фоновые задачи отправляют его с ограничением скорости (общим и на чат),
+    учитывают RetryAfter и склеивают накопившиеся ответы одному чату"""
     
-    def init_db(self):
-        """Инициализация базы данных"""
-        try:
-            with sqlite3.connect(self.db_name) as conn:
-                cursor = conn.cursor()
-                
-                # Таблица для рабочих дней
-                cursor.execute('''
-                    CREATE TABLE IF NOT EXISTS work_days (
-                        user_id INTEGER,
-                        date TEXT,
-                        start_time TEXT,
-                        end_time TEXT,
-                        PRIMARY KEY (user_id, date)
-                    )
-                ''')
-                
-                # Таблица для выполненных действий
-                cursor.execute('''
-                    CREATE TABLE IF NOT EXISTS work_actions (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        user_id INTEGER,
-                        date TEXT,
-                        action_description TEXT,
-                        created_at TEXT
-                    )
-                ''')
-                
-                conn.commit()
-                print(f"✅ База данных {self.db_name} создана/подключена")
-                
-        except Exception as e:
-            print(f"❌ Ошибка при создании базы данных: {e}")
+    def __init__(self, global_rate: float, chat_rate: float, chat_burst: int, workers: int):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.workers = workers
+        self.bot = None
+        # Чат -> очередь сообщений; чат есть здесь, пока у него есть неотправленные сообщения
+        self._pending = {}
+        self._chat_buckets = OrderedDict()
+        self._ready = None
+        self._tasks = []
+        self._paused_until = 0.0
     
-    def add_work_day(self, user_id: int, work_date: str, start_time: str, end_time: str):
-        """Добавление/обновление рабочего дня"""
-        with sqlite3.connect(self.db_name) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT OR REPLACE INTO work_days (user_id, date, start_time, end_time)
-                VALUES (?, ?, ?, ?)
-            ''', (user_id, work_date, start_time, end_time))
-            conn.commit()
+    @property
+    def running(self):
+        return bool(self._tasks)
     
-    def add_work_task(self, user_id: int, work_date: str, action_description: str):
-        """Добавление выполненного действия"""
-        with sqlite3.connect(self.db_name) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO work_actions (user_id, date, action_description, created_at)
-                VALUES (?, ?, ?, ?)
-            ''', (user_id, work_date, action_description, datetime.now().isoformat()))
-            conn.commit()
+    def start(self, bot):
+        """Запуск фоновых задач отправки (внутри цикла событий)"""
+        self.bot = bot
+        self._ready = asyncio.Queue()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
     
-    def get_work_day(self, user_id: int, work_date: str):
-        """Получение данных рабочего дня"""
-        with sqlite3.connect(self.db_name) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT * FROM work_days WHERE user_id = ? AND date = ?
-            ''', (user_id, work_date))
-            result = cursor.fetchone()
-            
-            if result:
-                return {
-                    'user_id': result[0],
-                    'date': result[1],
-                    'start_time': result[2],
-                    'end_time': result[3]
-                }
-            return None
+    async def stop(self, timeout: float = 10.0):
+        """Отправка оставшихся сообщений и остановка задач"""
+        deadline = time.monotonic() + timeout
+        while self._pending and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self._pending:
+            logging.warning(f"⚠️ Не отправлено сообщений при остановке: {self.queued()}")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
     
-    def get_work_tasks(self, user_id: int, work_date: str):
-        """Получение списка действий за день"""
-        with sqlite3.connect(self.db_name) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT action_description FROM work_actions 
-                WHERE user_id = ? AND date = ?
-                ORDER BY created_at
-            ''', (user_id, work_date))
-            return [row[0] for row in cursor.fetchall()]
+    def queued(self):
+        """Число сообщений в очереди"""
+        return sum(len(queue) for queue in self._pending.values())
     
-    def get_work_period(self, user_id: int, start_date: str, end_date: str):
-        """Получение данных за период"""
-        with sqlite3.connect(self.db_name) as conn:
-            cursor = conn.cursor()
-            
-            # Получаем рабочие дни
-            cursor.execute('''
-                SELECT date, start_time, end_time FROM work_days 
-                WHERE user_id = ? AND date BETWEEN ? AND ?
-                ORDER BY date
-            ''', (user_id, start_date, end_date))
-            work_days = cursor.fetchall()
+    def send(self, chat_id: int, text: str, reply_markup=None):
+        """Постановка сообщения в очередь без ожидания отправки"""
+        queue = self._pending.get(chat_id)
+        if queue is None:
+            queue = self._pending[chat_id] = deque()
+            self._ready.put_nowait(chat_id)
+        queue.append(OutboundMessage(text, reply_markup))
+    
+    async def call(self, chat_id: int, request):
+        """Прямой вызов Bot API, которому нужен объект обновления или результат (ответ на нажатие
+        кнопки, правка сообщения, файл): ждет токены тех же ограничителей, что и очередь,
+        и повторяет запрос после RetryAfter. request — функция без аргументов, возвращающая корутину"""
+        from telegram.error import RetryAfter
+        for attempt in range(1, OUTBOUND_MAX_ATTEMPTS + 1):
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            await asyncio.sleep(self._chat_bucket(chat_id).reserve())
+            await asyncio.sleep(self.global_bucket.reserve())
+            try:
+                result = await request()
+                metrics.inc('bot_outbound_sent_total')
+                return result
+            except RetryAfter as e:
+                retry_after = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else e.retry_after
+                logging.warning(f"⚠️ Telegram просит подождать {retry_after} с")
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+                metrics.inc('bot_outbound_retry_after_total')
+                if attempt == OUTBOUND_MAX_ATTEMPTS:
+                    raise
+    
+    def _chat_bucket(self, chat_id: int):
+        """Ограничитель скорости чата; полные ведра давно неактивных чатов забываются"""
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            while len(self._chat_buckets) >= OUTBOUND_CHAT_BUCKETS:
+                oldest_id, oldest = next(iter(self._chat_buckets.items()))
+                if not oldest.is_full():
+                    break
+                del self._chat_buckets[oldest_id]
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        self._chat_buckets.move_to_end(chat_id)
+        return bucket
+    
+    def _take(self, queue):
+        """Первое сообщение чата вместе с идущими следом ответами, которые помещаются в одно.
+        Кнопки могут быть только у последнего склеенного сообщения."""
+        message = queue.popleft()
+        while queue and message.reply_markup is None:
+            following = queue[0]
+            if len(message.text) + 2 + len(following.text) > TELEGRAM_MESSAGE_LIMIT:
+                break
+            queue.popleft()
+            merged = OutboundMessage(f"{message.text}\n\n{following.text}", following.reply_markup)
+            merged.attempts = max(message.attempts, following.attempts)
+            message = merged
+            metrics.inc('bot_outbound_coalesced_total')
+        return message
+    
+    async def _deliver(self, chat_id: int, message, queue):
+        """Отправка сообщения с обработкой ограничений и временных ошибок"""
+        from telegram.error import RetryAfter, BadRequest, Forbidden, NetworkError, TelegramError
+        try:
+            await self.bot.send_message(chat_id, message.text, reply_markup=message.reply_markup)
+            metrics.inc('bot_outbound_sent_total')
+        except RetryAfter as e:
+            retry_after = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else e.retry_after
+            logging.warning(f"⚠️ Telegram просит подождать {retry_after} с")
+            self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+            metrics.inc('bot_outbound_retry_after_total')
+            queue.appendleft(message)
+        except (BadRequest, Forbidden) as e:
+            logging.error(f"❌ Сообщение в чат {chat_id} отклонено: {e}")
+            metrics.inc('bot_outbound_dropped_total')
+        except NetworkError as e:
+            message.attempts += 1
+            if message.attempts < OUTBOUND_MAX_ATTEMPTS:
+                logging.warning(f"⚠️ Ошибка сети при отправке в чат {chat_id}, повтор: {e}")
+                queue.appendleft(message)
+                await asyncio.sleep(message.attempts)
+            else:
+                logging.error(f"❌ Сообщение в чат {chat_id} не отправлено: {e}")
+                metrics.inc('bot_outbound_dropped_total')
+        except TelegramError as e:
+            logging.error(f"❌ Ошибка при отправке в чат {chat_id}: {e}")
+            metrics.inc('bot_outbound_dropped_total')
+    
+    async def _worker(self):
+        """Фоновая задача: берет готовый к отправке чат и отправляет его сообщения"""
+        loop = asyncio.get_running_loop()
+        while True:
+            chat_id = await self._ready.get()
+            queue = self._pending.get(chat_id)
+            if not queue:
+                self._pending.pop(chat_id, None)
+                continue
             
-            # Получаем действия
-            cursor.execute('''
-                SELECT date, action_description FROM work_actions 
-                WHERE user_id = ? AND date BETWEEN ? AND ?
-                ORDER BY date, created_at
-            ''', (user_id, start_date, end_date))
-            tasks = cursor.fetchall()
+            # Чат исчерпал лимит — вернется в очередь, когда появится токен
+            bucket = self._chat_bucket(chat_id)
+            delay = bucket.delay()
+            if delay > 0:
+                loop.call_later(delay, self._ready.put_nowait, chat_id)
+                continue
+            bucket.reserve()
             
-            return {
-                'work_days': work_days,
-                'tasks': tasks
-            }
+            try:
+                pause = self._paused_until - time.monotonic()
+                if pause > 0:
+                    await asyncio.sleep(pause)
+                await asyncio.sleep(self.global_bucket.reserve())
+                await self._deliver(chat_id, self._take(queue), queue)
+            except Exception as e:
+                logging.error(f"❌ Ошибка очереди исходящих сообщений: {e}")
+            finally:
+                if queue:
+                    self._ready.put_nowait(chat_id)
+                else:
+                    del self._pending[chat_id]
 
-# Инициализация базы данных
-db = Database()
+sender = OutboundSender(OUTBOUND_GLOBAL_RATE, OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST, OUTBOUND_WORKERS)
+metrics.describe('bot_outbound_sent_total', 'counter', 'Messages delivered by the outbound queue')
+metrics.describe('bot_outbound_coalesced_total', 'counter', 'Replies merged into a preceding message')
+metrics.describe('bot_outbound_retry_after_total', 'counter', 'RetryAfter (429) responses from Telegram')
+metrics.describe('bot_outbound_dropped_total', 'counter', 'Messages dropped after errors')
+metrics.describe('bot_outbound_queue', 'gauge', 'Messages waiting in the outbound queue')
+metrics.gauge('bot_outbound_queue', sender.queued)
+
+async def reply(update, text: str, reply_markup=None):
+    """Ответ в чат обновления: через очередь исходящих сообщений, если она запущена"""
+    if sender.running:
+        sender.send(update.effective_chat.id, text, reply_markup=reply_markup)
+    else:
+        await update.message.reply_text(text, reply_markup=reply_markup)
+
+async def api_call(chat_id: int, request):
+    """Вызов Bot API из обработчика: через ограничители скорости очереди, если она запущена"""
+    if sender.running:
+        return await sender.call(chat_id, request)
+    return await request()
+
+async def answer_callback(update):
+    """Ответ на нажатие inline-кнопки (убирает индикатор загрузки)"""
+    await api_call(update.effective_chat.id, update.callback_query.answer)
+
+async def edit_message(update, text: str, reply_markup=None):
+    """Замена текста сообщения с нажатой inline-кнопкой"""
+    await api_call(update.effective_chat.id, functools.partial(
+        update.callback_query.edit_message_text, text, reply_markup=reply_markup))
+
+async def send_document(update, path: str):
+    """Отправка файла в чат обновления (файл открывается заново при повторе)"""
+    async def request():
+        with open(path, 'rb') as f:
+            return await update.message.reply_document(document=f, filename=os.path.basename(path))
+    await api_call(update.effective_chat.id, request)
 
 def format_date(date_str):
     """Форматирование даты в формат DD.MM.YYYY"""
@@ -149,27 +2488,148 @@ def format_date(date_str):
     except ValueError:
         return date_str
 
-def calculate_work_hours(start_time, end_time):
-    """Расчет рабочих часов: фактически и с учетом обеда"""
-    try:
-        start = datetime.strptime(start_time, '%H:%M')
-        end = datetime.strptime(end_time, '%H:%M')
-        
-        # Расчет фактических часов
-        actual_hours = (end - start).total_seconds() / 3600
-        
-        # Расчет часов с учетом обеда (минус 1 час)
-        work_hours_with_lunch = actual_hours - 1.0
-        
-        return max(0, actual_hours), max(0, work_hours_with_lunch)
-    except ValueError:
+def calculate_work_hours(start_at, end_at, break_min=None):
+    """Расчет рабочих часов по моментам начала и конца (секунды UTC): фактически
+    и за вычетом перерывов, а если перерывы не отмечались — обеда.
+    Смена может переходить через полночь"""
+    if start_at is None or end_at is None or end_at <= start_at:
         return 0, 0
+    minutes = (end_at - start_at) // 60
+    deduction = LUNCH_MINUTES if break_min is None else break_min
+    return minutes / 60, max(0, minutes - deduction) / 60
+
+def net_hours_label(break_min):
+    """Подпись к часам за вычетом обеда или отмеченных перерывов"""
+    if break_min is None:
+        return "🍽 С учетом обеда"
+    return f"☕ Без перерывов ({break_min} мин)"
+
+class Keyboards:
+    """Клавиатуры бота. Постоянные собираются один раз при запуске (build), а для кнопок
+    с данными сохраняются классы telegram, чтобы обработчики не импортировали их на каждый вызов"""
+    
+    def __init__(self):
+        self.main = None
+    
+    def build(self):
+        """Сборка клавиатур (telegram импортируется только здесь)"""
+        if self.main is not None:
+            return
+        from telegram import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
+        self._inline_markup = InlineKeyboardMarkup
+        self._inline_button = InlineKeyboardButton
+        self._cancel_overwrite = InlineKeyboardButton("❌ Отмена", callback_data="cancel_overwrite")
+        self.main = ReplyKeyboardMarkup([
+            [KeyboardButton(BUTTON_START_DAY), KeyboardButton(BUTTON_END_DAY)],
+            [KeyboardButton(BUTTON_ADD_ACTION), KeyboardButton(BUTTON_TODAY)],
+            [KeyboardButton(BUTTON_BREAK)]
+        ], resize_keyboard=True)
+    
+    def main_menu(self):
+        """Основная клавиатура с кнопками учета времени"""
+        self.build()
+        return self.main
+    
+    def overwrite(self, kind: str, day: int, moment: int):
+        """Предложение перезаписать начало или конец дня (kind — start или end)"""
+        self.build()
+        return self._inline_markup([
+            [self._inline_button("✅ Перезаписать время", callback_data=f"overwrite_{kind}_{day}_{moment}")],
+            [self._cancel_overwrite]
+        ])
+    
+    def search_pages(self, page: int, has_next: bool):
+        """Кнопки перелистывания результатов поиска (None, если страница одна)"""
+        self.build()
+        buttons = []
+        if page > 0:
+            buttons.append(self._inline_button("⬅️ Назад", callback_data=f"search_page_{page - 1}"))
+        if has_next:
+            buttons.append(self._inline_button("Далее ➡️", callback_data=f"search_page_{page + 1}"))
+        return self._inline_markup([buttons]) if buttons else None
+
+keyboards = Keyboards()
+
+# Часовые пояса пользователей, уже записанных в таблицу users этим процессом:
+# user_id -> (пояс, момент, после которого пояс перечитывается из базы).
+# Без кэша текущего дня (в том числе на общей базе реплик) пояс читается на каждое обновление
+user_timezones = {}
+USER_TIMEZONE_TTL = TODAY_CACHE_TTL if db.cache else 0
+
+async def user_timezone(user_id: int):
+    """Часовой пояс пользователя; при первом обращении после запуска
+    пользователь записывается в таблицу users"""
+    cached = user_timezones.get(user_id)
+    if cached and cached[1] > time.monotonic():
+        return cached[0]
+    if cached is None:
+        await adb.register_user(user_id)
+    tz = zone_name(await adb.get_timezone(user_id))
+    user_timezones[user_id] = (tz, time.monotonic() + USER_TIMEZONE_TTL)
+    return tz
+
+async def context_timezone(context, user_id: int):
+    """Часовой пояс пользователя для текущего обновления: читается один раз
+    (обычно маршрутизатором) и сохраняется в context.tz для обработчика"""
+    tz = getattr(context, 'tz', None)
+    if tz is None:
+        tz = context.tz = await user_timezone(user_id)
+    return tz
+
+# Состояние диалога и последний поисковый запрос (для перелистывания страниц). Пока база
+# принадлежит одному процессу, они хранятся в памяти и не стоят запроса к базе на каждое
+# сообщение; на общей базе реплик — в таблице users
+LOCAL_STATE = not db.storage.shared
+user_states = {}
+search_queries = {}
+
+async def set_state(user_id: int, state: str):
+    """Состояние диалога пользователя"""
+    if LOCAL_STATE:
+        user_states[user_id] = state
+    else:
+        await adb.set_state(user_id, state)
+
+async def pop_state(user_id: int):
+    """Состояние диалога со сбросом в STATE_IDLE"""
+    if LOCAL_STATE:
+        return user_states.pop(user_id, STATE_IDLE)
+    return await adb.pop_state(user_id)
+
+async def set_search_query(user_id: int, query: str):
+    """Последний поисковый запрос пользователя"""
+    if LOCAL_STATE:
+        search_queries[user_id] = query
+    else:
+        await adb.set_search_query(user_id, query)
+
+async def get_search_query(user_id: int):
+    """Последний поисковый запрос пользователя или None"""
+    if LOCAL_STATE:
+        return search_queries.get(user_id)
+    return await adb.get_search_query(user_id)
+
+async def current_shift(user_id: int, tz: str, now: int):
+    """Смена на текущий момент: сегодняшняя или начатая вчера и не закрытая
+    до сегодняшнего дня (ночная смена, в том числе уже закрытая после полуночи).
+    Возвращает (дата смены, рабочий день или None)"""
+    today = local_today(tz, now)
+    work_day = await adb.get_work_day(user_id, today)
+    if work_day and work_day['start_at'] is not None:
+        return today, work_day
+    
+    yesterday = day_to_date(date_to_day(today) - 1)
+    previous = await adb.get_work_day(user_id, yesterday)
+    if previous and previous['start_at'] is not None and (
+            previous['end_at'] is None or ts_to_day(previous['end_at'], tz) == date_to_day(today)):
+        return yesterday, previous
+    return today, work_day
 
 # ============================
 # ОСНОВНЫЕ КОМАНДЫ
 # ============================
 
-def start(update, context):
+async def start(update, context):
     """Команда /start"""
     user = update.message.from_user
     welcome_text = f"""
@@ -181,175 +2641,213 @@ def start(update, context):
 /start - Начало работы
 /add_action - Добавить выполненное действие
 /today - Показать сегодняшний день
+/report week|month|year - Отчет за неделю, месяц или год
+/report ДД.ММ.ГГГГ ДД.ММ.ГГГГ - Отчет за период
+/export [ДД.ММ.ГГГГ ДД.ММ.ГГГГ] [csv|xlsx] - Выгрузить историю
+/search ТЕКСТ - Найти выполненные действия
+/reminders on|off - Включить или выключить напоминания
+/timezone Europe/Moscow - Выбрать часовой пояс
 /reset_today - Сбросить сегодняшний день (для тестирования)
 
 🎯 Используйте кнопки ниже для учета рабочего времени!
+☕ Кнопка перерыва начинает и заканчивает перерыв: отмеченные перерывы вычитаются вместо обеда.
     """
     
-    from telegram import ReplyKeyboardMarkup, KeyboardButton
-    keyboard = [
-        [KeyboardButton("🟢 Начало рабочего дня"), KeyboardButton("🔴 Конец рабочего дня")],
-        [KeyboardButton("📝 Добавить действие"), KeyboardButton("📅 Сегодня")]
-    ]
-    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-    
-    update.message.reply_text(welcome_text, reply_markup=reply_markup)
+    await reply(update, welcome_text, reply_markup=keyboards.main_menu())
 
-def start_work_day(update, context):
+async def start_work_day(update, context):
     """Обработка нажатия кнопки начала рабочего дня"""
     user_id = update.message.from_user.id
-    today = date.today().isoformat()
+    tz = await context_timezone(context, user_id)
+    now = int(time.time())
+    today = local_today(tz, now)
     today_formatted = format_date(today)
-    current_time = datetime.now().strftime('%H:%M')
+    current_time = ts_to_time(now, tz)
     
     # Получаем текущие данные дня
-    work_day = db.get_work_day(user_id, today)
+    work_day = await adb.get_work_day(user_id, today)
     
-    if work_day and work_day['start_time']:
-        from telegram import InlineKeyboardMarkup, InlineKeyboardButton
+    if work_day and work_day['start_at'] is not None:
         # Предлагаем перезаписать или посмотреть текущее
-        keyboard = [
-            [InlineKeyboardButton("✅ Перезаписать время", callback_data=f"overwrite_start_{current_time}")],
-            [InlineKeyboardButton("❌ Отмена", callback_data="cancel_overwrite")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = keyboards.overwrite('start', date_to_day(today), now)
         
-        update.message.reply_text(
-            f"⏰ Начало рабочего дня уже было установлено: {work_day['start_time']}\n"
+        await reply(
+            update,
+            f"⏰ Начало рабочего дня уже было установлено: {ts_to_time(work_day['start_at'], tz)}\n"
             f"Хотите перезаписать на текущее время ({current_time})?",
             reply_markup=reply_markup
         )
     else:
         # Сохраняем только время начала, конец оставляем пустым
-        db.add_work_day(user_id, today, current_time, "")
+        await adb.add_work_day(user_id, today, now)
         
-        update.message.reply_text(
+        await reply(
+            update,
             f"🟢 Начало рабочего дня установлено!\n"
             f"📅 Дата: {today_formatted}\n"
             f"🕐 Время: {current_time}\n"
             f"Хорошего рабочего дня! 💼"
         )
 
-def end_work_day(update, context):
+async def end_work_day(update, context):
     """Обработка нажатия кнопки окончания рабочего дня"""
     user_id = update.message.from_user.id
-    today = date.today().isoformat()
-    today_formatted = format_date(today)
-    current_time = datetime.now().strftime('%H:%M')
+    tz = await context_timezone(context, user_id)
+    now = int(time.time())
+    current_time = ts_to_time(now, tz)
     
-    # Получаем текущие данные дня
-    work_day = db.get_work_day(user_id, today)
+    # Получаем текущую смену (ночная смена начата вчера)
+    shift_date, work_day = await current_shift(user_id, tz, now)
     
-    if not work_day or not work_day['start_time']:
-        update.message.reply_text(
+    if not work_day or work_day['start_at'] is None:
+        await reply(
+            update,
             "❌ Сначала нужно установить начало рабочего дня!\n"
             "Нажмите кнопку '🟢 Начало рабочего дня'"
         )
         return
     
-    if work_day['end_time']:
-        from telegram import InlineKeyboardMarkup, InlineKeyboardButton
+    if work_day['end_at'] is not None:
         # Предлагаем перезаписать или посмотреть текущее
-        keyboard = [
-            [InlineKeyboardButton("✅ Перезаписать время", callback_data=f"overwrite_end_{current_time}")],
-            [InlineKeyboardButton("❌ Отмена", callback_data="cancel_overwrite")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = keyboards.overwrite('end', date_to_day(shift_date), now)
         
-        update.message.reply_text(
-            f"⏰ Конец рабочего дня уже был установлен: {work_day['end_time']}\n"
+        await reply(
+            update,
+            f"⏰ Конец рабочего дня уже был установлен: {ts_to_time(work_day['end_at'], tz)}\n"
             f"Хотите перезаписать на текущее время ({current_time})?",
             reply_markup=reply_markup
         )
         return
     
-    # Сохраняем время окончания (начало берем из существующих данных)
-    db.add_work_day(user_id, today, work_day['start_time'], current_time)
+    # Сохраняем время окончания (незакрытый перерыв заканчивается вместе со сменой)
+    break_min = break_minutes(work_day['break_min'], work_day['break_at'], now)
+    await adb.add_work_day(user_id, shift_date, work_day['start_at'], now, break_min)
     
     # Расчет рабочих часов
-    actual_hours, work_hours_with_lunch = calculate_work_hours(work_day['start_time'], current_time)
+    actual_hours, net_hours = calculate_work_hours(work_day['start_at'], now, break_min)
     
-    update.message.reply_text(
+    await reply(
+        update,
         f"🔴 Конец рабочего дня установлен!\n"
-        f"📅 Дата: {today_formatted}\n"
-        f"🕐 Начало: {work_day['start_time']}\n"
+        f"📅 Дата: {format_date(shift_date)}\n"
+        f"🕐 Начало: {ts_to_time(work_day['start_at'], tz)}\n"
         f"🕔 Конец: {current_time}\n"
         f"⏱ Фактически отработано: {actual_hours:.1f} часов\n"
-        f"🍽 С учетом обеда: {work_hours_with_lunch:.1f} часов\n"
+        f"{net_hours_label(break_min)}: {net_hours:.1f} часов\n"
         f"Хорошего отдыха! 🌙"
     )
 
-def reset_today(update, context):
+async def toggle_break(update, context):
+    """Обработка нажатия кнопки перерыва: начало или окончание перерыва в текущей смене"""
+    user_id = update.message.from_user.id
+    tz = await context_timezone(context, user_id)
+    now = int(time.time())
+    
+    shift_date, work_day = await current_shift(user_id, tz, now)
+    if not work_day or work_day['start_at'] is None or work_day['end_at'] is not None:
+        await reply(
+            update,
+            "❌ Перерыв можно отметить только во время рабочего дня!\n"
+            f"Нажмите кнопку '{BUTTON_START_DAY}'"
+        )
+        return
+    
+    if work_day['break_at'] is None:
+        # С первого перерыва за день обед больше не вычитается
+        await adb.add_work_day(user_id, shift_date, work_day['start_at'], None, work_day['break_min'] or 0, now)
+        await reply(
+            update,
+            f"☕ Перерыв начат в {ts_to_time(now, tz)}\n"
+            f"Нажмите '{BUTTON_BREAK}' еще раз, когда вернетесь к работе"
+        )
+        return
+    
+    break_min = break_minutes(work_day['break_min'], work_day['break_at'], now)
+    await adb.add_work_day(user_id, shift_date, work_day['start_at'], None, break_min)
+    await reply(
+        update,
+        f"💼 Перерыв окончен: {(now - work_day['break_at']) // 60} мин\n"
+        f"☕ Всего перерывов за день: {break_min} мин"
+    )
+
+async def reset_today(update, context):
     """Сброс сегодняшнего дня для тестирования"""
     user_id = update.message.from_user.id
-    today = date.today().isoformat()
+    today = local_today(await context_timezone(context, user_id), time.time())
     today_formatted = format_date(today)
     
     # Удаляем данные за сегодня
-    conn = sqlite3.connect('work_tracker.db')
-    cursor = conn.cursor()
-    cursor.execute('DELETE FROM work_days WHERE user_id = ? AND date = ?', (user_id, today))
-    cursor.execute('DELETE FROM work_actions WHERE user_id = ? AND date = ?', (user_id, today))
-    conn.commit()
-    conn.close()
-    
-    update.message.reply_text(
+    await adb.reset_day(user_id, today)
+    
+    await reply(
+        update,
         f"🔄 Данные за сегодня ({today_formatted}) сброшены!\n"
         f"Теперь можно заново установить начало и конец рабочего дня."
     )
 
-def handle_overwrite_callback(update, context):
+async def handle_overwrite_callback(update, context):
     """Обработка перезаписи времени"""
     query = update.callback_query
-    query.answer()
+    await answer_callback(update)
     
     user_id = query.from_user.id
-    today = date.today().isoformat()
-    today_formatted = format_date(today)
     callback_data = query.data
     
     if callback_data == "cancel_overwrite":
-        query.edit_message_text("❌ Операция отменена.")
+        await edit_message(update, "❌ Операция отменена.")
+        return
+    
+    # Данные кнопки: overwrite_start|end_<номер дня>_<момент в секундах UTC>
+    try:
+        day, moment = (int(part) for part in callback_data.rsplit("_", 2)[1:])
+    except ValueError:
+        await edit_message(update, "⌛ Кнопка устарела, нажмите кнопку на клавиатуре еще раз.")
         return
+    tz = await context_timezone(context, user_id)
+    work_date = day_to_date(day)
+    current_time = ts_to_time(moment, tz)
     
-    elif callback_data.startswith("overwrite_start_"):
-        current_time = callback_data.replace("overwrite_start_", "")
-        # Перезаписываем время начала (конец оставляем пустым)
-        work_day = db.get_work_day(user_id, today)
-        db.add_work_day(user_id, today, current_time, "")
+    if callback_data.startswith("overwrite_start_"):
+        # Перезаписываем время начала (конец и перерывы сбрасываются)
+        await adb.add_work_day(user_id, work_date, moment)
         
-        query.edit_message_text(
+        await edit_message(
+            update,
             f"✅ Время начала перезаписано!\n"
-            f"📅 Дата: {today_formatted}\n"
+            f"📅 Дата: {format_date(work_date)}\n"
             f"🕐 Новое время: {current_time}"
         )
     
     elif callback_data.startswith("overwrite_end_"):
-        current_time = callback_data.replace("overwrite_end_", "")
         # Перезаписываем время окончания
-        work_day = db.get_work_day(user_id, today)
-        if work_day and work_day['start_time']:
-            db.add_work_day(user_id, today, work_day['start_time'], current_time)
+        work_day = await adb.get_work_day(user_id, work_date)
+        if work_day and work_day['start_at'] is not None:
+            break_min = break_minutes(work_day['break_min'], work_day['break_at'], moment)
+            await adb.add_work_day(user_id, work_date, work_day['start_at'], moment, break_min)
             
             # Расчет рабочих часов
-            actual_hours, work_hours_with_lunch = calculate_work_hours(work_day['start_time'], current_time)
+            actual_hours, net_hours = calculate_work_hours(work_day['start_at'], moment, break_min)
             
-            query.edit_message_text(
+            await edit_message(
+                update,
                 f"✅ Время окончания перезаписано!\n"
-                f"📅 Дата: {today_formatted}\n"
-                f"🕐 Начало: {work_day['start_time']}\n"
+                f"📅 Дата: {format_date(work_date)}\n"
+                f"🕐 Начало: {ts_to_time(work_day['start_at'], tz)}\n"
                 f"🕔 Конец: {current_time}\n"
                 f"⏱ Фактически отработано: {actual_hours:.1f} часов\n"
-                f"🍽 С учетом обеда: {work_hours_with_lunch:.1f} часов"
+                f"{net_hours_label(break_min)}: {net_hours:.1f} часов"
             )
 
 # ============================
 # ДОБАВЛЕНИЕ ДЕЙСТВИЙ
 # ============================
 
-def add_action_start(update, context):
+async def add_action_start(update, context):
     """Начало добавления выполненного действия"""
-    update.message.reply_text(
+    # Следующее текстовое сообщение будет сохранено как действие
+    await set_state(update.message.from_user.id, STATE_AWAITING_ACTION)
+    await reply(
+        update,
         "📝 Опишите выполненное действие:\n\n"
         "Например:\n"
         "• 'Монтаж электропроводки в квартире'\n"
@@ -359,57 +2857,61 @@ def add_action_start(update, context):
         "• 'Замена электропроводки на кухне'"
     )
 
-def add_action_complete(update, context):
-    """Добавление выполненного действия (обработка любого текстового сообщения)"""
-    # Проверяем, что это не команда и не кнопка
-    if update.message.text.startswith('/'):
-        return
-    
-    # Проверяем, что это не нажатие на другие кнопки
-    button_texts = ["🟢 Начало рабочего дня", "🔴 Конец рабочего дня", "📝 Добавить действие", "📅 Сегодня"]
-    if update.message.text in button_texts:
-        return
-    
+async def add_action_complete(update, context):
+    """Добавление выполненного действия (текст после кнопки «Добавить действие»)"""
     action_description = update.message.text
     user_id = update.message.from_user.id
-    today = date.today().isoformat()
-    today_formatted = format_date(today)
+    tz = await context_timezone(context, user_id)
     
-    # Сохраняем действие
-    db.add_work_task(user_id, today, action_description)
+    # Действие относится к текущей смене, в том числе ночной
+    shift_date, _ = await current_shift(user_id, tz, int(time.time()))
+    await adb.add_work_task(user_id, shift_date, action_description)
     
-    update.message.reply_text(
+    await reply(
+        update,
         f"✅ Выполненное действие добавлено!\n\n"
-        f"📅 Дата: {today_formatted}\n"
+        f"📅 Дата: {format_date(shift_date)}\n"
         f"📝 Действие: {action_description}"
     )
 
+async def unexpected_text(update, context):
+    """Текст без нажатия кнопки «Добавить действие» не сохраняется"""
+    await reply(
+        update,
+        f"🤔 Не понял сообщение.\n"
+        f"Чтобы добавить выполненное действие, сначала нажмите '{BUTTON_ADD_ACTION}'"
+    )
+
 # ============================
 # ИНФОРМАЦИЯ О СЕГОДНЯШНЕМ ДНЕ
 # ============================
 
-def today_info(update, context):
-    """Информация о сегодняшнем дне"""
+async def today_info(update, context):
+    """Информация о сегодняшнем дне (или о незакрытой ночной смене)"""
     user_id = update.message.from_user.id
-    today = date.today().isoformat()
-    today_formatted = format_date(today)
+    tz = await context_timezone(context, user_id)
+    now = int(time.time())
+    shift_date, work_day = await current_shift(user_id, tz, now)
+    actions = await adb.get_work_tasks(user_id, shift_date)
     
-    work_day = db.get_work_day(user_id, today)
-    actions = db.get_work_tasks(user_id, today)
-    
-    response = [f"📅 Сегодня: {today_formatted}"]
+    response = [f"📅 Сегодня: {format_date(shift_date)}"]
     
     if work_day:
-        if work_day['start_time']:
-            response.append(f"🟢 Начало: {work_day['start_time']}")
+        if work_day['start_at'] is not None:
+            response.append(f"🟢 Начало: {ts_to_time(work_day['start_at'], tz)}")
         else:
             response.append("❌ Начало дня не установлено")
-            
-        if work_day['end_time'] and work_day['end_time'] != work_day['start_time']:
-            response.append(f"🔴 Конец: {work_day['end_time']}")
-            actual_hours, work_hours_with_lunch = calculate_work_hours(work_day['start_time'], work_day['end_time'])
+        
+        if work_day['break_at'] is not None:
+            response.append(f"☕ На перерыве с {ts_to_time(work_day['break_at'], tz)}")
+        
+        if work_day['end_at'] is not None and work_day['end_at'] != work_day['start_at']:
+            response.append(f"🔴 Конец: {ts_to_time(work_day['end_at'], tz)}")
+            actual_hours, net_hours = calculate_work_hours(
+                work_day['start_at'], work_day['end_at'], work_day['break_min']
+            )
             response.append(f"⏱ Фактически: {actual_hours:.1f} часов")
-            response.append(f"🍽 С учетом обеда: {work_hours_with_lunch:.1f} часов")
+            response.append(f"{net_hours_label(work_day['break_min'])}: {net_hours:.1f} часов")
         else:
             response.append("❌ Конец дня не установлен")
     else:
@@ -422,48 +2924,811 @@ def today_info(update, context):
     else:
         response.append("\n❌ Действия не добавлены")
     
-    update.message.reply_text("\n".join(response))
+    await reply(update, "\n".join(response))
+
+# ============================
+# ОТЧЕТ ЗА ПЕРИОД
+# ============================
+
+# Ограничение Telegram на длину одного сообщения
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+REPORT_USAGE = (
+    "📊 Использование:\n"
+    "/report week - текущая неделя\n"
+    "/report month - текущий месяц\n"
+    "/report year - текущий год по месяцам\n"
+    "/report ДД.ММ.ГГГГ ДД.ММ.ГГГГ - произвольный период"
+)
+
+def parse_date(text):
+    """Разбор даты в формате ДД.ММ.ГГГГ или ГГГГ-ММ-ДД"""
+    for fmt in ('%d.%m.%Y', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(text, fmt).date()
+        except ValueError:
+            continue
+    return None
+
+def parse_report_period(args, today: date):
+    """Период отчета по аргументам команды: (начало, конец) или None"""
+    if len(args) == 1 and args[0].lower() == 'week':
+        return today - timedelta(days=today.weekday()), today
+    if len(args) == 1 and args[0].lower() == 'month':
+        return today.replace(day=1), today
+    if len(args) == 2:
+        start_date, end_date = parse_date(args[0]), parse_date(args[1])
+        if start_date and end_date and start_date <= end_date:
+            return start_date, end_date
+    return None
+
+def paginate(lines, limit: int = TELEGRAM_MESSAGE_LIMIT):
+    """Склейка строк в сообщения, не превышающие лимит Telegram"""
+    page, size = [], 0
+    for line in lines:
+        line = line[:limit]
+        if page and size + len(line) + 1 > limit:
+            yield "\n".join(page)
+            page, size = [], 0
+        page.append(line)
+        size += len(line) + 1
+    if page:
+        yield "\n".join(page)
+
+# Подписи к часам из сводных таблиц: за вычетом отмеченных перерывов,
+# а в дни без отмеченных перерывов — обеда
+NET_HOURS_SHORT = "без перерывов"
+NET_HOURS_TOTAL = "☕ Без обеда и перерывов"
+
+def build_period_report(user_id: int, start_date: str, end_date: str, tz: str = DEFAULT_TZ):
+    """Отчет за период за один проход по итогам дней; возвращает список сообщений.
+    Время начала и конца показывается в поясе пользователя tz"""
+    totals = {'days': 0, 'minutes': 0, 'net_minutes': 0, 'actions': 0}
+    
+    def lines():
+        yield f"📊 Отчет за период {format_date(start_date)} — {format_date(end_date)}\n"
+        for work_date, start_at, end_at, minutes, net_minutes, actions in db.iter_period_report(
+                user_id, start_date, end_date):
+            if start_at is not None:
+                totals['days'] += 1
+            totals['minutes'] += minutes
+            totals['net_minutes'] += net_minutes
+            totals['actions'] += actions
+            
+            interval = f"{ts_to_time(start_at, tz) or '—'}–{ts_to_time(end_at, tz) or '…'}"
+            yield (f"📅 {format_date(work_date)}: {interval}, "
+                   f"{minutes / 60:.1f} ч ({net_minutes / 60:.1f} ч {NET_HOURS_SHORT}), "
+                   f"действий: {actions}")
+        
+        if not totals['days'] and not totals['actions']:
+            yield "❌ За этот период нет данных"
+            return
+        yield (f"\n📆 Рабочих дней: {totals['days']}\n"
+               f"⏱ Фактически отработано: {totals['minutes'] / 60:.1f} часов\n"
+               f"{NET_HOURS_TOTAL}: {totals['net_minutes'] / 60:.1f} часов\n"
+               f"✅ Выполнено действий: {totals['actions']}")
+    
+    return list(paginate(lines()))
+
+MONTH_NAMES = [
+    "Январь", "Февраль", "Март", "Апрель", "Май", "Июнь",
+    "Июль", "Август", "Сентябрь", "Октябрь", "Ноябрь", "Декабрь"
+]
+
+def build_year_report(user_id: int, year: int):
+    """Отчет за год по месяцам из сводной таблицы monthly_totals"""
+    rows = db.get_monthly_totals(user_id, year * 100 + 1, year * 100 + 12)
+    if not rows:
+        return [f"📊 Отчет за {year} год\n\n❌ За этот период нет данных"]
+    
+    lines = [f"📊 Отчет за {year} год\n"]
+    for month, days, minutes, net_minutes in rows:
+        lines.append(f"📅 {MONTH_NAMES[month % 100 - 1]}: дней {days}, "
+                     f"{minutes / 60:.1f} ч ({net_minutes / 60:.1f} ч {NET_HOURS_SHORT})")
+    lines.append(f"\n📆 Рабочих дней: {sum(r[1] for r in rows)}\n"
+                 f"⏱ Фактически отработано: {sum(r[2] for r in rows) / 60:.1f} часов\n"
+                 f"{NET_HOURS_TOTAL}: {sum(r[3] for r in rows) / 60:.1f} часов")
+    return list(paginate(lines))
+
+async def report(update, context):
+    """Команда /report: отчет за неделю, месяц, год или произвольный период"""
+    user_id = update.message.from_user.id
+    tz = await context_timezone(context, user_id)
+    today = date.fromisoformat(local_today(tz, time.time()))
+    if len(context.args) == 1 and context.args[0].lower() == 'year':
+        pages = await adb.run(build_year_report, user_id, today.year)
+        for page in pages:
+            await reply(update, page)
+        return
+    
+    period = parse_report_period(context.args, today)
+    if not period:
+        await reply(update, REPORT_USAGE)
+        return
+    
+    start_date, end_date = (d.isoformat() for d in period)
+    pages = await adb.run(build_period_report, user_id, start_date, end_date, tz)
+    for page in pages:
+        await reply(update, page)
+
+# ============================
+# ЭКСПОРТ ИСТОРИИ
+# ============================
+
+# Число строк в одном файле экспорта (файлы отправляются по отдельности)
+EXPORT_CHUNK_ROWS = int(os.getenv('EXPORT_CHUNK_ROWS', '100000'))
+
+EXPORT_HEADER = [
+    "Пользователь", "Дата", "Начало", "Конец",
+    "Часы", "Часы без обеда и перерывов", "Время действия", "Действие"
+]
+
+EXPORT_USAGE = (
+    "📤 Использование:\n"
+    "/export - вся история в CSV\n"
+    "/export xlsx - вся история в Excel\n"
+    "/export ДД.ММ.ГГГГ ДД.ММ.ГГГГ [csv|xlsx] - история за период"
+)
+
+def export_rows(start_date: str, end_date: str, user_id: int = None):
+    """Строки экспорта в виде, готовом для записи в файл (время — в поясе пользователя)"""
+    for row_user, work_date, start_at, end_at, minutes, net_minutes, created_at, action, tz in db.iter_export(
+            start_date, end_date, user_id):
+        action_time = (datetime.fromtimestamp(created_at / 1000, get_zone(tz)).strftime('%H:%M:%S')
+                       if created_at else "")
+        yield [
+            row_user, work_date, ts_to_time(start_at, tz), ts_to_time(end_at, tz),
+            round(minutes / 60, 2) if minutes is not None else "",
+            round(net_minutes / 60, 2) if net_minutes is not None else "",
+            action_time, action or ""
+        ]
+
+def write_csv_chunk(path, rows):
+    """Запись части экспорта в CSV (с BOM, чтобы Excel понял кодировку)"""
+    import csv
+    with open(path, 'w', newline='', encoding='utf-8-sig') as f:
+        writer = csv.writer(f)
+        writer.writerow(EXPORT_HEADER)
+        writer.writerows(rows)
+
+def write_xlsx_chunk(path, rows):
+    """Запись части экспорта в XLSX в потоковом режиме openpyxl"""
+    from openpyxl import Workbook
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet("История")
+    sheet.append(EXPORT_HEADER)
+    for row in rows:
+        sheet.append(row)
+    workbook.save(path)
+
+EXPORT_WRITERS = {
+    'csv': write_csv_chunk,
+    'xlsx': write_xlsx_chunk,
+}
+
+def xlsx_available():
+    """Проверка, установлен ли openpyxl для экспорта в Excel"""
+    try:
+        import openpyxl  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+def export_history(directory, fmt: str, start_date: str, end_date: str, user_id: int = None,
+                   chunk_rows: int = EXPORT_CHUNK_ROWS):
+    """Потоковая выгрузка истории в файлы по chunk_rows строк; возвращает пути файлов.
+    В памяти одновременно находится не больше одной строки."""
+    write_chunk = EXPORT_WRITERS[fmt]
+    rows = export_rows(start_date, end_date, user_id)
+    suffix = f"user{user_id}" if user_id else "team"
+    paths = []
+    
+    while True:
+        chunk = itertools.islice(rows, chunk_rows)
+        first = next(chunk, None)
+        if first is None:
+            break
+        path = os.path.join(directory, f"work_history_{suffix}_{start_date}_{end_date}_{len(paths) + 1}.{fmt}")
+        write_chunk(path, itertools.chain([first], chunk))
+        paths.append(path)
+    
+    return paths
+
+def parse_export_args(args, today: date):
+    """Аргументы /export: (начало, конец, формат) или None"""
+    args = list(args)
+    fmt = 'csv'
+    if args and args[-1].lower() in EXPORT_WRITERS:
+        fmt = args.pop().lower()
+    if not args:
+        return date(1970, 1, 1), today, fmt
+    if len(args) == 2:
+        start_date, end_date = parse_date(args[0]), parse_date(args[1])
+        if start_date and end_date and start_date <= end_date:
+            return start_date, end_date, fmt
+    return None
+
+async def export(update, context):
+    """Команда /export: выгрузка своей истории в CSV или XLSX"""
+    user_id = update.message.from_user.id
+    today = date.fromisoformat(local_today(await context_timezone(context, user_id), time.time()))
+    parsed = parse_export_args(context.args, today)
+    if not parsed:
+        await reply(update, EXPORT_USAGE)
+        return
+    start_date, end_date, fmt = parsed
+    if fmt == 'xlsx' and not xlsx_available():
+        await reply(update, "❌ Экспорт в Excel недоступен: не установлен openpyxl")
+        return
+    
+    import tempfile
+    with tempfile.TemporaryDirectory() as directory:
+        paths = await adb.run(
+            export_history, directory, fmt, start_date.isoformat(), end_date.isoformat(), user_id
+        )
+        if not paths:
+            await reply(update, "❌ За этот период нет данных")
+            return
+        for path in paths:
+            await send_document(update, path)
+
+# ============================
+# ПОИСК ПО ДЕЙСТВИЯМ
+# ============================
+
+# Совпадений на странице и максимальная длина описания в выдаче
+SEARCH_PAGE_SIZE = 10
+SEARCH_SNIPPET_CHARS = 300
+
+SEARCH_USAGE = (
+    "🔎 Использование:\n"
+    "/search ТЕКСТ - поиск по выполненным действиям\n"
+    "Например: /search кабель ВВГнг"
+)
+
+def format_created_at(created_at, tz: str):
+    """Время создания действия (мс от начала эпохи) -> HH:MM в поясе tz"""
+    if created_at is None:
+        return ""
+    return ts_to_time(created_at // 1000, tz)
+
+async def build_search_page(user_id: int, query: str, page: int, tz: str):
+    """Текст страницы результатов поиска и кнопки перелистывания"""
+    # Одна лишняя строка показывает, есть ли следующая страница, без подсчета всех совпадений
+    hits = await adb.search_actions(user_id, query, SEARCH_PAGE_SIZE + 1, page * SEARCH_PAGE_SIZE)
+    has_next = len(hits) > SEARCH_PAGE_SIZE
+    hits = hits[:SEARCH_PAGE_SIZE]
+    
+    if not hits:
+        text = f"🔎 По запросу «{query}» ничего не найдено" if page == 0 else "🔎 Больше совпадений нет"
+        return text, None
+    
+    response = [f"🔎 Результаты по запросу «{query}» (страница {page + 1}):\n"]
+    for i, (work_date, created_at, action) in enumerate(hits, page * SEARCH_PAGE_SIZE + 1):
+        if len(action) > SEARCH_SNIPPET_CHARS:
+            action = action[:SEARCH_SNIPPET_CHARS] + "…"
+        response.append(f"{i}. 📅 {format_date(work_date)} {format_created_at(created_at, tz)}".rstrip())
+        response.append(f"   {action}")
+    
+    return "\n".join(response), keyboards.search_pages(page, has_next)
+
+async def search(update, context):
+    """Команда /search: поиск по описаниям своих действий"""
+    query = " ".join(context.args or []).strip()
+    if not SEARCH_WORD.search(query):
+        await reply(update, SEARCH_USAGE)
+        return
+    
+    user_id = update.message.from_user.id
+    await set_search_query(user_id, query)
+    text, reply_markup = await build_search_page(user_id, query, 0, await context_timezone(context, user_id))
+    await reply(update, text, reply_markup=reply_markup)
+
+async def handle_search_callback(update, context):
+    """Перелистывание страниц результатов поиска"""
+    query = update.callback_query
+    await answer_callback(update)
+    
+    search_query = await get_search_query(query.from_user.id)
+    if not search_query:
+        await edit_message(update, "🔎 Поиск устарел, повторите команду /search")
+        return
+    page = int(query.data.replace("search_page_", ""))
+    tz = await context_timezone(context, query.from_user.id)
+    text, reply_markup = await build_search_page(query.from_user.id, search_query, page, tz)
+    await edit_message(update, text, reply_markup=reply_markup)
+
+# ============================
+# НАПОМИНАНИЯ И АВТОЗАКРЫТИЕ ДНЯ
+# ============================
+
+# Максимальный сон планировщика: после скачка часов сервера ожидание пересчитывается
+SCHEDULER_MAX_SLEEP = 60.0
+
+# Сколько секунд хранить отметки о запусках задач в job_runs
+JOB_RUNS_KEEP = 7 * 86400
+
+def next_daily_run(at_minutes: int, after: float, tz: str):
+    """Ближайший момент (секунды UTC) позже after, когда время в поясе tz равно at_minutes"""
+    day = ts_to_day(after, tz)
+    run = local_to_ts(day, at_minutes, tz)
+    if run <= after:
+        run = local_to_ts(day + 1, at_minutes, tz)
+    return run
+
+class Scheduler:
+    """Планировщик ежедневных задач: min-heap по времени следующего запуска.
+    Цикл спит до ближайшей задачи и не опрашивает базу между запусками.
+    Каждый запуск отмечается в job_runs, поэтому при нескольких репликах
+    на одной базе задачу выполняет только одна из них"""
+    
+    def __init__(self):
+        # (время запуска, порядковый номер, имя, минуты от полуночи, пояс, задача)
+        self._heap = []
+        self._names = set()
+        self._counter = itertools.count()
+        self._wakeup = None
+        self._task = None
+        self.bot = None
+    
+    @property
+    def running(self):
+        return self._task is not None
+    
+    def add_daily(self, name: str, at_time: str, job, tz: str):
+        """Ежедневная задача job(bot) в HH:MM в поясе tz; задача с тем же именем не дублируется"""
+        if name in self._names:
+            return
+        self._names.add(name)
+        minutes = time_to_minutes(at_time)
+        self._push(next_daily_run(minutes, time.time(), tz), name, minutes, tz, job)
+    
+    def _push(self, run_at: int, name: str, minutes: int, tz: str, job):
+        heapq.heappush(self._heap, (run_at, next(self._counter), name, minutes, tz, job))
+        if self._wakeup:
+            self._wakeup.set()
+    
+    def jobs(self):
+        """Задачи в порядке запуска: (имя, время следующего запуска в поясе задачи)"""
+        return [(name, datetime.fromtimestamp(run_at, get_zone(tz)))
+                for run_at, _, name, _, tz, _ in sorted(self._heap)]
+    
+    def start(self, bot):
+        """Запуск цикла планировщика (внутри цикла событий)"""
+        self.bot = bot
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        """Остановка цикла; задача, выполняющаяся в этот момент, прерывается"""
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+    
+    async def _run(self):
+        """Цикл: сон до ближайшей задачи, запуск и перенос на следующий день"""
+        while True:
+            delay = self._heap[0][0] - time.time() if self._heap else SCHEDULER_MAX_SLEEP
+            if delay > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), min(delay, SCHEDULER_MAX_SLEEP))
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            
+            run_at, _, name, minutes, tz, job = heapq.heappop(self._heap)
+            self._push(next_daily_run(minutes, run_at, tz), name, minutes, tz, job)
+            try:
+                if not await adb.claim_job_run(name, int(run_at), JOB_RUNS_KEEP):
+                    logging.info(f"⏰ Задача {name} уже выполнена другой репликой")
+                    continue
+                with metrics.timer('bot_scheduler_job_seconds', job=name):
+                    await job(self.bot)
+            except Exception as e:
+                logging.error(f"❌ Ошибка задачи планировщика {name}: {e}")
+                metrics.inc('bot_scheduler_errors_total', job=name)
+
+scheduler = Scheduler()
+metrics.describe('bot_scheduler_job_seconds', 'histogram', 'Scheduled job duration')
+metrics.describe('bot_scheduler_errors_total', 'counter', 'Scheduled job exceptions')
+metrics.describe('bot_reminders_total', 'counter', 'Reminders and auto-close notices queued')
+
+async def notify(bot, chat_id: int, text: str):
+    """Сообщение без входящего обновления: через очередь исходящих сообщений, если она запущена"""
+    if sender.running:
+        sender.send(chat_id, text)
+        return
+    from telegram.error import TelegramError
+    try:
+        await bot.send_message(chat_id, text)
+    except TelegramError as e:
+        logging.error(f"❌ Ошибка при отправке в чат {chat_id}: {e}")
+
+async def remind_start_day(bot, tz: str):
+    """Напоминание отметить начало дня пользователям пояса tz, кто его еще не отметил"""
+    today = local_today(tz, time.time())
+    if date.fromisoformat(today).isoweekday() not in REMINDER_DAYS:
+        return
+    user_ids = await adb.get_users_without_day(today, tz)
+    for user_id in user_ids:
+        await notify(bot, user_id, f"⏰ Не забудьте отметить начало рабочего дня кнопкой '{BUTTON_START_DAY}'")
+    metrics.inc('bot_reminders_total', len(user_ids), kind='start')
+    logging.info(f"⏰ Напоминаний о начале дня ({tz}): {len(user_ids)}")
+
+async def remind_end_day(bot, tz: str):
+    """Напоминание закрыть рабочий день пользователям пояса tz, у кого он еще открыт"""
+    today = local_today(tz, time.time())
+    if date.fromisoformat(today).isoweekday() not in REMINDER_DAYS:
+        return
+    user_ids = await adb.get_open_day_users(today, tz)
+    for user_id in user_ids:
+        await notify(bot, user_id, f"⏰ Рабочий день еще не закрыт. Не забудьте нажать '{BUTTON_END_DAY}'")
+    metrics.inc('bot_reminders_total', len(user_ids), kind='end')
+    logging.info(f"⏰ Напоминаний о конце дня ({tz}): {len(user_ids)}")
+
+async def auto_close_days(bot, tz: str):
+    """Автоматическое закрытие незавершенных дней временем AUTO_CLOSE_TIME в поясе пользователя.
+    Запускается в AUTO_CLOSE_TIME каждого пояса tz и закрывает все смены, для которых это время прошло"""
+    now = int(time.time())
+    closed = await adb.close_open_days(now, AUTO_CLOSE_TIME, AUTO_CLOSE_GRACE_HOURS * 3600)
+    notified = 0
+    for user_id, work_date, start_at, end_at, tz, reminders in closed:
+        # Уведомление не приходит тем, кто выключил напоминания, и о забытых днях из прошлого,
+        # чтобы не засыпать чат уведомлениями
+        if not reminders or end_at < now - 86400:
+            continue
+        await notify(
+            bot, user_id,
+            f"🔒 Рабочий день {format_date(work_date)} закрыт автоматически.\n"
+            f"🕐 Начало: {ts_to_time(start_at, tz)}\n"
+            f"🕔 Конец: {ts_to_time(end_at, tz)}\n"
+            f"Если время неверное, нажмите '{BUTTON_END_DAY}' и перезапишите его."
+        )
+        notified += 1
+    metrics.inc('bot_reminders_total', notified, kind='auto_close')
+    logging.info(f"🔒 Автоматически закрыто рабочих дней: {len(closed)}")
+
+# Ежедневные задачи: (имя, время HH:MM из окружения, задача(bot, tz))
+DAILY_JOBS = [
+    ('remind_start', REMINDER_START_TIME, remind_start_day),
+    ('remind_end', REMINDER_END_TIME, remind_end_day),
+    ('auto_close', AUTO_CLOSE_TIME, auto_close_days),
+]
+
+def schedule_zone(tz: str):
+    """Регистрация ежедневных задач для пояса tz (повторная регистрация ничего не меняет)"""
+    for name, at_time, job in DAILY_JOBS:
+        if at_time:
+            scheduler.add_daily(f"{name}:{tz}", at_time, functools.partial(job, tz=tz), tz)
+
+def schedule_jobs(zones):
+    """Регистрация ежедневных задач для всех поясов пользователей"""
+    for tz in zones:
+        schedule_zone(tz)
+
+REMINDERS_USAGE = (
+    "🔔 Использование:\n"
+    "/reminders on - включить напоминания\n"
+    "/reminders off - выключить напоминания"
+)
+
+async def reminders(update, context):
+    """Команда /reminders on|off"""
+    user_id = update.message.from_user.id
+    args = [arg.lower() for arg in context.args or []]
+    
+    if args and args[0] in ('on', 'off'):
+        enabled = args[0] == 'on'
+        await adb.set_reminders(user_id, enabled)
+        await reply(update, "🔔 Напоминания включены" if enabled else "🔕 Напоминания выключены")
+        return
+    if args:
+        await reply(update, REMINDERS_USAGE)
+        return
+    
+    enabled = await adb.get_reminders(user_id)
+    response = ["🔔 Напоминания включены" if enabled else "🔕 Напоминания выключены"]
+    if REMINDER_START_TIME:
+        response.append(f"🟢 О начале дня: {REMINDER_START_TIME}")
+    if REMINDER_END_TIME:
+        response.append(f"🔴 О конце дня: {REMINDER_END_TIME}")
+    if AUTO_CLOSE_TIME:
+        response.append(f"🔒 Автозакрытие дня: {AUTO_CLOSE_TIME}")
+    if not (REMINDER_START_TIME or REMINDER_END_TIME or AUTO_CLOSE_TIME):
+        response.append("ℹ️ Время напоминаний на сервере не задано")
+    response.append("")
+    response.append(REMINDERS_USAGE)
+    await reply(update, "\n".join(response))
+
+# ============================
+# ЧАСОВОЙ ПОЯС
+# ============================
+
+TIMEZONE_USAGE = (
+    "🌍 Использование:\n"
+    "/timezone - показать текущий часовой пояс\n"
+    "/timezone Europe/Moscow - выбрать пояс (название IANA, например Asia/Yekaterinburg)"
+)
+
+async def set_timezone(update, context):
+    """Команда /timezone: просмотр и выбор часового пояса пользователя"""
+    user_id = update.message.from_user.id
+    args = context.args or []
+    
+    if not args:
+        tz = await context_timezone(context, user_id)
+        await reply(
+            update,
+            f"🌍 Часовой пояс: {tz}\n"
+            f"🕐 Сейчас: {ts_to_time(time.time(), tz)}\n\n"
+            f"{TIMEZONE_USAGE}"
+        )
+        return
+    
+    tz = args[0]
+    if len(args) > 1 or not get_zone(tz):
+        await reply(update, f"❌ Неизвестный часовой пояс: {' '.join(args)}\n\n{TIMEZONE_USAGE}")
+        return
+    
+    await context_timezone(context, user_id)
+    await adb.set_timezone(user_id, tz)
+    user_timezones[user_id] = (tz, time.monotonic() + USER_TIMEZONE_TTL)
+    # Напоминания для нового пояса начинают приходить без перезапуска
+    if scheduler.running:
+        schedule_zone(tz)
+    await reply(update, f"🌍 Часовой пояс установлен: {tz}\n🕐 Сейчас: {ts_to_time(time.time(), tz)}")
+
+# ============================
+# МАРШРУТИЗАЦИЯ СООБЩЕНИЙ
+# ============================
+
+# Кнопки клавиатуры: точное совпадение текста -> обработчик
+TEXT_ROUTES = {
+    BUTTON_START_DAY: timed_handler(start_work_day),
+    BUTTON_END_DAY: timed_handler(end_work_day),
+    BUTTON_ADD_ACTION: timed_handler(add_action_start),
+    BUTTON_TODAY: timed_handler(today_info),
+    BUTTON_BREAK: timed_handler(toggle_break),
+}
+
+# Команды: имя без "/" -> обработчик
+COMMAND_ROUTES = {
+    "start": timed_handler(start),
+    "today": timed_handler(today_info),
+    "reset_today": timed_handler(reset_today),
+    "add_action": timed_handler(add_action_start),
+    "report": timed_handler(report),
+    "export": timed_handler(export),
+    "reminders": timed_handler(reminders),
+    "search": timed_handler(search),
+    "timezone": timed_handler(set_timezone),
+}
+
+# Свободный текст обрабатывается в зависимости от состояния пользователя
+STATE_ROUTES = {
+    STATE_IDLE: timed_handler(unexpected_text),
+    STATE_AWAITING_ACTION: timed_handler(add_action_complete),
+}
+
+async def route_text(update, context):
+    """Единый обработчик текста: кнопка по точному совпадению, иначе — по состоянию"""
+    user_id = update.message.from_user.id
+    await context_timezone(context, user_id)
+    # Любое сообщение завершает ожидание описания действия
+    state = await pop_state(user_id)
+    handler = TEXT_ROUTES.get(update.message.text) or STATE_ROUTES[state]
+    await handler(update, context)
+
+async def route_command(update, context):
+    """Единый обработчик команд: поиск по словарю вместо цепочки CommandHandler"""
+    command, *args = update.message.text.split()
+    handler = COMMAND_ROUTES.get(command[1:].split('@', 1)[0].lower())
+    if handler is None:
+        return
+    await context_timezone(context, update.message.from_user.id)
+    await pop_state(update.message.from_user.id)
+    context.args = args
+    await handler(update, context)
 
 # ============================
 # ЗАПУСК БОТА
 # ============================
 
+def instrumented_classes():
+    """Классы Application и HTTPXRequest с замером времени обработки обновлений
+    и запросов к Bot API (telegram импортируется только при запуске бота)"""
+    from telegram.ext import Application
+    from telegram.request import HTTPXRequest
+    
+    class InstrumentedApplication(Application):
+        async def process_update(self, update):
+            with metrics.timer('bot_update_seconds'):
+                await super().process_update(update)
+    
+    class InstrumentedRequest(HTTPXRequest):
+        async def do_request(self, url, method, request_data=None, **kwargs):
+            api_method = url.rsplit('/', 1)[-1]
+            started = time.perf_counter()
+            status = 'error'
+            try:
+                status, payload = await super().do_request(url, method, request_data, **kwargs)
+                return status, payload
+            finally:
+                metrics.observe('bot_telegram_api_seconds', time.perf_counter() - started, method=api_method)
+                metrics.inc('bot_telegram_api_requests_total', method=api_method, status=status)
+    
+    return InstrumentedApplication, InstrumentedRequest
+
+class UserLocks:
+    """Блокировки по пользователям: обновления одного пользователя обрабатываются
+    по очереди, разных — параллельно. Блокировка удаляется, когда ее никто не держит и не ждет"""
+    
+    def __init__(self):
+        # user_id -> [asyncio.Lock, число держащих и ожидающих]
+        self._locks = {}
+    
+    def __len__(self):
+        return len(self._locks)
+    
+    @asynccontextmanager
+    async def hold(self, user_id: int):
+        """Выполнение блока, когда закончатся предыдущие обновления пользователя"""
+        entry = self._locks.get(user_id)
+        if entry is None:
+            entry = self._locks[user_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[user_id]
+
+user_locks = UserLocks()
+
+def user_update_processor(max_concurrent_updates: int):
+    """Обработчик очереди обновлений: до max_concurrent_updates одновременно, но обработчики
+    одного пользователя не пересекаются (чтение и запись рабочего дня, состояние диалога)"""
+    from telegram.ext import BaseUpdateProcessor
+    
+    class UserUpdateProcessor(BaseUpdateProcessor):
+        async def do_process_update(self, update, coroutine):
+            user = getattr(update, 'effective_user', None)
+            if user is None:
+                await coroutine
+                return
+            async with user_locks.hold(user.id):
+                await coroutine
+        
+        async def initialize(self):
+            pass
+        
+        async def shutdown(self):
+            pass
+    
+    return UserUpdateProcessor(max_concurrent_updates)
+
+async def start_background(application, schema=None, started=None):
+    """Запуск очереди исходящих сообщений и планировщика после инициализации бота.
+    Обновления начинают обрабатываться только после проверки схемы базы,
+    которая шла параллельно с импортом telegram и подключением к Bot API"""
+    if schema is not None and not await asyncio.wrap_future(schema):
+        # Обработчики без схемы базы не работают: запуск прерывается, процесс завершается
+        # с ошибкой и перезапускается оркестратором, а /ready до этого отвечает 503
+        raise RuntimeError("база данных не готова, обновления не принимаются")
+    if OUTBOUND_QUEUE:
+        sender.start(application.bot)
+        print(f"✅ Очередь исходящих сообщений: {OUTBOUND_GLOBAL_RATE:g}/с всего, {OUTBOUND_CHAT_RATE:g}/с на чат")
+    schedule_jobs(await adb.get_user_zones())
+    if scheduler.jobs():
+        scheduler.start(application.bot)
+        for name, run_at in scheduler.jobs():
+            print(f"⏰ Задача {name}: следующий запуск {run_at:%d.%m.%Y %H:%M}")
+    
+    readiness.finish('telegram', True, time.perf_counter() - started if started else None)
+    readiness.record('ready', time.perf_counter() - IMPORT_STARTED)
+    print(f"✅ Бот готов к работе: {readiness.status()['startup_seconds']}")
+
+async def stop_background(application):
+    """Остановка планировщика и отправка оставшихся сообщений до закрытия соединений бота"""
+    if scheduler.running:
+        await scheduler.stop()
+    if sender.running:
+        await sender.stop()
+
+async def shutdown(application):
+    """Сброс отложенной записи и закрытие соединений с базой после остановки"""
+    await asyncio.to_thread(adb.close)
+
+def build_application(schema=None, started=None):
+    """Приложение telegram с обработчиками бота (telegram импортируется только здесь).
+    schema — Future проверки схемы базы, которого дожидается post_init"""
+    from telegram.ext import Application, MessageHandler, filters, CallbackQueryHandler
+    keyboards.build()
+    if started is not None:
+        readiness.record('telegram_import', time.perf_counter() - started)
+    
+    # Создаем приложение с ограничением на число одновременно обрабатываемых обновлений;
+    # обновления одного пользователя обрабатываются по очереди
+    application_class, request_class = instrumented_classes()
+    builder = (
+        Application.builder()
+        .application_class(application_class)
+        .token(BOT_TOKEN)
+        .request(request_class(connection_pool_size=TELEGRAM_POOL_SIZE))
+        .get_updates_request(request_class())
+        .concurrent_updates(user_update_processor(CONCURRENT_UPDATES))
+        .post_init(functools.partial(start_background, schema=schema, started=started))
+        .post_stop(stop_background)
+        .post_shutdown(shutdown)
+    )
+    if TELEGRAM_API_URL:
+        builder = builder.base_url(TELEGRAM_API_URL)
+    application = builder.build()
+    
+    # Кнопки и свободный текст: один обработчик с поиском по словарю и состоянием пользователя.
+    # Только новые сообщения: у отредактированных update.message пустой
+    application.add_handler(MessageHandler(
+        filters.UpdateType.MESSAGE & filters.TEXT & ~filters.COMMAND, route_text))
+    
+    # Команды: один обработчик с поиском по словарю
+    application.add_handler(MessageHandler(filters.UpdateType.MESSAGE & filters.COMMAND, route_command))
+    
+    # Обработчики callback для перезаписи времени
+    application.add_handler(CallbackQueryHandler(timed_handler(handle_overwrite_callback), pattern="^overwrite_|^cancel_overwrite"))
+    
+    # Перелистывание результатов поиска
+    application.add_handler(CallbackQueryHandler(timed_handler(handle_search_callback), pattern="^search_page_"))
+    return application
+
 def main():
     """Запуск бота на Railway"""
+    if not BOT_TOKEN:
+        logging.error("❌ BOT_TOKEN не найден! Проверьте переменные окружения на Railway.")
+        exit(1)
+    
+    # Метрики и пробы поднимаются первыми: /health отвечает, пока бот запускается
+    if METRICS_PORT:
+        start_metrics_server(METRICS_PORT)
+    if HEALTH_PORT and HEALTH_PORT != METRICS_PORT:
+        start_metrics_server(HEALTH_PORT)
+    if METRICS_LOG_INTERVAL > 0:
+        start_metrics_logger(METRICS_LOG_INTERVAL)
+    
+    # Схема базы проверяется в отдельном потоке, пока импортируется telegram и бот подключается к Bot API
+    started = time.perf_counter()
+    schema = start_check('schema', db.migrate)
+    
     try:
-        from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackQueryHandler
-        
-        # Создаем Updater с токеном
-        updater = Updater(BOT_TOKEN, use_context=True)
-        dispatcher = updater.dispatcher
-        
-        # Добавляем обработчики кнопок
-        dispatcher.add_handler(MessageHandler(Filters.regex("🟢 Начало рабочего дня"), start_work_day))
-        dispatcher.add_handler(MessageHandler(Filters.regex("🔴 Конец рабочего дня"), end_work_day))
-        dispatcher.add_handler(MessageHandler(Filters.regex("📝 Добавить действие"), add_action_start))
-        dispatcher.add_handler(MessageHandler(Filters.regex("📅 Сегодня"), today_info))
-        
-        # Обработчик для добавления действий (любое текстовое сообщение)
-        dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.command, add_action_complete))
-        
-        # Обработчики callback для перезаписи времени
-        dispatcher.add_handler(CallbackQueryHandler(handle_overwrite_callback, pattern="^overwrite_|^cancel_overwrite"))
-        
-        # Добавляем обработчики команд
-        dispatcher.add_handler(CommandHandler("start", start))
-        dispatcher.add_handler(CommandHandler("today", today_info))
-        dispatcher.add_handler(CommandHandler("reset_today", reset_today))
-        dispatcher.add_handler(CommandHandler("add_action", add_action_start))
+        application = build_application(schema, started)
         
         print("🚀 Бот запускается на Railway...")
+        print(f"✅ Одновременно обрабатывается до {CONCURRENT_UPDATES} обновлений (от одного пользователя — по очереди)")
         
-        # Запускаем бота
-        updater.start_polling()
-        print("✅ Бот успешно запущен и работает!")
-        updater.idle()
+        # Запускаем бота (блокирует до остановки, затем вызывает shutdown)
+        if WEBHOOK_URL:
+            if not WEBHOOK_SECRET:
+                logging.warning("⚠️ WEBHOOK_SECRET не задан: входящие запросы не проверяются!")
+            webhook_url = f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}"
+            print(f"🌐 Режим webhook: {webhook_url} (слушаем {WEBHOOK_LISTEN}:{PORT})")
+            application.run_webhook(
+                listen=WEBHOOK_LISTEN,
+                port=PORT,
+                url_path=WEBHOOK_PATH,
+                webhook_url=webhook_url,
+                secret_token=WEBHOOK_SECRET
+            )
+        else:
+            application.run_polling()
         
     except Exception as e:
         logging.error(f"❌ Ошибка при запуске бота: {e}")
+        exit(1)
+
+readiness.record('import', time.perf_counter() - IMPORT_STARTED)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,60 @@
+"""
+Выгрузка истории рабочего времени из базы бота в CSV или XLSX.
+
+Использует ту же базу, что и бот (DB_PATH или DATABASE_URL для PostgreSQL).
+Строки читаются потоково и записываются в файлы по --chunk-rows строк,
+поэтому расход памяти не зависит от объема истории.
+
+Примеры:
+    python export.py --from 2024-01-01 --to 2024-12-31
+    python export.py --user 123456789 --format xlsx --out-dir exports
+"""
+
+import argparse
+import logging
+import os
+import sys
+from datetime import date
+
+import bot
+
+def main():
+    """Запуск выгрузки из командной строки"""
+    parser = argparse.ArgumentParser(description="Выгрузка истории рабочего времени")
+    parser.add_argument('--from', dest='start_date', default='1970-01-01',
+                        help="Начало периода (ДД.ММ.ГГГГ или ГГГГ-ММ-ДД)")
+    parser.add_argument('--to', dest='end_date', default=date.today().isoformat(),
+                        help="Конец периода (ДД.ММ.ГГГГ или ГГГГ-ММ-ДД)")
+    parser.add_argument('--user', type=int, help="ID пользователя (по умолчанию — вся команда)")
+    parser.add_argument('--format', choices=sorted(bot.EXPORT_WRITERS), default='csv')
+    parser.add_argument('--out-dir', default='.', help="Каталог для файлов выгрузки")
+    parser.add_argument('--chunk-rows', type=int, default=bot.EXPORT_CHUNK_ROWS,
+                        help="Максимум строк в одном файле")
+    args = parser.parse_args()
+
+    start_date, end_date = bot.parse_date(args.start_date), bot.parse_date(args.end_date)
+    if not start_date or not end_date or start_date > end_date:
+        parser.error("Некорректный период")
+    if args.format == 'xlsx' and not bot.xlsx_available():
+        parser.error("Для экспорта в XLSX установите openpyxl")
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    if not bot.db.migrate():
+        sys.exit("❌ База данных недоступна")
+    try:
+        paths = bot.export_history(
+            args.out_dir, args.format, start_date.isoformat(), end_date.isoformat(),
+            args.user, args.chunk_rows
+        )
+    finally:
+        bot.db.close()
+
+    if not paths:
+        logging.info("❌ За этот период нет данных")
+        return 1
+    for path in paths:
+        print(path)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,284 @@
+"""
+Локальная замена Telegram Bot API для проверки бота без сети.
+
+Сервер отвечает на основные методы Bot API (getMe, setWebhook, getUpdates,
+sendMessage, editMessageText, sendDocument, answerCallbackQuery) и печатает
+ответы бота. Строки, введенные в консоль, отправляются боту как сообщения
+пользователя: если бот зарегистрировал webhook — POST-запросом с секретным
+заголовком, иначе через getUpdates. Строка вида "cb:<data>" отправляет
+нажатие inline-кнопки.
+
+В тестах FakeTelegram запускается фикстурой fake_telegram (tests/conftest.py):
+start() поднимает сервер на свободном порту, адрес для TELEGRAM_API_URL — в url.
+
+Запуск из консоли:
+    python fake_telegram.py --port 8081
+    TELEGRAM_API_URL=http://localhost:8081/bot BOT_TOKEN=1:fake \\
+        WEBHOOK_URL=http://localhost:8443 WEBHOOK_SECRET=secret python bot.py
+"""
+
+import argparse
+import email.parser
+import email.policy
+import itertools
+import json
+import logging
+import threading
+import time
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+
+# Максимальное время ожидания в getUpdates, чтобы не держать соединение долго
+MAX_POLL_TIMEOUT = 1.0
+
+def parse_value(value: str):
+    """Значение параметра: JSON (числа, объекты) или строка как есть"""
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+def parse_multipart(content_type: str, body: bytes):
+    """Тело multipart/form-data -> (параметры, файлы {поле: (имя файла, байты)})"""
+    message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+        f'Content-Type: {content_type}\r\n\r\n'.encode() + body
+    )
+    params, files = {}, {}
+    for part in message.iter_parts():
+        name = part.get_param('name', header='content-disposition')
+        data = part.get_payload(decode=True)
+        if part.get_filename() is not None:
+            files[name] = (part.get_filename(), data)
+        else:
+            params[name] = parse_value(data.decode())
+    return params, files
+
+class FakeTelegram:
+    """Состояние поддельного Bot API: webhook, очередь обновлений и ответы бота"""
+
+    def __init__(self, user_id: int = 1, first_name: str = "Тест"):
+        self.user = {'id': user_id, 'is_bot': False, 'first_name': first_name}
+        self.chat = {'id': user_id, 'type': 'private', 'first_name': first_name}
+        self.webhook_url = None
+        self.webhook_secret = None
+        self.url = None
+        self.sent = []
+        # Файлы, отправленные ботом: (имя файла, содержимое)
+        self.documents = []
+        self._server = None
+        self._updates = []
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._cond = threading.Condition()
+
+    def _message(self, text, from_user, **extra):
+        """Объект Message в формате Bot API"""
+        message = {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': self.chat,
+            'from': from_user,
+            'text': text
+        }
+        message.update(extra)
+        return message
+
+    def start(self, host: str = '127.0.0.1', port: int = 0):
+        """Запуск HTTP-сервера в фоновом потоке (порт 0 — любой свободный)"""
+        self._server = ThreadingHTTPServer((host, port), make_handler(self))
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        self.url = f"http://{host}:{self._server.server_address[1]}/bot"
+        return self.url
+
+    def stop(self):
+        """Остановка HTTP-сервера"""
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def wait_for(self, predicate, timeout: float = 5.0):
+        """Ожидание, пока predicate() станет истинным (ответы бота приходят асинхронно)"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while not predicate():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+    def push_text(self, text: str, secret: str = None):
+        """Отправка боту текстового сообщения от пользователя"""
+        extra = {}
+        if text.startswith('/'):
+            command = text.split()[0]
+            extra['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]
+        return self.push_update({'message': self._message(text, self.user, **extra)}, secret)
+
+    def push_callback(self, data: str):
+        """Отправка боту нажатия inline-кнопки"""
+        bot_user = {'id': 0, 'is_bot': True, 'first_name': 'bot'}
+        return self.push_update({'callback_query': {
+            'id': str(next(self._update_ids)),
+            'from': self.user,
+            'chat_instance': '1',
+            'message': self._message('', bot_user),
+            'data': data
+        }})
+
+    def push_update(self, payload: dict, secret: str = None):
+        """Доставка обновления через webhook или очередь getUpdates.
+        secret заменяет зарегистрированный секрет ('' — запрос без заголовка).
+        Возвращает HTTP-статус ответа webhook (None при доставке через getUpdates)"""
+        update = {'update_id': next(self._update_ids), **payload}
+        if self.webhook_url:
+            request = urllib.request.Request(
+                self.webhook_url,
+                data=json.dumps(update).encode(),
+                headers={'Content-Type': 'application/json'}
+            )
+            secret = self.webhook_secret if secret is None else secret
+            if secret:
+                request.add_header('X-Telegram-Bot-Api-Secret-Token', secret)
+            try:
+                with urllib.request.urlopen(request, timeout=10) as response:
+                    response.read()
+                    return response.status
+            except urllib.error.HTTPError as e:
+                return e.code
+        with self._cond:
+            self._updates.append(update)
+            self._cond.notify_all()
+
+    def get_updates(self, offset: int, timeout: float):
+        """Метод getUpdates с коротким long polling"""
+        deadline = time.monotonic() + min(timeout, MAX_POLL_TIMEOUT)
+        with self._cond:
+            self._updates = [u for u in self._updates if u['update_id'] >= offset]
+            while not self._updates:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            return list(self._updates)
+
+    def call(self, method: str, params: dict, files: dict = None):
+        """Обработка вызова метода Bot API"""
+        if method == 'getMe':
+            return {'id': 0, 'is_bot': True, 'first_name': 'bot', 'username': 'fake_bot',
+                    'can_join_groups': False, 'can_read_all_group_messages': False,
+                    'supports_inline_queries': False}
+        if method == 'setWebhook':
+            self.webhook_url = params.get('url') or None
+            self.webhook_secret = params.get('secret_token')
+            logging.info(f"🌐 Webhook: {self.webhook_url}")
+            return True
+        if method == 'deleteWebhook':
+            self.webhook_url = None
+            self.webhook_secret = None
+            return True
+        if method == 'getUpdates':
+            return self.get_updates(int(params.get('offset') or 0), float(params.get('timeout') or 0))
+        bot_user = {'id': 0, 'is_bot': True, 'first_name': 'bot'}
+        if method in ('sendMessage', 'editMessageText'):
+            with self._cond:
+                self.sent.append((method, params))
+                self._cond.notify_all()
+            print(f"\n🤖 {params.get('text')}\n")
+            return self._message(params.get('text'), bot_user)
+        if method == 'sendDocument':
+            filename, data = (files or {}).get('document') or (None, b'')
+            with self._cond:
+                self.sent.append((method, params))
+                self.documents.append((filename, data))
+                self._cond.notify_all()
+            print(f"\n📎 {filename} ({len(data)} байт)\n")
+            file_id = f"file{len(self.documents)}"
+            return self._message(None, bot_user, document={
+                'file_id': file_id, 'file_unique_id': file_id,
+                'file_name': filename, 'file_size': len(data)
+            })
+        if method in ('answerCallbackQuery', 'close', 'logOut'):
+            return True
+        raise KeyError(method)
+
+def make_handler(fake: FakeTelegram):
+    """HTTP-обработчик запросов вида /bot<token>/<method>"""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            body = self.rfile.read(length) if length else b''
+            content_type = self.headers.get('Content-Type', '')
+            files = {}
+            if content_type.startswith('application/json'):
+                params = json.loads(body or b'{}')
+            elif content_type.startswith('multipart/form-data'):
+                params, files = parse_multipart(content_type, body)
+            else:
+                params = {key: parse_value(value) for key, value in parse_qsl(body.decode())}
+
+            method = self.path.rstrip('/').rsplit('/', 1)[-1]
+            try:
+                response = {'ok': True, 'result': fake.call(method, params, files)}
+                status = 200
+            except KeyError:
+                response = {'ok': False, 'error_code': 404, 'description': f'Not Found: {method}'}
+                status = 404
+
+            data = json.dumps(response).encode()
+            try:
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+            except (BrokenPipeError, ConnectionResetError):
+                # Бот остановился, не дождавшись ответа на long polling
+                pass
+
+        do_GET = do_POST
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+def main():
+    """Запуск поддельного Bot API с вводом сообщений из консоли"""
+    parser = argparse.ArgumentParser(description="Локальная замена Telegram Bot API")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    args = parser.parse_args()
+
+    fake = FakeTelegram()
+    print(f"🚀 Fake Telegram: {fake.start(args.host, args.port)}")
+    print("Введите сообщение (или cb:<data> для inline-кнопки), Ctrl+D для выхода")
+
+    try:
+        while True:
+            line = input().strip()
+            if not line:
+                continue
+            try:
+                if line.startswith('cb:'):
+                    fake.push_callback(line[3:])
+                else:
+                    fake.push_text(line)
+            except OSError as e:
+                logging.error(f"❌ Не удалось доставить обновление: {e}")
+    except (EOFError, KeyboardInterrupt):
+        pass
+    finally:
+        fake.stop()
+
+if __name__ == '__main__':
+    main()
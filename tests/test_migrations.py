@@ -0,0 +1,47 @@
+"""Обновление схемы SQLite с уже накопленными данными"""
+
+import pytest
+
+import bot
+
+ACTIONS = ["Установка розеток", "Замена щитка", "Прокладка кабеля ВВГнг", "Монтаж розеток на кухне", "Демонтаж"]
+
+@pytest.fixture
+def database_v8(tmp_path, monkeypatch):
+    """База на версии 8 с действиями; пачки миграций по 2 строки"""
+    migrations = bot.MIGRATIONS
+    monkeypatch.setattr(bot, 'MIGRATION_BATCH_SIZE', 2)
+    monkeypatch.setattr(bot, 'MIGRATIONS', [m for m in migrations if m[0] <= 8])
+    database = bot.Database(bot.SQLiteStorage(str(tmp_path / 'test.db')), write_behind=False)
+    assert database.migrate()
+    database.storage.write([
+        ('INSERT INTO work_actions (user_id, day, action_description, created_at) VALUES (?, ?, ?, ?)',
+         (1, 20000, action, i)) for i, action in enumerate(ACTIONS)
+    ])
+    monkeypatch.setattr(bot, 'MIGRATIONS', migrations)
+    yield database
+    database.close()
+
+def found(database, query):
+    return [hit[2] for hit in database.search_actions(1, query, 10)]
+
+def test_search_terms_are_backfilled_in_batches(database_v8):
+    assert database_v8.migrate()
+
+    assert database_v8.storage.fetchone('PRAGMA user_version')[0] == 9
+    assert found(database_v8, "розетки") == ["Установка розеток", "Монтаж розеток на кухне"]
+    assert found(database_v8, "щиток") == ["Замена щитка"]
+    # Новые действия попадают в индекс через триггеры
+    database_v8.add_work_task(1, bot.day_to_date(20000), "Замена розетки")
+    assert len(found(database_v8, "розетки")) == 3
+
+def test_search_terms_migration_resumes_after_interruption(database_v8):
+    # Прерванная миграция: колонка уже добавлена и частично заполнена
+    database_v8.storage.write([
+        ('ALTER TABLE work_actions ADD COLUMN search_terms TEXT', ()),
+        ('UPDATE work_actions SET search_terms = ? WHERE id = 1', (bot.search_terms(ACTIONS[0]),)),
+    ])
+    assert database_v8.migrate()
+
+    assert found(database_v8, "розетки") == ["Установка розеток", "Монтаж розеток на кухне"]
+    assert found(database_v8, "кабель") == ["Прокладка кабеля ВВГнг"]
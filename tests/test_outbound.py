@@ -0,0 +1,52 @@
+"""Прямые вызовы Bot API через ограничители очереди исходящих сообщений"""
+
+import asyncio
+import time
+
+import pytest
+
+import bot
+
+pytest.importorskip('telegram')
+
+def test_call_waits_for_chat_tokens():
+    sender = bot.OutboundSender(global_rate=1000, chat_rate=20, chat_burst=1, workers=1)
+    calls = []
+
+    async def request():
+        calls.append(time.monotonic())
+        return len(calls)
+
+    async def scenario():
+        return [await sender.call(1, request) for _ in range(3)]
+
+    assert asyncio.run(scenario()) == [1, 2, 3]
+    # Второй и третий вызов ждут по токену чата (20 в секунду)
+    assert calls[2] - calls[0] >= 0.09
+
+def test_call_retries_after_retry_after():
+    from telegram.error import RetryAfter
+
+    sender = bot.OutboundSender(global_rate=1000, chat_rate=1000, chat_burst=10, workers=1)
+    calls = []
+
+    async def request():
+        calls.append(time.monotonic())
+        if len(calls) == 1:
+            raise RetryAfter(0.05)
+        return 'ok'
+
+    assert asyncio.run(sender.call(1, request)) == 'ok'
+    assert len(calls) == 2 and calls[1] - calls[0] >= 0.05
+
+def test_call_gives_up_after_max_attempts(monkeypatch):
+    from telegram.error import RetryAfter
+
+    monkeypatch.setattr(bot, 'OUTBOUND_MAX_ATTEMPTS', 2)
+    sender = bot.OutboundSender(global_rate=1000, chat_rate=1000, chat_burst=10, workers=1)
+
+    async def request():
+        raise RetryAfter(0.01)
+
+    with pytest.raises(RetryAfter):
+        asyncio.run(sender.call(1, request))
@@ -0,0 +1,37 @@
+"""Время запуска ежедневных задач в поясе пользователя"""
+
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+import bot
+
+def local(ts: int, tz: str):
+    return datetime.fromtimestamp(ts, ZoneInfo(tz)).strftime('%Y-%m-%d %H:%M')
+
+def test_next_daily_run_uses_time_zone():
+    after = int(datetime(2026, 3, 2, 12, 0, tzinfo=ZoneInfo('UTC')).timestamp())
+    # В UTC+10 09:00 уже прошло: следующий запуск завтра в 09:00 по Владивостоку
+    assert local(bot.next_daily_run(9 * 60, after, 'Asia/Vladivostok'), 'Asia/Vladivostok') == '2026-03-03 09:00'
+    assert local(bot.next_daily_run(19 * 60, after, 'Europe/Moscow'), 'Europe/Moscow') == '2026-03-02 19:00'
+
+def test_next_daily_run_across_daylight_saving_change():
+    after = int(datetime(2026, 3, 28, 12, 0, tzinfo=ZoneInfo('Europe/Berlin')).timestamp())
+    first = bot.next_daily_run(9 * 60, after, 'Europe/Berlin')
+    second = bot.next_daily_run(9 * 60, first, 'Europe/Berlin')
+    assert local(first, 'Europe/Berlin') == '2026-03-29 09:00'
+    assert local(second, 'Europe/Berlin') == '2026-03-30 09:00'
+    # Ночь перевода часов на час короче
+    assert first - after == 20 * 3600
+    assert second - first == 24 * 3600
+
+def test_scheduler_registers_each_zone_once():
+    scheduler = bot.Scheduler()
+
+    async def job(bot_instance):
+        pass
+
+    scheduler.add_daily('remind_start:UTC', '09:00', job, 'UTC')
+    scheduler.add_daily('remind_start:UTC', '09:00', job, 'UTC')
+    scheduler.add_daily('remind_start:Asia/Tokyo', '09:00', job, 'Asia/Tokyo')
+    assert sorted(name for name, _ in scheduler.jobs()) == ['remind_start:Asia/Tokyo', 'remind_start:UTC']
+    assert all(run_at.strftime('%H:%M') == '09:00' for _, run_at in scheduler.jobs())
@@ -0,0 +1,162 @@
+"""Сценарии Database, общие для SQLite и PostgreSQL"""
+
+import bot
+
+DAY = '2026-03-02'
+NEXT_DAY = '2026-03-03'
+MONTH = 202603
+
+def at(work_date: str, hhmm: str, tz: str = 'UTC'):
+    """Момент в секундах UTC по местной дате и времени"""
+    return bot.local_to_ts(bot.date_to_day(work_date), bot.time_to_minutes(hhmm), tz)
+
+def schema_version(storage):
+    """Текущая версия схемы хранилища"""
+    if isinstance(storage, bot.SQLiteStorage):
+        return storage.fetchone('PRAGMA user_version')[0]
+    return storage.fetchone('SELECT MAX(version) FROM schema_version')[0]
+
+def expected_version(storage):
+    migrations = bot.MIGRATIONS if isinstance(storage, bot.SQLiteStorage) else bot.PG_MIGRATIONS
+    return migrations[-1][0]
+
+def test_migrate_is_idempotent(database):
+    assert schema_version(database.storage) == expected_version(database.storage)
+    assert database.migrate()
+    assert schema_version(database.storage) == expected_version(database.storage)
+
+def test_work_day_upsert_updates_rollups(database):
+    database.add_work_day(1, DAY, at(DAY, '09:00'))
+    database.add_work_day(1, DAY, at(DAY, '09:00'), at(DAY, '18:00'))
+
+    assert database.get_work_day(1, DAY)['end_at'] == at(DAY, '18:00')
+    assert list(database.iter_period_report(1, DAY, DAY)) == [
+        (DAY, at(DAY, '09:00'), at(DAY, '18:00'), 540, 540 - bot.LUNCH_MINUTES, 0)
+    ]
+    assert [tuple(row) for row in database.get_monthly_totals(1, MONTH, MONTH)] == [
+        (MONTH, 1, 540, 540 - bot.LUNCH_MINUTES)
+    ]
+
+def test_marked_breaks_replace_lunch_in_rollups(database):
+    database.add_work_day(1, DAY, at(DAY, '09:00'), at(DAY, '18:00'), break_min=25)
+
+    (row,) = database.iter_period_report(1, DAY, DAY)
+    assert row[3:5] == (540, 515)
+
+def test_overnight_shift_and_reset_day(database):
+    database.add_work_day(1, DAY, at(DAY, '22:00'), at(NEXT_DAY, '06:00'))
+    assert [tuple(row) for row in database.get_monthly_totals(1, MONTH, MONTH)] == [
+        (MONTH, 1, 480, 480 - bot.LUNCH_MINUTES)
+    ]
+
+    database.reset_day(1, DAY)
+    assert database.get_work_day(1, DAY) is None
+    assert database.get_monthly_totals(1, MONTH, MONTH) == []
+
+def test_period_report_counts_actions(database):
+    database.add_work_day(1, DAY, at(DAY, '09:00'), at(DAY, '17:00'))
+    database.add_work_task(1, DAY, "Монтаж щитка")
+    database.add_work_task(1, DAY, "Прокладка кабеля")
+    # Действие в день без отметок тоже попадает в отчет
+    database.add_work_task(1, NEXT_DAY, "Замена розетки")
+    database.add_work_task(2, DAY, "Чужое действие")
+
+    assert list(database.iter_period_report(1, DAY, NEXT_DAY)) == [
+        (DAY, at(DAY, '09:00'), at(DAY, '17:00'), 480, 480 - bot.LUNCH_MINUTES, 2),
+        (NEXT_DAY, None, None, 0, 0, 1),
+    ]
+    assert database.get_work_tasks(1, DAY) == ["Монтаж щитка", "Прокладка кабеля"]
+
+def test_search_actions_matches_word_forms_of_own_actions(database):
+    database.add_work_task(1, DAY, "Прокладка кабеля ВВГнг 3x2.5")
+    database.add_work_task(1, NEXT_DAY, "Подключение щитка освещения")
+    database.add_work_task(2, DAY, "Прокладка кабеля в подвале")
+
+    hits = database.search_actions(1, "кабель", 10)
+    assert [(work_date, action) for work_date, _, action in hits] == [(DAY, "Прокладка кабеля ВВГнг 3x2.5")]
+    assert database.search_actions(1, "подключения освещение", 10)[0][2] == "Подключение щитка освещения"
+    assert database.search_actions(1, "перфоратор", 10) == []
+    assert database.search_actions(1, "!!!", 10) == []
+
+def test_search_actions_matches_fleeting_vowels(database):
+    database.add_work_task(1, DAY, "Установка розеток")
+    database.add_work_task(1, DAY, "Замена щитка")
+
+    assert [hit[2] for hit in database.search_actions(1, "розетки", 10)] == ["Установка розеток"]
+    assert [hit[2] for hit in database.search_actions(1, "щиток", 10)] == ["Замена щитка"]
+
+def test_search_actions_pages(database):
+    for i in range(5):
+        database.add_work_task(1, DAY, f"Монтаж розеток, этап {i}")
+
+    first = database.search_actions(1, "монтаж", 3, 0)
+    second = database.search_actions(1, "монтаж", 3, 3)
+    assert len(first) == 3 and len(second) == 2
+    assert not {hit[2] for hit in first} & {hit[2] for hit in second}
+
+def test_iter_export_streams_rows_with_time_zone(database):
+    database.set_timezone(1, 'Asia/Tokyo')
+    database.add_work_day(1, DAY, at(DAY, '09:00', 'Asia/Tokyo'), at(DAY, '18:00', 'Asia/Tokyo'))
+    database.add_work_task(1, DAY, "Монтаж щитка")
+    database.add_work_task(2, NEXT_DAY, "Замена розетки")
+
+    rows = list(database.iter_export(DAY, NEXT_DAY, batch_size=1))
+    assert [(row[0], row[1], row[7], row[8]) for row in rows] == [
+        (1, DAY, "Монтаж щитка", 'Asia/Tokyo'),
+        (2, NEXT_DAY, "Замена розетки", bot.zone_name(None)),
+    ]
+    assert rows[0][2:6] == (at(DAY, '09:00', 'Asia/Tokyo'), at(DAY, '18:00', 'Asia/Tokyo'),
+                            540, 540 - bot.LUNCH_MINUTES)
+    assert [row[0] for row in database.iter_export(DAY, NEXT_DAY, user_id=2)] == [2]
+
+def test_close_open_days(database):
+    for user_id in (1, 2, 3):
+        database.register_user(user_id)
+    database.add_work_day(1, DAY, at(DAY, '09:00'))
+    database.add_work_day(2, NEXT_DAY, at(NEXT_DAY, '19:30'))
+    database.add_work_day(3, DAY, at(DAY, '09:00'), at(DAY, '17:00'))
+    now = at(NEXT_DAY, '21:00')
+
+    closed = database.close_open_days(now, '20:00', 8 * 3600)
+    assert closed == [(1, DAY, at(DAY, '09:00'), at(DAY, '20:00'), bot.zone_name(None), True)]
+    # Смена, начатая меньше grace назад, и уже закрытая смена не меняются
+    assert database.get_work_day(2, NEXT_DAY)['end_at'] is None
+    assert database.get_work_day(3, DAY)['end_at'] == at(DAY, '17:00')
+    assert database.close_open_days(now, '20:00', 8 * 3600) == []
+    assert database.get_open_day_users(NEXT_DAY, bot.DEFAULT_TZ) == [2]
+    assert sorted(database.get_users_without_day(DAY, bot.DEFAULT_TZ)) == [2]
+
+def test_close_open_days_reports_disabled_reminders(database):
+    database.register_user(1)
+    database.set_reminders(1, False)
+    database.add_work_day(1, DAY, at(DAY, '09:00'))
+
+    (closed,) = database.close_open_days(at(NEXT_DAY, '21:00'), '20:00', 8 * 3600)
+    assert closed[0] == 1 and closed[-1] is False
+
+def test_reminder_queries_filter_by_time_zone(database):
+    for user_id in (1, 2):
+        database.register_user(user_id)
+    database.set_timezone(2, 'Asia/Vladivostok')
+
+    assert database.get_users_without_day(DAY, bot.DEFAULT_TZ) == [1]
+    assert database.get_users_without_day(DAY, 'Asia/Vladivostok') == [2]
+    assert database.get_user_zones() == sorted({bot.DEFAULT_TZ, 'Asia/Vladivostok'})
+
+    database.add_work_day(2, DAY, at(DAY, '09:00', 'Asia/Vladivostok'))
+    assert database.get_open_day_users(DAY, 'Asia/Vladivostok') == [2]
+    assert database.get_open_day_users(DAY, bot.DEFAULT_TZ) == []
+
+def test_dialog_state_is_consumed_once(database):
+    assert database.pop_state(1) == bot.STATE_IDLE
+    database.set_state(1, bot.STATE_AWAITING_ACTION)
+    assert database.pop_state(1) == bot.STATE_AWAITING_ACTION
+    assert database.pop_state(1) == bot.STATE_IDLE
+
+    database.set_search_query(1, "кабель")
+    assert database.get_search_query(1) == "кабель"
+
+def test_job_run_is_claimed_once(database):
+    assert database.claim_job_run('remind_start', 1000, 100)
+    assert not database.claim_job_run('remind_start', 1000, 100)
+    assert database.claim_job_run('remind_end', 1000, 100)
@@ -0,0 +1,30 @@
+"""Очередность обработки обновлений одного пользователя"""
+
+import asyncio
+
+import bot
+
+async def run_updates(locks, user_ids):
+    """Запуск обработчиков с паузой внутри; возвращает порядок событий"""
+    events = []
+
+    async def handle(n, user_id):
+        async with locks.hold(user_id):
+            events.append(('start', n))
+            await asyncio.sleep(0.01)
+            events.append(('end', n))
+
+    await asyncio.gather(*(handle(n, user_id) for n, user_id in enumerate(user_ids)))
+    return events
+
+def test_updates_of_one_user_do_not_overlap():
+    locks = bot.UserLocks()
+    events = asyncio.run(run_updates(locks, [1, 1, 1]))
+    assert events == [('start', 0), ('end', 0), ('start', 1), ('end', 1), ('start', 2), ('end', 2)]
+    assert len(locks) == 0
+
+def test_updates_of_different_users_run_concurrently():
+    locks = bot.UserLocks()
+    events = asyncio.run(run_updates(locks, [1, 2]))
+    assert events[:2] == [('start', 0), ('start', 1)]
+    assert len(locks) == 0
@@ -0,0 +1,107 @@
+"""Бот в режиме webhook против поддельного Bot API (fake_telegram.py)"""
+
+import asyncio
+import socket
+
+import pytest
+
+import bot
+
+pytest.importorskip('telegram')
+
+SECRET = 'secret'
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+@pytest.fixture
+def webhook_bot(fake_telegram, tmp_path, monkeypatch):
+    """Запуск приложения бота с webhook на свободном порту и временной базой SQLite"""
+    database = bot.Database(bot.SQLiteStorage(str(tmp_path / 'test.db')), write_behind=False)
+    assert database.migrate()
+    monkeypatch.setattr(bot, 'db', database)
+    monkeypatch.setattr(bot.adb, 'db', database)
+    monkeypatch.setattr(bot, 'user_timezones', {})
+    monkeypatch.setattr(bot, 'user_states', {})
+    monkeypatch.setattr(bot, 'BOT_TOKEN', '1:fake')
+    monkeypatch.setattr(bot, 'TELEGRAM_API_URL', fake_telegram.url)
+
+    async def run(scenario, outbound=False):
+        application = bot.build_application()
+        port = free_port()
+        await application.initialize()
+        await application.updater.start_webhook(
+            listen='127.0.0.1', port=port, url_path='webhook',
+            webhook_url=f'http://127.0.0.1:{port}/webhook', secret_token=SECRET
+        )
+        await application.start()
+        if outbound:
+            bot.sender.start(application.bot)
+        try:
+            await scenario()
+        finally:
+            if bot.sender.running:
+                await bot.sender.stop()
+            await application.updater.stop()
+            await application.stop()
+            await application.shutdown()
+
+    yield lambda scenario, outbound=False: asyncio.run(run(scenario, outbound))
+    database.close()
+
+def test_webhook_accepts_only_requests_with_secret(webhook_bot, fake_telegram):
+    async def scenario():
+        assert fake_telegram.webhook_secret == SECRET
+        assert await asyncio.to_thread(fake_telegram.push_text, '/start', 'wrong') == 403
+        assert await asyncio.to_thread(fake_telegram.push_text, '/start', '') == 403
+        assert await asyncio.to_thread(fake_telegram.push_text, '/start') == 200
+        assert await asyncio.to_thread(fake_telegram.wait_for, lambda: fake_telegram.sent)
+
+    webhook_bot(scenario)
+    assert len(fake_telegram.sent) == 1
+    method, params = fake_telegram.sent[0]
+    assert method == 'sendMessage' and 'Привет, Тест' in params['text']
+
+@pytest.mark.parametrize('local_state', [True, False], ids=['memory', 'database'])
+def test_action_is_saved_after_add_action_button(webhook_bot, fake_telegram, monkeypatch, local_state):
+    # Состояние диалога в памяти процесса или, как на общей базе реплик, в таблице users
+    monkeypatch.setattr(bot, 'LOCAL_STATE', local_state)
+
+    async def scenario():
+        for text in (bot.BUTTON_ADD_ACTION, "Монтаж щитка", "Случайный текст"):
+            assert await asyncio.to_thread(fake_telegram.push_text, text) == 200
+            count = len(fake_telegram.sent) + 1
+            assert await asyncio.to_thread(fake_telegram.wait_for, lambda: len(fake_telegram.sent) >= count)
+
+    webhook_bot(scenario)
+    replies = [params['text'] for _, params in fake_telegram.sent]
+    assert "Монтаж щитка" in replies[1] and replies[1].startswith("✅")
+    assert replies[2].startswith("🤔")
+    today = bot.local_today(bot.DEFAULT_TZ, bot.time.time())
+    assert bot.db.get_work_tasks(fake_telegram.user['id'], today) == ["Монтаж щитка"]
+
+def test_export_sends_document(webhook_bot, fake_telegram):
+    async def scenario():
+        await bot.adb.add_work_task(fake_telegram.user['id'], bot.local_today(bot.DEFAULT_TZ, 0), "Монтаж щитка")
+        assert await asyncio.to_thread(fake_telegram.push_text, '/export') == 200
+        assert await asyncio.to_thread(fake_telegram.wait_for, lambda: fake_telegram.documents)
+
+    webhook_bot(scenario)
+    filename, data = fake_telegram.documents[0]
+    assert filename.endswith('.csv')
+    assert "Монтаж щитка" in data.decode('utf-8-sig')
+
+def test_callback_goes_through_outbound_limits(webhook_bot, fake_telegram):
+    sent_before = bot.metrics._counters.get(('bot_outbound_sent_total', ()), 0)
+
+    async def scenario():
+        assert await asyncio.to_thread(fake_telegram.push_callback, 'cancel_overwrite') == 200
+        assert await asyncio.to_thread(fake_telegram.wait_for, lambda: fake_telegram.sent)
+
+    webhook_bot(scenario, outbound=True)
+    method, params = fake_telegram.sent[0]
+    assert method == 'editMessageText' and params['text'] == "❌ Операция отменена."
+    # Ответ на нажатие и правка сообщения прошли через ограничители очереди
+    assert bot.metrics._counters[('bot_outbound_sent_total', ())] == sent_before + 2
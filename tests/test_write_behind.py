@@ -0,0 +1,73 @@
+"""Очередь отложенной записи поверх SQLite"""
+
+import time
+
+import pytest
+
+import bot
+
+DAY = '2026-03-02'
+
+@pytest.fixture
+def make_database(tmp_path, monkeypatch):
+    """Database с отложенной записью и заданным интервалом сброса"""
+    opened = []
+
+    def make(flush_interval_ms: int):
+        monkeypatch.setattr(bot, 'DB_FLUSH_INTERVAL_MS', flush_interval_ms)
+        database = bot.Database(bot.SQLiteStorage(str(tmp_path / 'test.db')), write_behind=True)
+        assert database.migrate()
+        opened.append(database)
+        return database
+
+    yield make
+    for database in opened:
+        database.close()
+
+def stored_tasks(tmp_path):
+    """Действия, уже записанные в файл базы (минуя очередь)"""
+    storage = bot.SQLiteStorage(str(tmp_path / 'test.db'))
+    try:
+        return [row[0] for row in storage.fetchall('SELECT action_description FROM work_actions')]
+    finally:
+        storage.close()
+
+def test_single_write_is_flushed_on_timer(make_database, tmp_path):
+    database = make_database(50)
+    database.add_work_task(1, DAY, "Монтаж щитка")
+
+    deadline = time.monotonic() + 2
+    while database.writer.pending_count() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert database.writer.pending_count() == 0
+    assert stored_tasks(tmp_path) == ["Монтаж щитка"]
+
+def test_read_sees_own_pending_writes(make_database):
+    database = make_database(60_000)
+    database.add_work_task(1, DAY, "Монтаж щитка")
+    assert database.writer.pending_count() == 1
+
+    assert database.get_work_tasks(1, DAY) == ["Монтаж щитка"]
+    assert database.writer.pending_count() == 0
+
+def test_close_flushes_pending_writes(make_database, tmp_path):
+    database = make_database(60_000)
+    database.add_work_task(1, DAY, "Монтаж щитка")
+    database.add_work_task(2, DAY, "Замена розетки")
+
+    database.close()
+    assert sorted(stored_tasks(tmp_path)) == ["Замена розетки", "Монтаж щитка"]
+
+def test_failed_batch_is_dropped_without_blocking_readers(make_database):
+    database = make_database(60_000)
+    lost_before = bot.metrics._counters.get(('bot_db_write_lost_total', ()), 0)
+    # Число вне диапазона INTEGER: sqlite3 бросает OverflowError, а не ошибку базы
+    database.add_work_day(1, DAY, 2 ** 70)
+
+    database.writer.flush()
+    assert database.writer.pending_count() == 0
+    assert bot.metrics._counters[('bot_db_write_lost_total', ())] == lost_before + 1
+    assert database.get_work_day(1, DAY) is None
+
+    database.add_work_task(1, DAY, "Монтаж щитка")
+    assert database.get_work_tasks(1, DAY) == ["Монтаж щитка"]